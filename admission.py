@@ -0,0 +1,148 @@
+import os
+import math
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from metrics import Counter, Histogram
+
+# Admission control in front of the agent. Each mode has a limit of concurrent generations
+# (what the Ollama instance / the Groq account can serve) and a bounded queue. Queued requests are
+# admitted round robin between users, so one user sending many questions can't take every slot.
+# The limits are per worker process, with several gunicorn workers the capacity is multiplied.
+ADMISSION_LIMITS = {
+    "local": int(os.getenv('ADMISSION_LOCAL_CONCURRENCY', 1)),
+    "cloud": int(os.getenv('ADMISSION_CLOUD_CONCURRENCY', 4)),
+}
+ADMISSION_QUEUE_SIZES = {
+    "local": int(os.getenv('ADMISSION_LOCAL_QUEUE', 8)),
+    "cloud": int(os.getenv('ADMISSION_CLOUD_QUEUE', 8)),
+}
+# Requests of the same user waiting at the same time, more are answered with 429
+ADMISSION_USER_QUEUE = int(os.getenv('ADMISSION_USER_QUEUE', 2))
+# Seconds a request can wait for a slot before it is answered with 503
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 60))
+
+admission_wait = Histogram("fiberbot_admission_wait_seconds", "Time a query waited for a generation slot", ("mode",))
+admission_rejected = Counter("fiberbot_admission_rejected_total", "Queries rejected by admission control", ("mode", "reason"))
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, user):
+        self.user = user
+        self.granted = False
+        self.enqueued_at = time.monotonic()
+
+
+class AdmissionController:
+    def __init__(self, limits=ADMISSION_LIMITS, queue_sizes=ADMISSION_QUEUE_SIZES, user_queue=ADMISSION_USER_QUEUE, timeout=ADMISSION_QUEUE_TIMEOUT):
+        self.limits = dict(limits)
+        self.queue_sizes = dict(queue_sizes)
+        self.user_queue = user_queue
+        self.timeout = timeout
+        self.condition = threading.Condition()
+        self.running = {mode: 0 for mode in self.limits}
+        # mode -> user -> queued tickets, the order of the users is the round robin order
+        self.waiting = {mode: OrderedDict() for mode in self.limits}
+        self.queued = {mode: 0 for mode in self.limits}
+        # Moving average of the time a generation holds a slot, used for Retry-After
+        self.service_time = {mode: 5.0 for mode in self.limits}
+        self.stats = {mode: {"admitted": 0, "queued": 0, "rejected_user": 0, "rejected_full": 0, "timeouts": 0} for mode in self.limits}
+
+    def retry_after(self, mode):
+        backlog = self.queued[mode] + self.running[mode]
+        return max(1, math.ceil(self.service_time[mode] * backlog / self.limits[mode]))
+
+    def reject(self, mode, status, reason, message):
+        self.stats[mode][reason] += 1
+        admission_rejected.inc(mode=mode, reason=reason)
+        raise AdmissionRejected(status, message, self.retry_after(mode))
+
+    def acquire(self, mode, user):
+        if mode not in self.limits:
+            return None
+        with self.condition:
+            if self.running[mode] < self.limits[mode] and not self.queued[mode]:
+                self.running[mode] += 1
+                self.stats[mode]["admitted"] += 1
+                admission_wait.observe(0, mode=mode)
+                return time.monotonic()
+            if len(self.waiting[mode].get(user, ())) >= self.user_queue:
+                self.reject(mode, 429, "rejected_user", "Demasiadas consultas en curso, espera a que terminen")
+            if self.queued[mode] >= self.queue_sizes[mode]:
+                self.reject(mode, 503, "rejected_full", "El modelo esta saturado, vuelve a intentarlo en unos segundos")
+
+            ticket = Ticket(user)
+            self.waiting[mode].setdefault(user, deque()).append(ticket)
+            self.queued[mode] += 1
+            self.stats[mode]["queued"] += 1
+            deadline = ticket.enqueued_at + self.timeout
+            while not ticket.granted:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.remove(mode, ticket)
+                    self.reject(mode, 503, "timeouts", "El modelo esta saturado, vuelve a intentarlo en unos segundos")
+                self.condition.wait(remaining)
+            admission_wait.observe(time.monotonic() - ticket.enqueued_at, mode=mode)
+            return time.monotonic()
+
+    def remove(self, mode, ticket):
+        tickets = self.waiting[mode][ticket.user]
+        tickets.remove(ticket)
+        if not tickets:
+            del self.waiting[mode][ticket.user]
+        self.queued[mode] -= 1
+
+    def release(self, mode, admitted_at):
+        if admitted_at is None:
+            return
+        with self.condition:
+            self.service_time[mode] = 0.8 * self.service_time[mode] + 0.2 * (time.monotonic() - admitted_at)
+            self.running[mode] -= 1
+            # Next user in the round robin gets the slot and goes to the end of the rotation
+            while self.running[mode] < self.limits[mode] and self.waiting[mode]:
+                user, tickets = next(iter(self.waiting[mode].items()))
+                ticket = tickets.popleft()
+                if tickets:
+                    self.waiting[mode].move_to_end(user)
+                else:
+                    del self.waiting[mode][user]
+                self.queued[mode] -= 1
+                self.running[mode] += 1
+                self.stats[mode]["admitted"] += 1
+                ticket.granted = True
+            self.condition.notify_all()
+
+    @contextmanager
+    def admit(self, mode, user):
+        admitted_at = self.acquire(mode, user)
+        try:
+            yield
+        finally:
+            self.release(mode, admitted_at)
+
+    def get_stats(self):
+        with self.condition:
+            return {
+                mode: {
+                    "limit": self.limits[mode],
+                    "queue_size": self.queue_sizes[mode],
+                    "running": self.running[mode],
+                    "waiting": self.queued[mode],
+                    "waiting_users": len(self.waiting[mode]),
+                    "avg_service_seconds": self.service_time[mode],
+                    **self.stats[mode],
+                }
+                for mode in self.limits
+            }
+
+
+admission = AdmissionController()
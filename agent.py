@@ -1,21 +1,27 @@
 import os
+import re
 import datetime
 import time
-import sqlite3
+import threading
+import uuid
 from typing import Annotated, TypedDict
-from langchain_ollama import ChatOllama
-from get_vector_db import get_vector_db
-from langchain_core.messages import BaseMessage, AIMessage
+from get_vector_db import get_embeddings
+from langchain_core.messages import BaseMessage, AIMessage, AIMessageChunk, HumanMessage, ToolMessage, RemoveMessage
 from langchain.tools.retriever import create_retriever_tool
-from langchain_community.tools import DuckDuckGoSearchRun
-from langgraph.checkpoint.memory import MemorySaver
-from langgraph.checkpoint.sqlite import SqliteSaver
-from langgraph.prebuilt import create_react_agent
-from flask import session
+from checkpoints import PooledSqliteSaver
+from langgraph.prebuilt import create_react_agent, ToolNode
 from tool_models import Subject, Class
+from fib_api import CachedFibApi
+from answer_cache import AnswerCache
+from router import IntentRouter, CHAT
+from tool_node import with_timeout
+from retriever import HybridRetriever, get_retrieval_stats
+from context import make_state_modifier, compact_thread, get_context_stats
+from metrics import MetricsCallbackHandler, record_llm_metrics, query_duration, query_errors, first_token_latency
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableConfig
+from langchain_core.tools import BaseTool, tool as create_tool
 from langgraph.graph.message import add_messages
-from langchain_groq import ChatGroq
 import sys
 
 # Redirect stdout to stderr
@@ -23,9 +29,11 @@ sys.stdout = sys.stderr
 
 LLM_MODEL = os.getenv('LLM_MODEL', 'llama3.1:8b')
 OLLAMA_SERVER_URL = os.getenv('OLLAMA_SERVER_URL', "http://localhost:11434")
+GROQ_MODEL = os.getenv('GROQ_MODEL', 'llama3-70b-8192')
+# Seconds an LLM request can take, in auto mode a timeout falls back to the other backend
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 120))
 
-conn = sqlite3.connect("checkpoints.sqlite", check_same_thread=False)
-memory = SqliteSaver(conn)
+memory = PooledSqliteSaver()
 
 #memory = MemorySaver()
 
@@ -47,57 +55,46 @@ class CustomState(TypedDict):
     week: str
     messages: Annotated[list[BaseMessage], add_messages]
     is_last_step: str
+    summary: str
 
-def print_metrics(message : AIMessage):
-    print("================================ Metrics ================================")
-    print(f"\033[32mUsing model: {message.response_metadata['model']} \033[0m")
-    print(f"\033[33mInput tokens: {message.usage_metadata['input_tokens']}")
-    print(f"Output tokens: {message.usage_metadata['output_tokens']}\033[0m")
-    print(f"\033[32mTotal tokens: {message.usage_metadata['total_tokens']}\033[0m")
-    print(f"\033[34mLoad duration: {message.response_metadata['load_duration']/1e6} ms")
-    print(f"Prompt evaluation duration: {message.response_metadata['prompt_eval_count']/1e6} ms")
-    print(f"Evaluation duration: {message.response_metadata['eval_duration']/1e6} ms\033[0m")
-    print(f"\033[32mTotal duration: {message.response_metadata['total_duration']/1e6} ms\033[0m")
-    print(f"\033[32mTokens/s: {message.usage_metadata['output_tokens']/(message.response_metadata['total_duration']/1e9)} T/s\033[0m")
-
-cost_per_million_tokens = {
-    "llama3-70b-8192" : {
-        "input" : 0.59,
-        "output" : 0.79
-    }
-}
-
-def print_cloud_compute_metrics(message: AIMessage):
-    print("================================ Metrics ================================")
-    model_name = message.response_metadata['model_name']
-    print(f"\033[32mUsing model: {model_name} \033[0m")
-    print(f"\033[33mInput tokens: {message.usage_metadata['input_tokens']}")
-    print(f"Output tokens: {message.usage_metadata['output_tokens']}\033[0m")
-    print(f"\033[32mTotal tokens: {message.usage_metadata['total_tokens']}\033[0m")
-    print(f"\033[34mQueue time: {message.response_metadata['token_usage']['queue_time']*1000} ms")
-    print(f"Prompt time: {message.response_metadata['token_usage']['prompt_time']*1000} ms")
-    print(f"Completion time: {message.response_metadata['token_usage']['completion_time']*1000} ms\033[0m")
-    print(f"\033[32mTotal time: {message.response_metadata['token_usage']['total_time']*1000} ms\033[0m")
-    print(f"\033[32mTokens/s: {message.usage_metadata['output_tokens']/(message.response_metadata['token_usage']['total_time'])} T/s\033[0m")
-    input_cost = (message.usage_metadata['input_tokens']/1e6)*cost_per_million_tokens[model_name]['input']
-    output_cost = (message.usage_metadata['output_tokens']/1e6)*cost_per_million_tokens[model_name]['output']
-    print("\033[33mInput Cost: " + '{0:.8f}'.format(input_cost) + "$")
-    print("Output Cost: " + '{0:.8f}'.format(output_cost) + "$\033[0m")
-    print("\033[32mTotal Cost: " + '{0:.8f}'.format(input_cost + output_cost) + "$\033[0m")
-    return input_cost + output_cost
 
 
+# Client libraries are imported when the first agent of their mode is built, not at startup
+def build_llm(mode, model):
+    if mode == "local":
+        from langchain_ollama import ChatOllama
+        return ChatOllama(model=model, base_url=OLLAMA_SERVER_URL, client_kwargs={"timeout": LLM_TIMEOUT})
+    elif mode == "cloud":
+        from langchain_groq import ChatGroq
+        return ChatGroq(model=model, timeout=LLM_TIMEOUT)
+    raise ValueError(f"Unknown mode {mode}")
+
+_search = None
+
+@create_tool("duckduckgo_search")
+def web_search(query: Annotated[str, "search query to look up"]) -> str:
+    """A wrapper around DuckDuckGo Search. Useful for when you need to answer questions about current events. Input should be a search query."""
+    # Same name and description as DuckDuckGoSearchRun, which is only imported the first time it is used
+    global _search
+    if _search is None:
+        from langchain_community.tools import DuckDuckGoSearchRun
+        _search = DuckDuckGoSearchRun()
+    return _search.invoke(query)
+
+def default_model(mode):
+    return GROQ_MODEL if mode == "cloud" else LLM_MODEL
 
 class Agent:
     def __init__(self, fib_api, token_key):
         # FIB API
-        self.fib_api = fib_api
+        self.fib_api = CachedFibApi(fib_api)
         self.token_key = token_key
 
         # Tools
-        search = DuckDuckGoSearchRun()
-        db = get_vector_db()
-        retriever = db.as_retriever(search_kwargs={'k': 2})
+        # The vector store is opened by the first search (or by warmup.py), not here
+        embeddings = get_embeddings()
+        self.answer_cache = AnswerCache(embeddings)
+        retriever = HybridRetriever()
         retrieval_tool = create_retriever_tool(
             retriever,
             "buscar_information_sobre_la_normativa_de_la_FIB",
@@ -108,14 +105,60 @@ class Agent:
             """,
         )
         self.tools=[retrieval_tool,
-                    search,
+                    web_search,
                     self.natural_language_chat, 
                     self.get_subjects_list, 
                     self.get_subject_info, 
                     self.get_user_class_schedule]
+        self.tools = [with_timeout(tool if isinstance(tool, BaseTool) else create_tool(tool)) for tool in self.tools]
+        self.tools_by_name = {tool.name: tool for tool in self.tools}
+        self.tool_node = ToolNode(self.tools)
+        self.router = IntentRouter(embeddings, {
+            CHAT: self.tools_by_name["natural_language_chat"].description,
+            **{tool.name: tool.description for tool in self.tools},
+        })
+
+        # Compiled agent graphs, shared by every request and keyed by (mode, model).
+        # The user token and thread_id travel in the config at invoke time.
+        self.executors = {}
+        self.llms = {}
+        self.state_modifiers = {}
+        self.executors_lock = threading.Lock()
+        self.executor_stats = {"hits": 0, "builds": 0}
 
-    def get_urls(self):
-        return self.fib_api.get('', headers={'Accept': 'application/json'}).data
+    def get_executor(self, mode, model=None):
+        key = (mode, model or default_model(mode))
+        with self.executors_lock:
+            agent_executor = self.executors.get(key)
+            if agent_executor is not None:
+                self.executor_stats["hits"] += 1
+                return agent_executor
+            llm = build_llm(*key)
+            state_modifier = make_state_modifier(prompt, key[1])
+            agent_executor = create_react_agent(llm, self.tool_node, checkpointer=memory, state_schema=CustomState, state_modifier=state_modifier, debug=False)
+            self.executors[key] = agent_executor
+            self.llms[key] = llm
+            self.state_modifiers[key] = state_modifier
+            self.executor_stats["builds"] += 1
+            print(f"\033[33mBuilt agent for mode={key[0]} model={key[1]}\033[0m")
+            return agent_executor
+
+    def get_stats(self):
+        with self.executors_lock:
+            return {
+                **self.executor_stats,
+                "agents": [{"mode": mode, "model": model} for mode, model in self.executors],
+                "fib_api_cache": self.fib_api.get_stats(),
+                "answer_cache": self.answer_cache.get_stats(),
+                "retrieval": get_retrieval_stats(),
+                "query_embeddings": get_embeddings().get_stats(),
+                "context": get_context_stats(),
+                "router": self.router.get_stats(),
+            }
+
+    def get_token(self, config):
+        # Token of the user that made the request, see Agent.query
+        return config.get("configurable", {}).get("token")
     
     def natural_language_chat(self):
         """
@@ -124,7 +167,7 @@ class Agent:
         """
         return "chat with the user"
     
-    def get_subject_info(self, siglas):
+    def get_subject_info(self, siglas, config: RunnableConfig):
         """
         Recupera informacion detallada sobre una asignatura de la lista de asignaturas que la universidad ofrece.
         Usalo cuando el usuario pregunta por la informacion de una asignatura, por ejemplo 'cuentame sobre la asignatura PTI'.
@@ -132,103 +175,265 @@ class Agent:
         Argumentos:
             siglas: las siglas de la asignatura.
             Por ejemplo en la pregunta 'cuentame sobre la asignatura PTI' las siglas serian PTI.
+            Si el usuario pregunta por varias asignaturas, pon todas las siglas separadas por comas, por ejemplo 'PTI, IDI'.
             Y si el usuario pregunta por una asignatura por su nombre, se tiene que traducir a sus siglas.
             Algunos ejemplos de nombres a siglas:
             Proyecto de Tecnologia de la Informacion, las siglas serian PTI.
         """
-        session.get(self.token_key)
-        urls = self.get_urls()
-        subjects = self.fib_api.get(urls['public']['assignatures'], headers={'Accept' : 'application/json','Accept-Language': 'es'}).data
-        for subject in subjects['results']:
-            if subject['sigles'] == siglas:
-                name = f"""name : {subject['nom']}"""
-                detailed_info = self.fib_api.get(subject['guia'], headers={'Accept' : 'application/json', 'Accept-Language': 'es'}).data
-                description = f"""description and metodologia_docent: {detailed_info['descripcio']} + {detailed_info['metodologia_docent']}"""
-                teachers = f"""teachers : {detailed_info['professors']}"""
-                department = f"""department: {detailed_info['departament']}"""
-                evaluation = f"""evaluation methodology : {detailed_info['metodologia_avaluacio']}"""
-                result = Subject(name, siglas, description, teachers, department, evaluation)
-                return result
-        return f"""No information about {siglas}"""
+        token = self.get_token(config)
+        acronyms = [acronym.upper() for acronym in re.split(r'[\s,;]+', siglas) if acronym]
+        subjects = [self.fib_api.find_subject(acronym, token) for acronym in acronyms]
+        # Guides of every requested subject are fetched at the same time
+        guides = self.fib_api.fetch_many([
+            (lambda url=subject['guia']: self.fib_api.get_guide(url, token))
+            for subject in subjects if subject is not None
+        ])
+        guides = iter(guides)
+        results = []
+        for acronym, subject in zip(acronyms, subjects):
+            if subject is None:
+                results.append(f"""No information about {acronym}""")
+                continue
+            name = f"""name : {subject['nom']}"""
+            detailed_info = next(guides)
+            description = f"""description and metodologia_docent: {detailed_info['descripcio']} + {detailed_info['metodologia_docent']}"""
+            teachers = f"""teachers : {detailed_info['professors']}"""
+            department = f"""department: {detailed_info['departament']}"""
+            evaluation = f"""evaluation methodology : {detailed_info['metodologia_avaluacio']}"""
+            results.append(Subject(name, acronym, description, teachers, department, evaluation))
+        if len(results) == 1:
+            return results[0]
+        return results or f"""No information about {siglas}"""
     
-    def get_subjects_list(self):
+    def get_subjects_list(self, config: RunnableConfig):
         """
         Obtiene las asignaturas que el usuario esta matriculado.
         Usalo para saber que asignaturas el usuario esta actualmente matriculado,
         pro ejemplo cuando el usuario pregunta 'que asignaturas tengo este quadrimestre'
         """
-        session.get(self.token_key)
-        urls = self.get_urls()
-        subjects = self.fib_api.get(urls['privat']['assignatures'], headers={'Accept' : 'application/json', 'Accept-Language': 'es'}).data
+        subjects = self.fib_api.get_private('assignatures', self.get_token(config))
         names = []
         for subject in subjects['results']:
             names.append(subject['nom'])
         return names
     
-    def get_user_class_schedule(self):
+    def get_user_class_schedule(self, config: RunnableConfig):
         """
         Obtiene el horario de clases del usuario.
         Usa esta funcion caundo el usuario pregunta por el horario de clases,
         por ejemplo cuando el usuario pregunta 'que clases tengo hoy'
         """
-        session.get(self.token_key)
-        urls = self.get_urls()
-        schedule = self.fib_api.get(urls['privat']['horari'], headers={'Accept' : 'application/json', 'Accept-Language': 'es'}).data
-        subjects = self.fib_api.get(urls['privat']['assignatures'], headers={'Accept' : 'application/json', 'Accept-Language': 'es'}).data
-        clases = []
-        for clase in schedule['results']:
-            name = "name: " + clase['codi_assig']
-            for subject in subjects['results']:
-                if subject['id'] == clase['codi_assig']:
-                    name = "name: " + subject['nom']
-                    break
-            grupo = "group: " + clase['grup']
-            dia_semana = "day of the week: " + weekDaysMapping[clase['dia_setmana'] - 1]
-            inicio = "start: " + clase['inici']
-            durada = f"duration: {clase['durada']}"
-            tipo = 'laboratory' if clase['tipus'] == "L" else 'teory'
-            aula = "class rooms: " + clase['aules']
-            clases.append(Class(name, grupo, dia_semana, inicio, durada, tipo, aula))
+        token = self.get_token(config)
+        self.fib_api.get_urls(token)
+        schedule, subjects = self.fib_api.fetch_many([
+            lambda: self.fib_api.get_private('horari', token),
+            lambda: self.fib_api.get_private('assignatures', token),
+        ])
+        names = {subject['id']: subject['nom'] for subject in subjects['results']}
+        clases = [
+            Class("name: " + names.get(clase['codi_assig'], clase['codi_assig']),
+                  "group: " + clase['grup'],
+                  "day of the week: " + weekDaysMapping[clase['dia_setmana'] - 1],
+                  "start: " + clase['inici'],
+                  f"duration: {clase['durada']}",
+                  'laboratory' if clase['tipus'] == "L" else 'teory',
+                  "class rooms: " + clase['aules'])
+            for clase in schedule['results']
+        ]
         return clases
 
-    def query(self, input, thread_id, mode):
-        if input:
-            
-            if mode == "local":
-                start_time = time.monotonic()
-                llm = ChatOllama(model=LLM_MODEL,base_url=OLLAMA_SERVER_URL)
-                agent_executor = create_react_agent(llm, self.tools, checkpointer=memory, state_schema=CustomState, state_modifier=prompt, debug=False)
-                config = {"configurable": {"thread_id": thread_id}}
-                inputs = {"messages": [("user", f"{input}")], "today": f"{datetime.datetime.now()}", "week" : f"{weekDaysMapping[datetime.datetime.now().weekday()]}", "is_last_step" : ""}
-                for chunk in agent_executor.stream(inputs, config, stream_mode="values"):
-                    message = chunk["messages"][-1]
-                    if isinstance(message, tuple):
-                        print(message)
-                    else:
-                        message.pretty_print()
-                    if isinstance(message, AIMessage):
-                        print_metrics(message)
-                end_time = time.monotonic()
-                print(f"\033[31mTotal query execution time: {end_time - start_time} s\033[0m")
-                return chunk['messages'][-1].content
-            
-            elif mode == "cloud":
-                start_time = time.monotonic()
-                llm = ChatGroq(model='llama3-70b-8192')
-                agent_executor = create_react_agent(llm, self.tools, checkpointer=memory, state_schema=CustomState, state_modifier=prompt, debug=False)
-                config = {"configurable": {"thread_id": thread_id}}
-                inputs = {"messages": [("user", f"{input}")], "today": f"{datetime.datetime.now()}", "week" : f"{weekDaysMapping[datetime.datetime.now().weekday()]}", "is_last_step" : ""}
-                query_cost = 0
-                for chunk in agent_executor.stream(inputs, config, stream_mode="values"):
+    def compact_history(self, mode, agent_executor, config):
+        compact_thread(agent_executor, self.llms[(mode, default_model(mode))], config)
+
+    def thread_message_ids(self, mode, thread_id):
+        agent_executor = self.get_executor(mode)
+        state = agent_executor.get_state({"configurable": {"thread_id": thread_id}})
+        return {message.id for message in state.values.get("messages", [])}
+
+    def discard_turn(self, mode, thread_id, message_ids):
+        # Removes what a failed turn left in the thread (see thread_message_ids) before it is retried on the other backend
+        if not message_ids:
+            # The thread started with the failed turn
+            memory.delete_thread(thread_id)
+            return
+        agent_executor = self.get_executor(mode)
+        config = {"configurable": {"thread_id": thread_id}}
+        stale = [RemoveMessage(id=message.id) for message in agent_executor.get_state(config).values.get("messages", [])
+                 if message.id not in message_ids]
+        if stale:
+            agent_executor.update_state(config, {"messages": stale}, as_node="agent")
+
+    def is_first_turn(self, agent_executor, config):
+        return not agent_executor.get_state(config).values.get("messages")
+
+    def remember_cached_answer(self, agent_executor, config, input, answer):
+        # Keep the thread history consistent when the answer comes from the cache
+        agent_executor.update_state(config, {"messages": [HumanMessage(content=input), AIMessage(content=answer)]}, as_node="agent")
+
+    def routed_turn(self, route, input, thread_id, mode, agent_executor, config, question_embedding, collection_version, first_turn):
+        # Fast path of the router: the tool (if any) is called directly and one generation answers,
+        # the turn is stored in the thread as if the agent had run it
+        start_time = time.monotonic()
+        key = (mode, default_model(mode))
+        telemetry = MetricsCallbackHandler(mode, thread_id)
+        config = {**config, "callbacks": [telemetry]}
+        state = agent_executor.get_state(config).values
+        new_messages = [HumanMessage(content=input)]
+        try:
+            if route.tool:
+                call = {"name": route.tool, "args": route.args, "id": f"call_{uuid.uuid4().hex}", "type": "tool_call"}
+                new_messages.append(AIMessage(content="", tool_calls=[call]))
+                yield {"event": "tool_start", "tools": [route.tool]}
+                # Same node as the agent, with its error handling and timeouts
+                tool_message = self.tool_node.invoke([new_messages[-1]], config)[0]
+                new_messages.append(tool_message)
+                yield {"event": "tool_end", "tool": route.tool, "status": tool_message.status}
+
+            now = datetime.datetime.now()
+            prompt_messages = self.state_modifiers[key]({**state, "messages": state.get("messages", []) + new_messages,
+                                                         "today": f"{now}", "week": f"{weekDaysMapping[now.weekday()]}"})
+            generation = None
+            first_token_time = None
+            generation_start = time.monotonic()
+            for chunk in self.llms[key].stream(prompt_messages, config):
+                if chunk.content:
+                    if first_token_time is None:
+                        first_token_time = time.monotonic()
+                    yield {"event": "token", "content": chunk.content}
+                generation = chunk if generation is None else generation + chunk
+            generation_time = time.monotonic() - generation_start
+            message = AIMessage(content=generation.content, response_metadata=generation.response_metadata, usage_metadata=generation.usage_metadata)
+            record_llm_metrics(mode, message)
+            agent_executor.update_state(config, {"messages": new_messages + [message]}, as_node="agent")
+        except BaseException as e:
+            if not isinstance(e, GeneratorExit):
+                query_errors.inc(mode=mode)
+            telemetry.finish(e)
+            raise
+        telemetry.finish()
+
+        duration = time.monotonic() - start_time
+        query_duration.observe(duration, mode=mode, path="router")
+        if first_token_time is not None:
+            first_token_latency.observe(first_token_time - start_time, mode=mode)
+        self.router.observe_route(route, duration, generation_time)
+        self.answer_cache.store(question_embedding, collection_version, input, message.content, {route.tool} if route.tool else set(), first_turn)
+        yield {"event": "done", "message": message.content}
+
+    def query(self, input, thread_id, mode, token=None):
+        if input and mode in ("local", "cloud"):
+            start_time = time.monotonic()
+            agent_executor = self.get_executor(mode)
+            config = {"configurable": {"thread_id": thread_id, "token": token}}
+            self.compact_history(mode, agent_executor, config)
+            first_turn = self.is_first_turn(agent_executor, config)
+
+            answer, question_embedding, collection_version = self.answer_cache.lookup(input, first_turn)
+            if answer:
+                self.remember_cached_answer(agent_executor, config, input, answer)
+                query_duration.observe(time.monotonic() - start_time, mode=mode, path="cache")
+                print(f"\033[31mTotal query execution time: {time.monotonic() - start_time} s (answer cache)\033[0m")
+                return answer
+
+            route = self.router.route(input, question_embedding)
+            if route:
+                for event in self.routed_turn(route, input, thread_id, mode, agent_executor, config, question_embedding, collection_version, first_turn):
+                    if event["event"] == "done":
+                        print(f"\033[31mTotal query execution time: {time.monotonic() - start_time} s (router)\033[0m")
+                        return event["message"]
+
+            inputs = {"messages": [("user", f"{input}")], "today": f"{datetime.datetime.now()}", "week" : f"{weekDaysMapping[datetime.datetime.now().weekday()]}", "is_last_step" : ""}
+            query_cost = 0
+            tools_used = set()
+            telemetry = MetricsCallbackHandler(mode, thread_id)
+            try:
+                for chunk in agent_executor.stream(inputs, {**config, "callbacks": [telemetry]}, stream_mode="values"):
                     message = chunk["messages"][-1]
                     if isinstance(message, tuple):
                         print(message)
                     else:
                         message.pretty_print()
                     if isinstance(message, AIMessage):
-                        query_cost += print_cloud_compute_metrics(message)
-                end_time = time.monotonic()
-                print(f"\033[31mTotal query execution time: {end_time - start_time} s")
-                print("Total query cost: " + '{0:.8f}'.format(query_cost) +"$\033[0m")
-                return chunk['messages'][-1].content
-        return None
\ No newline at end of file
+                        query_cost += record_llm_metrics(mode, message)
+                        tools_used.update(call["name"] for call in message.tool_calls)
+            except Exception as e:
+                query_errors.inc(mode=mode)
+                telemetry.finish(e)
+                raise
+            telemetry.finish()
+            end_time = time.monotonic()
+            query_duration.observe(end_time - start_time, mode=mode, path="agent")
+            print(f"\033[31mTotal query execution time: {end_time - start_time} s\033[0m")
+            if mode == "cloud":
+                print("\033[31mTotal query cost: " + '{0:.8f}'.format(query_cost) +"$\033[0m")
+            response = chunk['messages'][-1].content
+            self.answer_cache.store(question_embedding, collection_version, input, response, tools_used, first_turn)
+            return response
+        return None
+
+    def stream_query(self, input, thread_id, mode, token=None):
+        # Same pipeline as query, but yields tool progress and LLM tokens as they are produced
+        if not input:
+            return
+
+        start_time = time.monotonic()
+        agent_executor = self.get_executor(mode)
+        config = {"configurable": {"thread_id": thread_id, "token": token}}
+        self.compact_history(mode, agent_executor, config)
+        first_turn = self.is_first_turn(agent_executor, config)
+
+        answer, question_embedding, collection_version = self.answer_cache.lookup(input, first_turn)
+        if answer:
+            self.remember_cached_answer(agent_executor, config, input, answer)
+            query_duration.observe(time.monotonic() - start_time, mode=mode, path="cache")
+            yield {"event": "token", "content": answer}
+            yield {"event": "done", "message": answer, "cached": True}
+            return
+
+        route = self.router.route(input, question_embedding)
+        if route:
+            yield from self.routed_turn(route, input, thread_id, mode, agent_executor, config, question_embedding, collection_version, first_turn)
+            return
+
+        inputs = {"messages": [("user", f"{input}")], "today": f"{datetime.datetime.now()}", "week" : f"{weekDaysMapping[datetime.datetime.now().weekday()]}", "is_last_step" : ""}
+        response = None
+        tools_used = set()
+        first_token_time = None
+        telemetry = MetricsCallbackHandler(mode, thread_id)
+        try:
+            for stream_mode, chunk in agent_executor.stream(inputs, {**config, "callbacks": [telemetry]}, stream_mode=["messages", "updates"]):
+                if stream_mode == "messages":
+                    message, metadata = chunk
+                    if metadata.get("langgraph_node") == "agent" and isinstance(message, AIMessageChunk) and message.content:
+                        if first_token_time is None:
+                            first_token_time = time.monotonic()
+                        yield {"event": "token", "content": message.content}
+                    continue
+
+                for node, update in chunk.items():
+                    for message in update.get("messages", []) if isinstance(update, dict) else []:
+                        if isinstance(message, AIMessage):
+                            record_llm_metrics(mode, message)
+                            if message.tool_calls:
+                                tools_used.update(call["name"] for call in message.tool_calls)
+                                yield {"event": "tool_start", "tools": [call["name"] for call in message.tool_calls]}
+                            else:
+                                response = message.content
+                        elif isinstance(message, ToolMessage):
+                            yield {"event": "tool_end", "tool": message.name, "status": message.status}
+        except BaseException as e:
+            # GeneratorExit when the client disconnects mid stream
+            if not isinstance(e, GeneratorExit):
+                query_errors.inc(mode=mode)
+            telemetry.finish(e)
+            raise
+        telemetry.finish()
+
+        end_time = time.monotonic()
+        query_duration.observe(end_time - start_time, mode=mode, path="agent")
+        if first_token_time is not None:
+            first_token_latency.observe(first_token_time - start_time, mode=mode)
+            print(f"\033[31mTime to first token: {first_token_time - start_time} s\033[0m")
+        print(f"\033[31mTotal query execution time: {end_time - start_time} s\033[0m")
+        self.answer_cache.store(question_embedding, collection_version, input, response, tools_used, first_turn)
+        yield {"event": "done", "message": response}
@@ -0,0 +1,93 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from get_vector_db import get_collection_version
+
+# Semantic cache of answers to questions that do not depend on the user or the conversation.
+# Only the first turn of a thread is looked up and stored, a follow-up ("¿y el segundo?") depends on
+# the history. Only answers grounded on the normativa retriever are stored: answers built from private
+# tools (schedule, enrolled subjects) or without any tool may depend on the user.
+ANSWER_CACHE_ENABLED = os.getenv('ANSWER_CACHE_ENABLED', 'true').lower() == 'true'
+ANSWER_CACHE_THRESHOLD = float(os.getenv('ANSWER_CACHE_THRESHOLD', 0.95))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', 24 * 3600))
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', 512))
+
+RETRIEVAL_TOOL = "buscar_information_sobre_la_normativa_de_la_FIB"
+CACHEABLE_TOOLS = {RETRIEVAL_TOOL, "natural_language_chat"}
+
+
+class AnswerCache:
+    def __init__(self, embeddings, threshold=ANSWER_CACHE_THRESHOLD, ttl=ANSWER_CACHE_TTL, maxsize=ANSWER_CACHE_SIZE):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        # key -> (normalized embedding, question, answer, created, collection version or None)
+        self.entries = OrderedDict()
+        self.next_key = 0
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "expired": 0, "invalidated": 0, "errors": 0}
+
+    def embed(self, question):
+        try:
+            vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+        except Exception as e:
+            # The cache is an optimization, the agent still answers if the embedding server fails
+            print(f"\033[31mAnswer cache disabled for this query: {e}\033[0m")
+            with self.lock:
+                self.stats["errors"] += 1
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, question, first_turn=True):
+        # Returns (answer or None, embedding of the question and collection version to pass to store).
+        # The version is read before the agent retrieves, an answer built while the collection changes
+        # is stored with the older version and dropped on the next lookup.
+        version = get_collection_version()
+        if not ANSWER_CACHE_ENABLED:
+            return None, None, version
+        vector = self.embed(question)
+        if vector is None or not first_turn:
+            return None, vector, version
+
+        now = time.time()
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if now - entry[3] > self.ttl:
+                    del self.entries[key]
+                    self.stats["expired"] += 1
+                elif entry[4] is not None and entry[4] != version:
+                    del self.entries[key]
+                    self.stats["invalidated"] += 1
+            if self.entries:
+                keys = list(self.entries)
+                similarities = np.stack([self.entries[key][0] for key in keys]) @ vector
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.entries.move_to_end(keys[best])
+                    self.stats["hits"] += 1
+                    entry = self.entries[keys[best]]
+                    print(f"\033[32mAnswer cache hit ({similarities[best]:.3f}): '{entry[1]}'\033[0m")
+                    return entry[2], vector, version
+            self.stats["misses"] += 1
+        return None, vector, version
+
+    def store(self, vector, version, question, answer, tools_used, first_turn=True):
+        # Answers built from the collection are dropped as soon as its content changes
+        if vector is None or not answer or not first_turn or RETRIEVAL_TOOL not in tools_used or not set(tools_used) <= CACHEABLE_TOOLS:
+            return False
+        with self.lock:
+            self.entries[self.next_key] = (vector, question, answer, time.time(), version)
+            self.next_key += 1
+            self.stats["stores"] += 1
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return True
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, "size": len(self.entries), "maxsize": self.maxsize,
+                    "threshold": self.threshold, "ttl": self.ttl, "enabled": ANSWER_CACHE_ENABLED}
@@ -1,16 +1,32 @@
 import os
+import re
+import json
+import time
+import uuid
+import threading
+# Start of the process, for the startup report
+process_start = time.monotonic()
 from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
-from flask import Flask, redirect, request, jsonify, render_template, url_for, session, send_file
+from flask import Flask, Response, redirect, request, jsonify, render_template, url_for, session, send_file, stream_with_context
 from flask_oauthlib.client import OAuth
-from embed import embed, embed_url
+from embed import allowed_file, save_file, remove_source
+from ingest import ingestion_queue
+from source_catalog import get_source_catalog
 from werkzeug import security
 from agent import Agent
-from agent import conn
-from get_vector_db import get_vector_db
+from agent import memory
+from metrics import render_metrics, register_collector, export_stats
+from admission import admission, AdmissionRejected
+from backend_router import backend_router
+from fib_api import user_key
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 from flask_marshmallow import Marshmallow
+from warmup import start_warm_up, get_startup_report, record_phase, ready
 
+imports_end = time.monotonic()
+record_phase("imports", imports_end - process_start)
 load_dotenv()
 SOURCE_FOLDER = os.getenv('SOURCE_FOLDER', './document_source')
 os.makedirs(SOURCE_FOLDER, exist_ok=True)
@@ -21,21 +37,20 @@ app.config.from_object('config')
 app.config['SESSION_COOKIE_SAMESITE'] = 'Strict'
 app.config['SESSION_COOKIE_SECURE'] = True
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI']='sqlite:///'+os.path.join(basedir, 'db.sqlite')
+app.config['SQLALCHEMY_DATABASE_URI']=os.getenv('DATABASE_URL', 'sqlite:///'+os.path.join(basedir, 'db.sqlite'))
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 db = SQLAlchemy(app)
 ma = Marshmallow(app)
 app.app_context().push()
 oauth = OAuth(app)
-app_url = 'https://api.fib.upc.edu/v2/'
+app_url = os.getenv('FIB_API_URL', 'https://api.fib.upc.edu/v2/')
 # OAuth UPC/FIB
 def get_random_state():
     return security.gen_salt(16)
 
-state = get_random_state()
 fib = oauth.remote_app(
     'fib',
-    request_token_params={'scope': 'read', 'state': state},
+    request_token_params={'scope': 'read'},
     base_url=app_url,
     request_token_url=None,
     access_token_method='POST',
@@ -44,12 +59,41 @@ fib = oauth.remote_app(
     app_key='RACO'
 )
 token_key = 'api_token'
+# Seconds the login lasts (max_age of the authenticated cookie)
+SESSION_MAX_AGE = int(os.getenv('SESSION_MAX_AGE', 3600))
+record_phase("app_setup", time.monotonic() - imports_end)
+agent_start = time.monotonic()
+agent = Agent(fib, token_key)
+record_phase("agent", time.monotonic() - agent_start)
+# With python3 app.py the processes of the PDF parse pool (embed.py) run this script as __mp_main__,
+# they only parse pages and must not claim ingestion jobs or warm up
+if __name__ != '__mp_main__':
+    ingestion_queue.start()
+    memory.start_compaction()
+    # Vector store, models and compiled graphs are loaded in the background, /readyz says when they are
+    start_warm_up(agent, process_start)
+    print(f"\033[32mServing after {time.monotonic() - process_start:.2f} s, warming up in the background\033[0m")
+
+def collect_stats():
+    stats = agent.get_stats()
+    for component in ("fib_api_cache", "answer_cache", "retrieval", "query_embeddings", "context", "router"):
+        export_stats(component, stats.pop(component))
+    export_stats("agent", stats)
+    export_stats("checkpoints", memory.get_stats())
+    export_stats("admission", admission.get_stats())
+    export_stats("backend_router", backend_router.get_stats())
+register_collector(collect_stats)
+
+# Admission control: the query routes answer 429/503 with Retry-After when the model is saturated
+@app.errorhandler(AdmissionRejected)
+def admission_rejected(e):
+    return jsonify({"error": e.message}), e.status, {"Retry-After": str(e.retry_after)}
 
 # Authentication check
 
 @app.before_request
 def enforce_authentication():
-    if request.endpoint not in ['login', 'authorized', 'static', 'login_view'] and not request.cookies.get('authenticated'):
+    if request.endpoint not in ['login', 'authorized', 'static', 'login_view', 'metrics', 'healthz', 'readyz'] and not request.cookies.get('authenticated'):
         session.clear()
         if request.endpoint == 'index':
             return redirect(url_for('login_view'))
@@ -58,10 +102,13 @@ def enforce_authentication():
 # login routes
 @app.route('/login')
 def login():
-    return fib.authorize(callback=url_for('authorized', _external=True), approval_prompt='auto')
+    # The state lives in the session cookie, the callback can reach any gunicorn worker
+    session['oauth_state'] = get_random_state()
+    return fib.authorize(callback=url_for('authorized', _external=True), state=session['oauth_state'], approval_prompt='auto')
 
 @app.route('/logout')
 def logout():
+    agent.fib_api.evict_user(session.get(token_key))
     session.clear()
     response = redirect(url_for('login_view'))
     response.set_cookie('authenticated', '', expires=0)
@@ -70,47 +117,154 @@ def logout():
 @app.route('/login/authorized')
 def authorized():
     resp = fib.authorized_response()
-    received_state = request.args['state']
-    if resp is None or resp.get('access_token') is None or received_state is None or received_state != state:
+    received_state = request.args.get('state')
+    expected_state = session.pop('oauth_state', None)
+    if resp is None or resp.get('access_token') is None or received_state is None or received_state != expected_state:
         return jsonify({"error": "access denied"}), 401
     else:
         session[token_key] = (resp['access_token'], '')
+        session['expires_at'] = time.time() + SESSION_MAX_AGE
+        prefetch_user_data()
         response = redirect(url_for('index'))
-        response.set_cookie(key="authenticated", value="True", max_age=3600)
+        response.set_cookie(key="authenticated", value="True", max_age=SESSION_MAX_AGE)
         return response
 
+def prefetch_user_data():
+    # Schedule and subjects of the user are loaded in the background and kept fresh until logout or the end
+    # of the session. The cache is per worker, the first request of the user in a worker starts it there.
+    token = session.get(token_key)
+    if token:
+        agent.fib_api.prefetch_user(token, session.get('expires_at', time.time() + SESSION_MAX_AGE))
+
 #DB CHATS
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class Chat(db.Model):
     __tablename__ = "chats"
+    # Listing order of /chats
+    __table_args__ = (db.Index('ix_chats_created_at_id', 'created_at', 'id'),)
 
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False, unique=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
     messages = db.relationship('Message', back_populates='chat', cascade='all, delete-orphan')
 
 class ChatSchema(ma.Schema):
     class Meta:
-        fields = ('id', 'title')
+        fields = ('id', 'title', 'created_at')
 
 chatschema = ChatSchema()
 chatschemas = ChatSchema(many = True)
 
 class Message(db.Model):
     __tablename__ = "messages"
+    # Listing order of /chats/<chatid>/messages
+    __table_args__ = (db.Index('ix_messages_chat_id_created_at_id', 'chat_id', 'created_at', 'id'),)
 
     id = db.Column(db.Integer, primary_key=True)
-    chat_id = db.Column(db.String(50), db.ForeignKey('chats.id'),nullable=False)
+    chat_id = db.Column(db.Integer, db.ForeignKey('chats.id'),nullable=False)
     chat = db.relationship('Chat', back_populates='messages')
     role = db.Column(db.String(10), nullable=False)  # "human" o "ai"
     content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
 
 class MessagesSchema(ma.Schema):
     class Meta:
-        fields = ('id', 'chat_id', 'role', 'content')
+        fields = ('id', 'chat_id', 'role', 'content', 'created_at')
 
 messagechema = MessagesSchema()
 messageschemas = MessagesSchema(many = True)
 
+# Number of chats created with each title, "title (n)" is the next one
+class ChatTitle(db.Model):
+    __tablename__ = "chat_titles"
+
+    title = db.Column(db.String(100), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+# Background deletions of chats (?background=true), with the rows removed so far
+class DeletionJob(db.Model):
+    __tablename__ = "deletion_jobs"
+
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # "drop_chat" o "dropallchats"
+    status = db.Column(db.String(10), nullable=False)  # "running", "done" o "failed"
+    chats = db.Column(db.Integer, nullable=False, default=0)
+    messages = db.Column(db.Integer, nullable=False, default=0)
+    checkpoints = db.Column(db.Integer, nullable=False, default=0)
+    writes = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+class DeletionJobSchema(ma.Schema):
+    class Meta:
+        fields = ('id', 'kind', 'status', 'chats', 'messages', 'checkpoints', 'writes', 'error', 'created_at', 'updated_at')
+
+deletionjobschema = DeletionJobSchema()
+
+def migrate_chats():
+    # db.sqlite files created before chat_id was an Integer and chats had created_at: the tables are
+    # rebuilt with the current schema in one transaction, the old rows get the migration time
+    if db.engine.dialect.name != 'sqlite':
+        return
+    with db.engine.connect() as conn:
+        tables = {row[0] for row in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        if 'chats' not in tables:
+            return
+        chat_columns = {row[1] for row in conn.exec_driver_sql("PRAGMA table_info(chats)")}
+        message_types = {row[1]: row[2] for row in conn.exec_driver_sql("PRAGMA table_info(messages)")}
+        if 'created_at' in chat_columns and message_types.get('chat_id') == 'INTEGER':
+            return
+        now = utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+        # pysqlite doesn't open a transaction for DDL by itself
+        conn.exec_driver_sql("BEGIN")
+        conn.exec_driver_sql("ALTER TABLE messages RENAME TO messages_old")
+        conn.exec_driver_sql("ALTER TABLE chats RENAME TO chats_old")
+        db.metadata.create_all(conn, tables=[Chat.__table__, Message.__table__])
+        conn.exec_driver_sql("INSERT INTO chats (id, title, created_at) SELECT id, title, ? FROM chats_old", (now,))
+        conn.exec_driver_sql("""
+            INSERT INTO messages (id, chat_id, role, content, created_at)
+            SELECT id, CAST(chat_id AS INTEGER), role, content, ? FROM messages_old
+            WHERE CAST(chat_id AS INTEGER) IN (SELECT id FROM chats_old)
+        """, (now,))
+        conn.exec_driver_sql("DROP TABLE messages_old")
+        conn.exec_driver_sql("DROP TABLE chats_old")
+        conn.commit()
+    print("\033[33mMigrated chats and messages to the current schema\033[0m")
+
+def backfill_chat_titles():
+    # Counters of the titles of chats created before chat_titles existed
+    if ChatTitle.query.first() is not None or Chat.query.first() is None:
+        return
+    counts = {}
+    for (title,) in db.session.query(Chat.title):
+        match = re.match(r"^(.*) \((\d+)\)$", title)
+        base, count = (match.group(1), int(match.group(2)) + 1) if match else (title, 1)
+        counts[base] = max(counts.get(base, 0), count)
+    db.session.add_all(ChatTitle(title=title, count=count) for title, count in counts.items())
+    db.session.commit()
+
+migrate_chats()
 db.create_all()
+backfill_chat_titles()
+
+# Keyset pagination of chats and messages, by creation time and id
+CHATS_PAGE_SIZE = int(os.getenv('CHATS_PAGE_SIZE', 50))
+MESSAGES_PAGE_SIZE = int(os.getenv('MESSAGES_PAGE_SIZE', 50))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 200))
+EPOCH = datetime(1970, 1, 1)
+
+def encode_cursor(row):
+    return f"{(row.created_at - EPOCH) // timedelta(microseconds=1)}-{row.id}"
+
+def decode_cursor(cursor):
+    created_at, id = cursor.split('-')
+    return EPOCH + timedelta(microseconds=int(created_at)), int(id)
+
+def page_size(default):
+    return max(1, min(request.args.get('limit', default, type=int), MAX_PAGE_SIZE))
 
 #CREAR CHAT CON TITULO
 #curl --request POST   --url http://localhost:8080/new_chat   --header 'Content-Type: application/json'   --data '{ "title": "TITLE" }'
@@ -123,107 +277,189 @@ def new_chat():
     if not title:
         return jsonify({"error": "El título es obligatorio"}), 400
     
-    #existing_chat = Chat.query.filter_by(title=t).first()
-    count = Chat.query.filter(Chat.title.like(f"{title}%")).count()
-
-    if count:
-        title = f"{title} ({count})"
-    
-    chat = Chat(title = title)
-    db.session.add(chat)
+    # The counter of the title gives the next "title (n)" without looking at the other chats. A
+    # title taken by hand (someone created "x (1)" before the second "x") moves to the next number.
+    for _ in range(10):
+        count = db.session.execute(db.text(
+            "INSERT INTO chat_titles (title, count) VALUES (:title, 1) "
+            "ON CONFLICT (title) DO UPDATE SET count = chat_titles.count + 1 RETURNING count"
+        ), {"title": title}).scalar_one()
+        chat = Chat(title = title if count == 1 else f"{title} ({count - 1})")
+        try:
+            with db.session.begin_nested():
+                db.session.add(chat)
+            break
+        except IntegrityError:
+            continue
+    else:
+        db.session.rollback()
+        return jsonify({"error": "No se pudo crear el chat"}), 409
     db.session.commit()
     result = chatschema.dump(chat)
     
     return jsonify({"chat": result}), 200
 
-#BORRAR CHAT Y SUS MENSAJES DADO UN TITULO
-#curl --request POST   --url http://localhost:8080/drop_chat/<chatid>'
-@app.route('/drop_chat/<string:chatid>', methods=['DELETE'])
+# Rows deleted per statement, every batch is its own transaction so live queries only wait for one batch
+CHAT_DELETE_BATCH = int(os.getenv('CHAT_DELETE_BATCH', 1000))
+
+def delete_chats(chat_ids=None, progress=None):
+    # Deletes the chats (every chat that exists when it starts if chat_ids is None), their messages and
+    # their agent threads with set based statements, and returns the rows removed
+    counts = {"chats": 0, "messages": 0, "checkpoints": 0, "writes": 0}
+    if chat_ids is None:
+        last_id = db.session.query(db.func.max(Chat.id)).scalar()
+        pending = None
+    else:
+        pending = list(chat_ids)
+    while True:
+        if pending is None:
+            ids = [id for (id,) in db.session.query(Chat.id).filter(Chat.id <= last_id).order_by(Chat.id).limit(CHAT_DELETE_BATCH)] if last_id is not None else []
+        else:
+            ids, pending = pending[:CHAT_DELETE_BATCH], pending[CHAT_DELETE_BATCH:]
+        if not ids:
+            break
+        while True:
+            batch = db.select(Message.id).where(Message.chat_id.in_(ids)).limit(CHAT_DELETE_BATCH)
+            deleted = Message.query.filter(Message.id.in_(batch)).delete(synchronize_session=False)
+            db.session.commit()
+            counts["messages"] += deleted
+            if deleted < CHAT_DELETE_BATCH:
+                break
+        counts["chats"] += Chat.query.filter(Chat.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        for table, deleted in memory.delete_threads([str(id) for id in ids]).items():
+            counts[table] += deleted
+        if progress:
+            progress(counts)
+    if chat_ids is None and Chat.query.first() is None:
+        # Titles start again from "title" once there are no chats
+        ChatTitle.query.delete(synchronize_session=False)
+        db.session.commit()
+    db.session.expire_all()
+    return counts
+
+def start_deletion_job(kind, chat_ids=None):
+    job_id = uuid.uuid4().hex
+    db.session.add(DeletionJob(id=job_id, kind=kind, status="running"))
+    db.session.commit()
+
+    def update_job(**fields):
+        DeletionJob.query.filter_by(id=job_id).update({**fields, "updated_at": utcnow()}, synchronize_session=False)
+        db.session.commit()
+
+    def run():
+        start_time = time.monotonic()
+        with app.app_context():
+            try:
+                counts = delete_chats(chat_ids, progress=lambda counts: update_job(**counts))
+                update_job(status="done", **counts)
+                print(f"\033[32mDeletion job {job_id} ({kind}) done in {time.monotonic() - start_time:.2f} s: {counts}\033[0m")
+            except Exception as e:
+                db.session.rollback()
+                update_job(status="failed", error=str(e))
+                print(f"\033[31mDeletion job {job_id} ({kind}) failed: {e}\033[0m")
+
+    threading.Thread(target=run, name=f"deletion-{job_id}", daemon=True).start()
+    return job_id
+
+#BORRAR CHAT Y SUS MENSAJES DADO SU ID (CON background=true DEVUELVE EL ID DEL JOB)
+#curl --request DELETE --url 'http://localhost:8080/drop_chat/<chatid>?background=true'
+@app.route('/drop_chat/<int:chatid>', methods=['DELETE'])
 def drop_chat(chatid):
     chat = Chat.query.filter_by(id=chatid).first()
 
-    #chat = Chat.query.get(chatid)
-
     if not chat:
         return jsonify({'error': 'Chat no encontrado'}), 404
-    
-    try:
-        db.session.delete(chat)
-        db.session.commit()
-        sql1 = 'DELETE FROM checkpoints WHERE thread_id = ?'
-        sql2 = 'DELETE FROM writes WHERE thread_id = ?'
-        cur = conn.cursor()
-        cur.execute(sql1, (chatid,))
-        cur.execute(sql2, (chatid,))
-        conn.commit()
 
+    if request.args.get('background', 'false').lower() == 'true':
+        job_id = start_deletion_job("drop_chat", [chatid])
+        return jsonify({'message': f'Borrando el chat con id {chatid}', 'job_id': job_id}), 202
+
+    try:
+        counts = delete_chats([chatid])
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': 'Error al eliminar el chat', 'details': str(e)}), 500
 
-    return jsonify({'message': f'Chat con id {chatid} eliminado correctamente'}), 200
+    return jsonify({'message': f'Chat con id {chatid} eliminado correctamente', 'deleted': counts}), 200
 
-#BORRAR TODOS LOS CHATS Y SUS MENSAJES
-#curl --request POST   --url http://localhost:8080/dropallchats
+#BORRAR TODOS LOS CHATS Y SUS MENSAJES (CON background=true DEVUELVE EL ID DEL JOB)
+#curl --request DELETE --url 'http://localhost:8080/dropallchats?background=true'
 @app.route('/dropallchats', methods=['DELETE'])
 def dropallchats():
-    try:
-        all_chats = Chat.query.all()
-
-        for chat in all_chats:
-            db.session.delete(chat)
+    if request.args.get('background', 'false').lower() == 'true':
+        job_id = start_deletion_job("dropallchats")
+        return jsonify({'message': 'Borrando todos los chats', 'job_id': job_id}), 202
 
-        db.session.commit()
-
-        db.session.delete(chat)
-        db.session.commit()
-        sql1 = 'DELETE FROM checkpoints'
-        sql2 = 'DELETE FROM writes'
-        cur = conn.cursor()
-        cur.execute(sql1)
-        cur.execute(sql2)
-        conn.commit()
-        
+    try:
+        counts = delete_chats()
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': 'Error al eliminar los chats', 'details': str(e)}), 500
 
-    return jsonify({'message': 'Todos los chats y mensajes asociados fueron eliminados correctamente'}), 200
+    return jsonify({'message': 'Todos los chats y mensajes asociados fueron eliminados correctamente', 'deleted': counts}), 200
 
-#DEVUELVE LISTADO DE LOS CHATS (SIN LOS MENSAJES)
-#curl --request GET --url http://localhost:8080/chats
+#DEVUELVE LISTADO DE LOS CHATS (SIN LOS MENSAJES), DEL MAS RECIENTE AL MAS ANTIGUO, PAGINADO
+#curl --request GET --url 'http://localhost:8080/chats?limit=20&before=<next_cursor>'
 @app.route('/chats', methods=['GET'])
 def get_chats():
-    chats = Chat.query.all()
-    result = chatschemas.dump(chats)
-
-    return result, 200
-
-#DEVUELVE MENSAJES ASOCIADOS AL CHAT CON TITLE
-#curl --request GET --url http://localhost:8080/chats/<chatid>/messages
-@app.route('/chats/<string:chatid>/messages', methods=['GET'])
+    limit = page_size(CHATS_PAGE_SIZE)
+    query = Chat.query
+    if request.args.get('before'):
+        try:
+            query = query.filter(db.tuple_(Chat.created_at, Chat.id) < decode_cursor(request.args['before']))
+        except ValueError:
+            return jsonify({"error": "Cursor no valido"}), 400
+    chats = query.order_by(Chat.created_at.desc(), Chat.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(chats[limit - 1]) if len(chats) > limit else None
+
+    return jsonify({"chats": chatschemas.dump(chats[:limit]), "next_cursor": next_cursor}), 200
+
+#DEVUELVE LOS MENSAJES MAS RECIENTES DEL CHAT (EN ORDEN CRONOLOGICO), PAGINADO HACIA ATRAS
+#curl --request GET --url 'http://localhost:8080/chats/<chatid>/messages?limit=50&before=<next_cursor>'
+@app.route('/chats/<int:chatid>/messages', methods=['GET'])
 def get_all_messages(chatid):
-    chat = Chat.query.filter_by(id=chatid).first()
+    chat = db.session.get(Chat, chatid)
     
     if not chat:
         return jsonify({"error": f"No se encontró un chat con id '{chatid}'"}), 404
 
-    messages = Message.query.filter_by(chat_id=chatid)
-    result = messageschemas.dump(messages)
+    limit = page_size(MESSAGES_PAGE_SIZE)
+    query = Message.query.filter_by(chat_id=chatid)
+    if request.args.get('before'):
+        try:
+            query = query.filter(db.tuple_(Message.created_at, Message.id) < decode_cursor(request.args['before']))
+        except ValueError:
+            return jsonify({"error": "Cursor no valido"}), 400
+    messages = query.order_by(Message.created_at.desc(), Message.id.desc()).limit(limit + 1).all()
+    next_cursor = encode_cursor(messages[limit - 1]) if len(messages) > limit else None
+    result = messageschemas.dump(reversed(messages[:limit]))
 
-    return jsonify({'messages': result}), 200
+    return jsonify({'messages': result, 'next_cursor': next_cursor}), 200
 
 
 
 # API routes
 
+def query_modes(mode):
+    # "auto" tries the backends in the order chosen by backend_router, the other modes only their own
+    if mode == "auto":
+        return backend_router.choose()
+    return [mode]
+
+def can_fall_back(modes, index, error):
+    # A user with too many queries waiting (429) is not retried on the other backend
+    return index < len(modes) - 1 and not (isinstance(error, AdmissionRejected) and error.status == 429)
+
 """
 curl --request POST \
   --url http://localhost:8080/query/<chatid> \
   --header 'Content-Type: application/json' \
-  --data '{ "query": ""}'
+  --data '{ "query": "", "mode": "auto"}'
+
+mode: local, cloud o auto (el backend con menor tiempo estimado, con el otro como respaldo si falla)
 """
-@app.route('/query/<string:chatid>', methods=['POST'])
+@app.route('/query/<int:chatid>', methods=['POST'])
 def route_query(chatid):
     data = request.get_json()
     mode = data.get('mode')
@@ -232,13 +468,25 @@ def route_query(chatid):
         return jsonify({"error": "Missing groq cloud key"}), 400
 
     chat = Chat.query.filter_by(id=chatid).first()
-    
+
     if not chat:
         return jsonify({"error": f"No se encontró un chat con id '{chatid}'"}), 404
-    
-    agent = Agent(fib, token_key)
-    response = agent.query(input=data.get('query'), thread_id=chatid, mode=mode)
-    
+
+    prefetch_user_data()
+    modes = query_modes(mode)
+    for index, mode in enumerate(modes):
+        message_ids = agent.thread_message_ids(mode, str(chatid)) if len(modes) > 1 else None
+        try:
+            with admission.admit(mode, user_key(session.get(token_key))):
+                response = agent.query(input=data.get('query'), thread_id=str(chatid), mode=mode, token=session.get(token_key))
+            break
+        except Exception as e:
+            if not can_fall_back(modes, index, e):
+                raise
+            if not isinstance(e, AdmissionRejected):
+                agent.discard_turn(mode, str(chatid), message_ids)
+            backend_router.record_fallback(mode, modes[index + 1], e)
+
     message = Message(chat_id=chatid, role="human", content=data.get('query'))
     db.session.add(message)
 
@@ -247,14 +495,140 @@ def route_query(chatid):
     db.session.commit()
 
     if response:
-        return jsonify({"message": response, "chatId":chatid}), 200
+        return jsonify({"message": response, "chatId":chatid, "mode": mode}), 200
     
     db.session.rollback()
     return jsonify({"error": "Something went wrong"}), 400
 
+"""
+curl --request POST \
+  --url http://localhost:8080/query/<chatid>/stream \
+  --header 'Content-Type: application/json' \
+  --data '{ "query": "", "mode": "auto"}'
+
+Server-Sent Events: tool_start, tool_end, token, fallback (auto cambia de backend antes del primer token), done (o error)
+"""
+@app.route('/query/<int:chatid>/stream', methods=['POST'])
+def route_query_stream(chatid):
+    data = request.get_json()
+    mode = data.get('mode')
+    query = data.get('query')
+
+    if mode == "cloud" and os.getenv("GROQ_API_KEY") == None:
+        return jsonify({"error": "Missing groq cloud key"}), 400
+
+    chat = Chat.query.filter_by(id=chatid).first()
+
+    if not chat:
+        return jsonify({"error": f"No se encontró un chat con id '{chatid}'"}), 404
+
+    token = session.get(token_key)
+    prefetch_user_data()
+    modes = query_modes(mode)
+    slot = {}
+
+    def acquire_slot(index):
+        # Slot of the first backend from modes[index] on with room in its queue
+        for index in range(index, len(modes)):
+            try:
+                slot["admitted_at"] = admission.acquire(modes[index], user_key(token))
+            except AdmissionRejected as e:
+                if not can_fall_back(modes, index, e):
+                    raise
+                backend_router.record_fallback(modes[index], modes[index + 1], e)
+                continue
+            slot["index"] = index
+            return modes[index]
+
+    def release_slot():
+        # Called when the stream ends and when the server closes the response (client gone before the first event)
+        if "admitted_at" in slot:
+            admission.release(modes[slot["index"]], slot.pop("admitted_at"))
+
+    # The slot is taken before the response starts, so a saturated model is a 429/503 and not an SSE error
+    acquire_slot(0)
+
+    def generate():
+        response = None
+        try:
+            while True:
+                mode = modes[slot["index"]]
+                message_ids = agent.thread_message_ids(mode, str(chatid)) if len(modes) > 1 else None
+                streamed = False
+                try:
+                    for event in agent.stream_query(input=query, thread_id=str(chatid), mode=mode, token=token):
+                        streamed = streamed or event['event'] == 'token'
+                        if event['event'] == 'done':
+                            response = event['message']
+                            event['chatId'] = chatid
+                            event['mode'] = mode
+                        yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+                    break
+                except Exception as e:
+                    # Once tokens were sent the answer can't be replaced by the other backend's
+                    release_slot()
+                    if streamed or not can_fall_back(modes, slot["index"], e):
+                        raise
+                    agent.discard_turn(mode, str(chatid), message_ids)
+                    backend_router.record_fallback(mode, modes[slot["index"] + 1], e)
+                    yield f"event: fallback\ndata: {json.dumps({'mode': acquire_slot(slot['index'] + 1)})}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+            return
+        finally:
+            release_slot()
+
+        if response:
+            db.session.add(Message(chat_id=chatid, role="human", content=query))
+            db.session.add(Message(chat_id=chatid, role="ai", content=response))
+            db.session.commit()
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(release_slot)
+    return response
+
+#ESTADISTICAS DE LOS AGENTES COMPILADOS (REUTILIZADOS / CONSTRUIDOS)
+#curl --request GET --url http://localhost:8080/agent_stats
+@app.route('/agent_stats', methods=['GET'])
+def agent_stats():
+    return jsonify(agent.get_stats()), 200
+
+#ESTADO DE LA BASE DE DATOS DE CHECKPOINTS (TAMAÑO, LATENCIA DE ESCRITURA, COMPACTACION)
+#curl --request GET --url http://localhost:8080/checkpoint_stats
+@app.route('/checkpoint_stats', methods=['GET'])
+def checkpoint_stats():
+    return jsonify(memory.get_stats()), 200
+
+#ESTADO DE LA COLA DE ADMISION POR MODO (EN CURSO, EN ESPERA, RECHAZADAS)
+#curl --request GET --url http://localhost:8080/admission_stats
+@app.route('/admission_stats', methods=['GET'])
+def admission_stats():
+    return jsonify(admission.get_stats()), 200
+
+#METRICAS EN FORMATO PROMETHEUS (LATENCIAS, TOKENS, COSTE, ERRORES Y ESTADO DE LAS CACHES)
+#curl --request GET --url http://localhost:8080/metrics
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+#EL PROCESO ESTA VIVO (LIVENESS)
+#curl --request GET --url http://localhost:8080/healthz
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({"status": "ok"}), 200
+
+#EL PROCESO HA TERMINADO EL CALENTAMIENTO (READINESS), CON EL TIEMPO DE CADA FASE DEL ARRANQUE
+#curl --request GET --url http://localhost:8080/readyz
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    return jsonify(get_startup_report()), 200 if ready.is_set() else 503
+
 
 # vector database CRUD
 
+#SUBE UN PDF Y LO ENCOLA PARA EMBEDDING, DEVUELVE EL ID DEL JOB
+#curl --request POST --url http://localhost:8080/embed_pdf --form file=@normativa.pdf
 @app.route('/embed_pdf', methods=['POST'])
 def route_embed_pdf():
     if 'file' in request.files:
@@ -263,10 +637,10 @@ def route_embed_pdf():
         if file.filename == '':
             return jsonify({"error": "No selected file"}), 400
 
-        embedded = embed(file)
-
-        if embedded:
-            return jsonify({"message": "File embedded successfully"}), 200
+        if allowed_file(file.filename):
+            file_path = save_file(file)
+            job_id = ingestion_queue.submit('pdf', file_path)
+            return jsonify({"message": "File queued for embedding", "job_id": job_id}), 202
 
     return jsonify({"error": "File embedded unsuccessfully"}), 400
 
@@ -274,24 +648,57 @@ def route_embed_pdf():
 def route_embed_url():
     
     data = request.get_json()
-    embedded = embed_url(data.get('url'))
-   
-    if embedded:
-        return jsonify({"message": "URL embedded successfully"}), 200
+    url = data.get('url')
+
+    if url:
+        job_id = ingestion_queue.submit('url', url)
+        return jsonify({"message": "URL queued for embedding", "job_id": job_id}), 202
 
     return jsonify({"error": "URL embedded unsuccessfully"}), 400
 
+#ESTADO Y PROGRESO DE LOS JOBS DE INGESTA
+#curl --request GET --url http://localhost:8080/jobs/<jobid>
+@app.route('/jobs', methods=['GET'])
+def get_jobs():
+    return jsonify({"jobs": ingestion_queue.list()}), 200
+
+@app.route('/jobs/<string:jobid>', methods=['GET'])
+def get_job(jobid):
+    job = ingestion_queue.get(jobid)
+
+    if not job:
+        # Deletion of chats started with background=true
+        deletion_job = DeletionJob.query.filter_by(id=jobid).first()
+        job = deletionjobschema.dump(deletion_job) if deletion_job else None
+
+    if not job:
+        return jsonify({"error": f"No se encontró un job con id '{jobid}'"}), 404
+
+    return jsonify({"job": job}), 200
+
+#CANCELA UN JOB DE INGESTA
+#curl --request POST --url http://localhost:8080/jobs/<jobid>/cancel
+@app.route('/jobs/<string:jobid>/cancel', methods=['POST'])
+def cancel_job(jobid):
+    job = ingestion_queue.cancel(jobid)
+
+    if not job:
+        return jsonify({"error": f"No se encontró un job con id '{jobid}'"}), 404
+
+    return jsonify({"job": job}), 200
+
+#LISTADO DE FUENTES, PAGINADO OPCIONALMENTE POR NOMBRE
+#curl --request GET --url 'http://localhost:8080/get_all_sources?limit=20&after=<source>'
 @app.route('/get_all_sources')
 def get_all_sources():
-    vector_store = get_vector_db()
-    docs = vector_store.get(include=["metadatas"])
-    metadata_list = docs['metadatas']
+    limit = request.args.get('limit', type=int)
+    after = request.args.get('after')
+    entries = get_source_catalog().list(after=after, limit=limit)
 
-    # Extract unique sources from metadata
-    unique_sources = set([metadata["source"] for metadata in metadata_list])
-    source_list = [item.replace(SOURCE_FOLDER + "/", "") if item.startswith(SOURCE_FOLDER + "/") else item for item in list(unique_sources)]
+    source_list = [entry["source"].replace(SOURCE_FOLDER + "/", "") if entry["source"].startswith(SOURCE_FOLDER + "/") else entry["source"] for entry in entries]
+    next_cursor = entries[-1]["source"] if limit and len(entries) == limit else None
     
-    return jsonify({"sources" : source_list})
+    return jsonify({"sources" : source_list, "details": entries, "next_cursor": next_cursor})
 
 @app.route('/delete_source', methods=['DELETE'])
 def delete_source():
@@ -301,12 +708,10 @@ def delete_source():
     # check if source is pdf
     if '.' in source and source.rsplit('.', 1)[1].lower() in {'pdf'}:
         source = SOURCE_FOLDER + "/" + source
-        os.remove(source)
+        if os.path.exists(source):
+            os.remove(source)
 
-    vector_store = get_vector_db()
-    docs = vector_store.get(where={'source': source})
-    doc_ids = docs['ids']
-    vector_store.delete(doc_ids)
+    doc_ids = remove_source(source)
     return jsonify({"document_deleted" : doc_ids})
 
 
@@ -320,7 +725,9 @@ def login_view():
 
 @app.route('/')
 def index():
+    prefetch_user_data()
     return render_template('index.html', title='FiberBot', message='Hello, Flask!')
 
+# Development server, in production the app is served by gunicorn (gunicorn.conf.py)
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=8080, debug=True)
+    app.run(host="0.0.0.0", port=int(os.getenv('PORT', 8080)), debug=app.config['DEBUG'])
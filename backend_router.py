@@ -0,0 +1,124 @@
+import os
+import time
+import threading
+from collections import deque
+from metrics import Counter, register_generation_observer
+from admission import admission
+
+# Backend selection for mode "auto". Each generation updates moving averages of the queue time,
+# prompt time, tokens/s and output tokens of its backend (see metrics.notify_generation), and the
+# admission controller gives the requests running and waiting for each backend in this worker.
+# A query goes to the backend with the lowest expected completion time, the other one is the
+# fallback when it fails, times out or its queue is full. Like the admission limits, the estimates
+# and the cloud budget are per worker process.
+AUTO_EWMA_ALPHA = float(os.getenv('AUTO_EWMA_ALPHA', 0.2))
+# Dollars the cloud backend can spend in the last hour, above it auto only uses the local one (0 = no limit)
+AUTO_CLOUD_MAX_COST_PER_HOUR = float(os.getenv('AUTO_CLOUD_MAX_COST_PER_HOUR', 0))
+# A backend that fails more often than this is only used as the fallback
+AUTO_MAX_ERROR_RATE = float(os.getenv('AUTO_MAX_ERROR_RATE', 0.5))
+# Seconds for the error rate of a backend to halve without new generations, so a failing backend is retried
+AUTO_ERROR_HALF_LIFE = float(os.getenv('AUTO_ERROR_HALF_LIFE', 60))
+
+# Estimates before the first generation of each backend
+PRIORS = {
+    "local": {"queue_seconds": 0.0, "prompt_seconds": 1.0, "output_tokens": 150.0,
+              "tokens_per_second": float(os.getenv('AUTO_LOCAL_TOKENS_PER_SECOND', 20))},
+    "cloud": {"queue_seconds": 0.0, "prompt_seconds": 0.2, "output_tokens": 150.0,
+              "tokens_per_second": float(os.getenv('AUTO_CLOUD_TOKENS_PER_SECOND', 250))},
+}
+
+auto_decisions = Counter("fiberbot_auto_decisions_total", "Backend chosen for the queries in auto mode", ("mode",))
+auto_fallbacks = Counter("fiberbot_auto_fallbacks_total", "Auto mode queries retried on the other backend", ("from_mode", "to_mode"))
+
+
+class BackendRouter:
+    def __init__(self, admission, alpha=AUTO_EWMA_ALPHA):
+        self.admission = admission
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.estimates = {mode: dict(prior) for mode, prior in PRIORS.items()}
+        # mode -> (error rate, time of the last update)
+        self.errors = {mode: (0.0, time.monotonic()) for mode in PRIORS}
+        # (time, cost) of the cloud generations of the last hour
+        self.spend = deque()
+        self.stats = {"chosen_local": 0, "chosen_cloud": 0, "fallbacks": 0, "over_budget": 0}
+        register_generation_observer(self.observe)
+
+    def decayed_error_rate(self, mode, now):
+        # callers hold self.lock
+        rate, updated = self.errors[mode]
+        return rate * 0.5 ** ((now - updated) / AUTO_ERROR_HALF_LIFE)
+
+    def observe(self, mode, sample):
+        if mode not in self.estimates:
+            return
+        now = time.monotonic()
+        with self.lock:
+            rate = self.decayed_error_rate(mode, now)
+            self.errors[mode] = ((1 - self.alpha) * rate + self.alpha * (sample is None), now)
+            if sample is None:
+                return
+            estimates = self.estimates[mode]
+            for name in ("queue_seconds", "prompt_seconds", "output_tokens", "tokens_per_second"):
+                # Chunks without timings report 0 tokens/s
+                if name != "tokens_per_second" or sample[name]:
+                    estimates[name] = (1 - self.alpha) * estimates[name] + self.alpha * sample[name]
+            if sample["cost"]:
+                self.spend.append((now, sample["cost"]))
+
+    def hourly_cost(self, now):
+        # callers hold self.lock
+        while self.spend and now - self.spend[0][0] > 3600:
+            self.spend.popleft()
+        return sum(cost for _, cost in self.spend)
+
+    def available(self):
+        return ["local", "cloud"] if os.getenv("GROQ_API_KEY") else ["local"]
+
+    def expected_seconds(self, mode, admission_stats, error_rate):
+        # Wait for a generation slot of this worker, then the generation itself
+        slots = admission_stats[mode]
+        ahead = max(0, slots["running"] + slots["waiting"] + 1 - slots["limit"])
+        wait = ahead / slots["limit"] * slots["avg_service_seconds"]
+        estimates = self.estimates[mode]
+        generation = estimates["queue_seconds"] + estimates["prompt_seconds"] + estimates["output_tokens"] / max(estimates["tokens_per_second"], 1)
+        # Failed attempts are retried on the other backend, an unreliable backend costs more
+        return (wait + generation) / max(1 - error_rate, 0.05)
+
+    def choose(self):
+        # Backends to try in order, the first one is the choice and the rest are fallbacks
+        admission_stats = self.admission.get_stats()
+        now = time.monotonic()
+        modes = self.available()
+        with self.lock:
+            if "cloud" in modes and AUTO_CLOUD_MAX_COST_PER_HOUR and self.hourly_cost(now) >= AUTO_CLOUD_MAX_COST_PER_HOUR:
+                modes.remove("cloud")
+                self.stats["over_budget"] += 1
+            error_rates = {mode: self.decayed_error_rate(mode, now) for mode in modes}
+            expected = {mode: self.expected_seconds(mode, admission_stats, error_rates[mode]) for mode in modes}
+            modes.sort(key=lambda mode: (error_rates[mode] > AUTO_MAX_ERROR_RATE, expected[mode]))
+            self.stats[f"chosen_{modes[0]}"] += 1
+        auto_decisions.inc(mode=modes[0])
+        print(f"\033[34mAuto mode: {modes[0]} (expected " + ", ".join(f"{mode} {expected[mode]:.1f} s" for mode in modes) + ")\033[0m")
+        return modes
+
+    def record_fallback(self, from_mode, to_mode, reason):
+        with self.lock:
+            self.stats["fallbacks"] += 1
+        auto_fallbacks.inc(from_mode=from_mode, to_mode=to_mode)
+        print(f"\033[33mAuto mode: {from_mode} failed ({reason}), retrying on {to_mode}\033[0m")
+
+    def get_stats(self):
+        admission_stats = self.admission.get_stats()
+        now = time.monotonic()
+        with self.lock:
+            backends = {}
+            for mode in self.estimates:
+                error_rate = self.decayed_error_rate(mode, now)
+                backends[mode] = {**self.estimates[mode], "error_rate": error_rate,
+                                  "expected_seconds": self.expected_seconds(mode, admission_stats, error_rate)}
+            return {**self.stats, "cloud_cost_last_hour": self.hourly_cost(now),
+                    "cloud_max_cost_per_hour": AUTO_CLOUD_MAX_COST_PER_HOUR, **backends}
+
+
+backend_router = BackendRouter(admission)
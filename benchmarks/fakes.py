@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, HumanMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+# Deterministic stand-ins for Ollama/Groq and the embedding model, with configurable latency
+BENCH_LLM_LATENCY_MS = float(os.getenv('BENCH_LLM_LATENCY_MS', 50))
+BENCH_LLM_TOKENS_PER_SECOND = float(os.getenv('BENCH_LLM_TOKENS_PER_SECOND', 400))
+BENCH_EMBED_LATENCY_MS = float(os.getenv('BENCH_EMBED_LATENCY_MS', 20))
+BENCH_EMBED_TEXT_LATENCY_MS = float(os.getenv('BENCH_EMBED_TEXT_LATENCY_MS', 2))
+BENCH_EMBED_DIMENSIONS = int(os.getenv('BENCH_EMBED_DIMENSIONS', 256))
+
+# First keyword found in the question decides the scripted tool call
+SCRIPT = [
+    (("horario", "clases"), "get_user_class_schedule", lambda question: {}),
+    (("asignaturas", "matriculado"), "get_subjects_list", lambda question: {}),
+    (("normativa", "practicas", "matricula"), "buscar_information_sobre_la_normativa_de_la_FIB", lambda question: {"query": question}),
+    (("pti", "idi", "xc"), "get_subject_info", lambda question: {"siglas": "PTI, IDI"}),
+]
+
+
+class FakeChatModel(BaseChatModel):
+    latency_ms: float = BENCH_LLM_LATENCY_MS
+    tokens_per_second: float = BENCH_LLM_TOKENS_PER_SECOND
+
+    @property
+    def _llm_type(self):
+        return "fake"
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+    def reply(self, messages):
+        last = messages[-1]
+        if isinstance(last, HumanMessage):
+            question = str(last.content).lower()
+            for keywords, tool, args in SCRIPT:
+                if any(keyword in question for keyword in keywords):
+                    return AIMessage(content="", tool_calls=[{"name": tool, "args": args(question), "id": str(uuid.uuid4())}])
+            return AIMessage(content="Hola, soy FIBerBot. ¿En qué te puedo ayudar?")
+        return AIMessage(content="Según la información disponible: " + str(last.content)[:400])
+
+    def simulate(self, messages, message):
+        # Prompt evaluation is proportional to the prompt size, generation to the output size
+        prompt_tokens = sum(len(str(m.content)) // 4 + 4 for m in messages)
+        output_tokens = max(len(str(message.content)) // 4, 10)
+        prompt_eval = self.latency_ms / 1000
+        eval = output_tokens / self.tokens_per_second
+        time.sleep(prompt_eval + eval)
+        message.response_metadata = {
+            "model": "fake", "model_name": "fake",
+            "load_duration": 0, "prompt_eval_count": prompt_tokens, "prompt_eval_duration": int(prompt_eval * 1e9),
+            "eval_count": output_tokens, "eval_duration": int(eval * 1e9), "total_duration": int((prompt_eval + eval) * 1e9),
+        }
+        message.usage_metadata = {"input_tokens": prompt_tokens, "output_tokens": output_tokens, "total_tokens": prompt_tokens + output_tokens}
+        return message
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return ChatResult(generations=[ChatGeneration(message=self.simulate(messages, self.reply(messages)))])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        message = self.reply(messages)
+        time.sleep(self.latency_ms / 1000)
+        if message.tool_calls:
+            yield ChatGenerationChunk(message=AIMessageChunk(content="", tool_call_chunks=[
+                {"name": call["name"], "args": json.dumps(call["args"]), "id": call["id"], "index": 0} for call in message.tool_calls
+            ]))
+            return
+        for word in message.content.split(" "):
+            time.sleep(1 / self.tokens_per_second)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word + " "))
+            if run_manager:
+                run_manager.on_llm_new_token(word + " ", chunk=chunk)
+            yield chunk
+
+
+class FakeEmbeddings(Embeddings):
+    # Hashed bag of words, so similar texts get similar vectors and the same text always the same vector
+    def __init__(self, dimensions=BENCH_EMBED_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def embed(self, text):
+        vector = [0.0] * self.dimensions
+        for word in text.lower().split():
+            vector[int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16) % self.dimensions] += 1
+        norm = sum(x * x for x in vector) ** 0.5 or 1
+        return [x / norm for x in vector]
+
+    def embed_documents(self, texts):
+        time.sleep((BENCH_EMBED_LATENCY_MS + BENCH_EMBED_TEXT_LATENCY_MS * len(texts)) / 1000)
+        return [self.embed(text) for text in texts]
+
+    def embed_query(self, text):
+        time.sleep((BENCH_EMBED_LATENCY_MS + BENCH_EMBED_TEXT_LATENCY_MS) / 1000)
+        return self.embed(text)
+
+
+WORDS = ("la normativa de la FIB establece que los estudiantes deben matricular las asignaturas obligatorias "
+         "antes del inicio del cuatrimestre las practicas externas requieren un convenio firmado con la empresa "
+         "y el trabajo final de grado se evalua ante un tribunal").split()
+
+
+def make_pdf(path, pages, seed=0, lines_per_page=40):
+    # Minimal single font PDF with synthetic normativa text, different for every seed
+    def page_lines(page):
+        return [" ".join(WORDS[(seed * 7 + page * 13 + line * 3 + i) % len(WORDS)] for i in range(12)) + f" articulo {seed}.{page}.{line}"
+                for line in range(lines_per_page)]
+
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [" + " ".join(f"{4 + 2 * page} 0 R" for page in range(pages)) + f"] /Count {pages} >>",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    for page in range(pages):
+        stream = "BT /F1 9 Tf 30 810 Td 11 TL " + " ".join(f"({line}) '" for line in page_lines(page)) + " ET"
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents {5 + 2 * page} 0 R /Resources << /Font << /F1 3 0 R >> >> >>")
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n".encode('latin-1')
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode()
+    out += f"trailer << /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF".encode()
+    with open(path, 'wb') as f:
+        f.write(out)
@@ -0,0 +1,72 @@
+import os
+import json
+import time
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-in of api.fib.upc.edu/v2 with synthetic subjects and schedules
+BENCH_FIB_LATENCY_MS = float(os.getenv('BENCH_FIB_LATENCY_MS', 30))
+BENCH_FIB_SUBJECTS = int(os.getenv('BENCH_FIB_SUBJECTS', 200))
+
+NAMED_SUBJECTS = ['PTI', 'IDI', 'XC', 'PROP', 'BD', 'SO', 'EC', 'IES']
+
+
+def subject_acronyms():
+    return NAMED_SUBJECTS + [f"S{i:03d}" for i in range(max(BENCH_FIB_SUBJECTS - len(NAMED_SUBJECTS), 0))]
+
+
+class FibApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def payload(self, path):
+        base = f"http://127.0.0.1:{self.server.server_port}/v2/"
+        if path == '/v2/':
+            return {
+                'public': {'assignatures': base + 'assignatures/'},
+                'privat': {'assignatures': base + 'jo/assignatures/', 'horari': base + 'jo/classes/'},
+            }
+        if path == '/v2/assignatures/':
+            return {'results': [
+                {'id': acronym, 'sigles': acronym, 'nom': f"Assignatura {acronym}", 'guia': base + f"assignatures/{acronym}/guia/"}
+                for acronym in subject_acronyms()
+            ]}
+        if path == '/v2/jo/assignatures/':
+            return {'results': [
+                {'id': acronym, 'sigles': acronym, 'nom': f"Assignatura {acronym}", 'guia': base + f"assignatures/{acronym}/guia/"}
+                for acronym in NAMED_SUBJECTS[:5]
+            ]}
+        if path == '/v2/jo/classes/':
+            return {'results': [
+                {'codi_assig': acronym, 'grup': '11', 'dia_setmana': i % 5 + 1, 'inici': f"{8 + 2 * (i % 5):02d}:00",
+                 'durada': 2, 'tipus': 'L' if i % 2 else 'T', 'aules': f"A5{i:03d}"}
+                for i, acronym in enumerate(NAMED_SUBJECTS[:5] * 2)
+            ]}
+        if path.startswith('/v2/assignatures/') and path.endswith('/guia/'):
+            acronym = path.split('/')[3]
+            return {
+                'descripcio': f"Descripción de {acronym}. " * 20,
+                'metodologia_docent': "Clases de teoría y laboratorio. " * 10,
+                'professors': [{'nom': f"Professor {i}"} for i in range(4)],
+                'departament': 'AC',
+                'metodologia_avaluacio': "Examen parcial, examen final y prácticas. " * 5,
+            }
+        return None
+
+    def do_GET(self):
+        time.sleep(BENCH_FIB_LATENCY_MS / 1000)
+        data = self.payload(self.path.split('?')[0])
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(200 if data is not None else 404)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_fib_stub(port=0):
+    server = ThreadingHTTPServer(('127.0.0.1', port), FibApiHandler)
+    threading.Thread(target=server.serve_forever, name="fib-api-stub", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/v2/"
@@ -0,0 +1,257 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Offline end to end benchmark: drives the real Flask routes with a fake LLM, fake embeddings and a
+# stub of the FIB API, so runs on different commits can be compared without Ollama, Groq or network.
+#   python benchmarks/run.py --concurrency 8 --requests 200
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+sys.path.insert(0, ROOT)
+
+from benchmarks.fakes import FakeChatModel, FakeEmbeddings, make_pdf
+from benchmarks.fib_stub import start_fib_stub
+
+SCENARIOS = ('query', 'messages', 'sources', 'embed_pdf')
+QUESTIONS = [
+    "hola",
+    "que clases tengo hoy",
+    "que asignaturas tengo este cuatrimestre",
+    "como funcionan las practicas externas segun la normativa",
+    "cuentame sobre la asignatura PTI e IDI",
+    "cuando es la matricula",
+]
+
+report = sys.__stdout__
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_revision():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+        dirty = bool(subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, text=True).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, dirty
+
+
+def setup_environment(workdir, args):
+    # Everything the app writes goes to the temporary directory
+    os.environ['CHROMA_PATH'] = os.path.join(workdir, 'chroma')
+    os.environ['SOURCE_FOLDER'] = os.path.join(workdir, 'document_source')
+    os.environ['CHECKPOINT_DB'] = os.path.join(workdir, 'checkpoints.sqlite')
+    os.environ['INGEST_DB'] = os.path.join(workdir, 'jobs.sqlite')
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'db.sqlite')
+    os.environ['ANSWER_CACHE_ENABLED'] = 'true' if args.answer_cache else 'false'
+    os.environ['WARMUP_MODELS'] = 'false'
+    os.environ['FIB_API_URL'] = start_fib_stub()
+
+
+def load_app():
+    import get_vector_db
+    get_vector_db.build_embeddings = lambda: FakeEmbeddings()
+    import agent
+    agent.build_llm = lambda mode, model: FakeChatModel()
+    import app
+    return app
+
+
+def new_client(server, user):
+    # One simulated student per client, admission control queues them fairly
+    client = server.app.test_client()
+    client.set_cookie('localhost', 'authenticated', 'True')
+    with client.session_transaction() as session:
+        session[server.token_key] = (f'bench-token-{user}', '')
+    return client
+
+
+def embed_pdf(client, path, timeout=600):
+    with open(path, 'rb') as f:
+        response = client.post('/embed_pdf', data={'file': (f, os.path.basename(path))}, content_type='multipart/form-data')
+    if response.status_code != 202:
+        return False
+    job_id = response.json['job_id']
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f'/jobs/{job_id}').json['job']
+        if job['status'] in ('done', 'failed', 'cancelled'):
+            return job['status'] == 'done'
+        time.sleep(0.05)
+    return False
+
+
+class Benchmark:
+    def __init__(self, server, args, workdir):
+        self.server = server
+        self.args = args
+        self.workdir = workdir
+        self.clients = [new_client(server, user) for user in range(args.concurrency)]
+        self.chats = []
+        self.pdf_counter = 0
+        self.pdf_lock = threading.Lock()
+
+    def make_pdf(self):
+        with self.pdf_lock:
+            self.pdf_counter += 1
+            seed = self.pdf_counter
+        path = os.path.join(self.workdir, f"normativa-{seed}.pdf")
+        make_pdf(path, self.args.pdf_pages, seed=seed)
+        return path
+
+    def seed(self):
+        for _ in range(self.args.seed_pdfs):
+            if not embed_pdf(self.clients[0], self.make_pdf()):
+                raise RuntimeError("Could not ingest the seed documents")
+        for client in self.clients:
+            response = client.post('/new_chat', json={'title': 'benchmark'})
+            self.chats.append(response.json['chat']['id'])
+
+    def request(self, scenario, worker, i):
+        client = self.clients[worker]
+        if scenario == 'query':
+            response = client.post(f'/query/{self.chats[worker]}', json={'query': QUESTIONS[i % len(QUESTIONS)], 'mode': self.args.mode})
+        elif scenario == 'messages':
+            response = client.get(f'/chats/{self.chats[worker]}/messages')
+        elif scenario == 'sources':
+            response = client.get('/get_all_sources')
+        elif scenario == 'embed_pdf':
+            return embed_pdf(client, self.make_pdf())
+        return response.status_code < 400
+
+    def run(self, scenario, total):
+        latencies = []
+        errors = 0
+        lock = threading.Lock()
+
+        def worker(w):
+            nonlocal errors
+            for i in range(w, total, self.args.concurrency):
+                start_time = time.monotonic()
+                try:
+                    ok = self.request(scenario, w, i)
+                except Exception as e:
+                    print(f"{scenario} request failed: {e}", file=sys.stderr)
+                    ok = False
+                elapsed = time.monotonic() - start_time
+                with lock:
+                    latencies.append(elapsed)
+                    errors += not ok
+
+        start_time = time.monotonic()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            list(executor.map(worker, range(self.args.concurrency)))
+        wall_time = time.monotonic() - start_time
+        latencies.sort()
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            "mean_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0,
+            "requests_per_second": len(latencies) / wall_time if wall_time else 0,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+
+def print_results(results, baseline=None):
+    print(f"\nCommit {results['commit'][:12]}{' (dirty)' if results['dirty'] else ''}, concurrency {results['config']['concurrency']}", file=report)
+    print(f"{'scenario':<10} {'requests':>8} {'errors':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'rss MB':>8}", file=report)
+    for name, stats in results['scenarios'].items():
+        print(f"{name:<10} {stats['requests']:>8} {stats['errors']:>6} {stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} "
+              f"{stats['p99_ms']:>9.1f} {stats['requests_per_second']:>8.2f} {stats['peak_rss_mb']:>8.1f}", file=report)
+        before = (baseline or {}).get('scenarios', {}).get(name)
+        if before:
+            change = lambda key: (stats[key] - before[key]) / before[key] * 100 if before[key] else 0
+            print(f"{'  vs base':<10} {'':>8} {'':>6} {change('p50_ms'):>+8.1f}% {change('p95_ms'):>+8.1f}% "
+                  f"{change('p99_ms'):>+8.1f}% {change('requests_per_second'):>+7.1f}% {change('peak_rss_mb'):>+7.1f}%", file=report)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline end to end benchmark of FIBerBot")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=40, help="requests per scenario")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--mode', default='local', choices=['local', 'cloud'])
+    parser.add_argument('--pdf-pages', type=int, default=20)
+    parser.add_argument('--seed-pdfs', type=int, default=3, help="documents ingested before the run")
+    parser.add_argument('--embed-requests', type=int, default=None, help="requests of the embed_pdf scenario (default --requests / 4)")
+    parser.add_argument('--answer-cache', action='store_true', help="keep the semantic answer cache enabled")
+    parser.add_argument('--output', default=None, help="results file (default benchmarks/results/<commit>-c<concurrency>.json)")
+    parser.add_argument('--compare', default=None, help="results file of a previous run to compare with")
+    parser.add_argument('--log', default=os.devnull, help="file for the application logs")
+    args = parser.parse_args()
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}, choose from {', '.join(SCENARIOS)}")
+
+    workdir = tempfile.mkdtemp(prefix='fiberbot-bench-')
+    log = open(args.log, 'a')
+    sys.stderr = log
+    try:
+        setup_environment(workdir, args)
+        os.environ.setdefault('GROQ_API_KEY', 'benchmark')
+        start_time = time.monotonic()
+        server = load_app()
+        server.ready.wait()
+        startup_time = time.monotonic() - start_time
+        benchmark = Benchmark(server, args, workdir)
+        benchmark.seed()
+        print(f"Started in {startup_time:.2f} s, seeded {args.seed_pdfs} documents of {args.pdf_pages} pages", file=report)
+
+        results = {"scenarios": {}}
+        for name in scenarios:
+            total = args.requests if name != 'embed_pdf' else (args.embed_requests or max(args.requests // 4, 1))
+            print(f"Running {name} ({total} requests)...", file=report)
+            results["scenarios"][name] = benchmark.run(name, total)
+    finally:
+        sys.stderr = sys.__stderr__
+        log.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    commit, dirty = git_revision()
+    results = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": time.time(),
+        "startup_seconds": startup_time,
+        "config": {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'log')},
+        **results,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    output = args.output or os.path.join(RESULTS_DIR, f"{commit[:12]}{'-dirty' if dirty else ''}-c{args.concurrency}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    print(f"\nSaved to {output}", file=report)
+    # Ingestion and compaction threads are daemons, no need to wait for them
+    report.flush()
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import subprocess
+import numpy as np
+
+# Latency, memory and recall of the vector store backends on synthetic embeddings, each backend in
+# its own process so the peak RSS is its own. Recall is measured against exact cosine search.
+#   python benchmarks/vector_store.py --chunks 20000 --dim 768
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BACKENDS = ('chroma', 'mmap-float32', 'mmap-int8')
+
+
+class LookupEmbeddings:
+    # The store embeds the texts it is given, the vectors are precomputed
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_documents(self, texts):
+        return [self.vectors[int(text.split()[1])].tolist() for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def make_data(chunks, dim, queries, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((chunks, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    # Queries close to stored chunks, like questions about a passage
+    targets = rng.integers(0, chunks, queries)
+    noisy = vectors[targets] + 0.5 * rng.standard_normal((queries, dim)).astype(np.float32) / np.sqrt(dim)
+    noisy /= np.linalg.norm(noisy, axis=1, keepdims=True)
+    return vectors, noisy
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_backend(backend, args):
+    vectors, queries = make_data(args.chunks, args.dim, args.queries)
+    embeddings = LookupEmbeddings(vectors)
+    workdir = tempfile.mkdtemp(prefix='fiberbot-vectors-')
+    if backend == 'chroma':
+        from langchain_chroma import Chroma
+        store = Chroma(collection_name='bench', persist_directory=workdir, embedding_function=embeddings)
+    else:
+        from mmap_store import MmapVectorStore
+        store = MmapVectorStore('bench', workdir, embeddings, dtype=backend.split('-')[1])
+    start_rss = peak_rss_mb()
+
+    start_time = time.monotonic()
+    for start in range(0, args.chunks, 1000):
+        ids = [str(i) for i in range(start, min(start + 1000, args.chunks))]
+        store.add_texts([f"chunk {i}" for i in ids], [{"source": f"doc{int(i) % 50}"} for i in ids], ids=ids)
+    build_seconds = time.monotonic() - start_time
+    build_rss = peak_rss_mb()
+
+    exact = np.argsort(-(queries @ vectors.T), axis=1)[:, :args.k]
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, exact):
+        start_time = time.monotonic()
+        docs = store.similarity_search_by_vector(query.tolist(), k=args.k)
+        latencies.append(time.monotonic() - start_time)
+        hits += len({int(doc.page_content.split()[1]) for doc in docs} & set(expected.tolist()))
+    latencies.sort()
+    return {
+        "backend": backend,
+        "build_seconds": build_seconds,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p95_ms": latencies[int(len(latencies) * 0.95)] * 1000,
+        "recall": hits / (len(queries) * args.k),
+        "build_rss_mb": build_rss - start_rss,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the vector store backends")
+    parser.add_argument('--chunks', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=768)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--backends', default=','.join(BACKENDS))
+    parser.add_argument('--backend', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--output', default=None, help="json file for the results")
+    args = parser.parse_args()
+
+    if args.backend:
+        print(json.dumps(run_backend(args.backend, args)))
+        return
+
+    results = []
+    for backend in args.backends.split(','):
+        command = [sys.executable, __file__, '--backend', backend, '--chunks', str(args.chunks), '--dim', str(args.dim),
+                   '--queries', str(args.queries), '-k', str(args.k)]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{args.chunks} chunks of dimension {args.dim}, top {args.k} of {args.queries} queries")
+    print(f"{'backend':<14} {'build s':>8} {'p50 ms':>8} {'p95 ms':>8} {'recall':>7} {'build MB':>9} {'rss MB':>8}")
+    for r in results:
+        print(f"{r['backend']:<14} {r['build_seconds']:>8.1f} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['recall']:>7.3f} "
+              f"{r['build_rss_mb']:>9.1f} {r['peak_rss_mb']:>8.1f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({"config": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
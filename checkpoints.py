@@ -0,0 +1,239 @@
+import os
+import time
+import queue
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+# Checkpoint store of the agent threads.
+# SqliteSaver serializes every read and write on a single connection, this version hands out
+# connections from a pool (WAL mode, so readers don't block each other) and only serializes writes.
+# A background job keeps the latest CHECKPOINT_KEEP checkpoints of each thread and vacuums incrementally.
+CHECKPOINT_DB = os.getenv('CHECKPOINT_DB', 'checkpoints.sqlite')
+CHECKPOINT_POOL_SIZE = int(os.getenv('CHECKPOINT_POOL_SIZE', 8))
+# Seconds to wait for a free connection when all of them are in use
+CHECKPOINT_POOL_TIMEOUT = float(os.getenv('CHECKPOINT_POOL_TIMEOUT', 30))
+CHECKPOINT_KEEP = int(os.getenv('CHECKPOINT_KEEP', 3))
+CHECKPOINT_COMPACT_INTERVAL = int(os.getenv('CHECKPOINT_COMPACT_INTERVAL', 600))
+# Rows deleted per statement and pages released per run, so compaction never holds the write lock for long
+CHECKPOINT_COMPACT_BATCH = int(os.getenv('CHECKPOINT_COMPACT_BATCH', 2000))
+CHECKPOINT_VACUUM_PAGES = int(os.getenv('CHECKPOINT_VACUUM_PAGES', 2000))
+
+
+def open_connection(path):
+    conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=30000")
+    return conn
+
+
+class ConnectionPool:
+    def __init__(self, path, size=CHECKPOINT_POOL_SIZE, timeout=CHECKPOINT_POOL_TIMEOUT):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                conn = open_connection(self.path)
+            else:
+                try:
+                    conn = self.idle.get(timeout=self.timeout)
+                except queue.Empty:
+                    raise TimeoutError(f"No checkpoint connection free after {self.timeout} s, all {self.size} are in use "
+                                       f"(CHECKPOINT_POOL_SIZE)") from None
+        try:
+            yield conn
+        finally:
+            self.idle.put(conn)
+
+
+class PooledSqliteSaver(SqliteSaver):
+    def __init__(self, path=CHECKPOINT_DB, pool_size=CHECKPOINT_POOL_SIZE):
+        self.local = threading.local()
+        super().__init__(open_connection(path))
+        self.path = path
+        self.pool = ConnectionPool(path, pool_size)
+        # Reentrant: a nested cursor of the same thread shares its connection and transaction
+        self.write_lock = threading.RLock()
+        self.setup_lock = threading.Lock()
+        self.write_latencies = deque(maxlen=1000)
+        self.compaction_stats = {"runs": 0, "checkpoints_deleted": 0, "writes_deleted": 0, "last_run": None}
+        self.compaction_started = False
+
+    # SqliteSaver uses self.conn directly in some methods (list), it has to be the pooled
+    # connection of the current cursor so it is never shared between threads
+    @property
+    def conn(self):
+        stack = getattr(self.local, 'connections', None)
+        return stack[-1] if stack else self.base_conn
+
+    @conn.setter
+    def conn(self, value):
+        self.base_conn = value
+
+    def setup(self):
+        if self.is_setup:
+            return
+        with self.setup_lock:
+            if self.is_setup:
+                return
+            super().setup()
+            self.base_conn.executescript("""
+                CREATE INDEX IF NOT EXISTS checkpoints_thread_id ON checkpoints(thread_id);
+                CREATE INDEX IF NOT EXISTS writes_thread_id ON writes(thread_id);
+            """)
+
+    @contextmanager
+    def cursor(self, transaction=True):
+        self.setup()
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = []
+        # A nested cursor (e.g. get_tuple inside list) reuses the connection the thread already holds,
+        # taking a second one from the pool could wait on itself
+        held = self.local.connections[-1] if self.local.connections else None
+        with nullcontext(held) if held else self.pool.connection() as conn:
+            self.local.connections.append(conn)
+            try:
+                if transaction:
+                    # sqlite has a single writer, waiting here is cheaper than retrying on SQLITE_BUSY
+                    with self.write_lock:
+                        start_time = time.monotonic()
+                        cur = conn.cursor()
+                        try:
+                            yield cur
+                        finally:
+                            conn.commit()
+                            cur.close()
+                            self.write_latencies.append(time.monotonic() - start_time)
+                else:
+                    cur = conn.cursor()
+                    try:
+                        yield cur
+                    finally:
+                        cur.close()
+            finally:
+                self.local.connections.pop()
+
+    def delete_batches(self, table, where="", params=()):
+        # Deletes in statements of CHECKPOINT_COMPACT_BATCH rows, the write lock is released between them
+        deleted_total = 0
+        while True:
+            with self.cursor() as cur:
+                cur.execute(f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table}{where} LIMIT ?)", (*params, CHECKPOINT_COMPACT_BATCH))
+                deleted = cur.rowcount
+            deleted_total += deleted
+            if deleted < CHECKPOINT_COMPACT_BATCH:
+                return deleted_total
+
+    def delete_threads(self, thread_ids):
+        # Returns the rows deleted per table
+        thread_ids = [str(thread_id) for thread_id in thread_ids]
+        counts = {"checkpoints": 0, "writes": 0}
+        for i in range(0, len(thread_ids), 500):
+            batch = thread_ids[i:i + 500]
+            for table in counts:
+                counts[table] += self.delete_batches(table, f" WHERE thread_id IN ({', '.join('?' * len(batch))})", batch)
+        return counts
+
+    def delete_thread(self, thread_id):
+        return self.delete_threads([thread_id])
+
+    def delete_all(self):
+        return {table: self.delete_batches(table) for table in ("checkpoints", "writes")}
+
+    def compact(self, keep=CHECKPOINT_KEEP):
+        # Deletes every checkpoint of a thread but the latest `keep` ones, then the writes that belonged to them
+        checkpoints_deleted = writes_deleted = 0
+        while True:
+            with self.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM checkpoints WHERE rowid IN (
+                        SELECT rowid FROM (
+                            SELECT rowid, ROW_NUMBER() OVER (PARTITION BY thread_id, checkpoint_ns ORDER BY checkpoint_id DESC) AS position
+                            FROM checkpoints
+                        ) WHERE position > ? LIMIT ?
+                    )
+                """, (keep, CHECKPOINT_COMPACT_BATCH))
+                deleted = cur.rowcount
+            checkpoints_deleted += deleted
+            if deleted < CHECKPOINT_COMPACT_BATCH:
+                break
+        while True:
+            with self.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM writes WHERE rowid IN (
+                        SELECT rowid FROM writes WHERE NOT EXISTS (
+                            SELECT 1 FROM checkpoints
+                            WHERE checkpoints.thread_id = writes.thread_id
+                            AND checkpoints.checkpoint_ns = writes.checkpoint_ns
+                            AND checkpoints.checkpoint_id = writes.checkpoint_id
+                        ) LIMIT ?
+                    )
+                """, (CHECKPOINT_COMPACT_BATCH,))
+                deleted = cur.rowcount
+            writes_deleted += deleted
+            if deleted < CHECKPOINT_COMPACT_BATCH:
+                break
+        with self.cursor() as cur:
+            cur.execute(f"PRAGMA incremental_vacuum({CHECKPOINT_VACUUM_PAGES})")
+            cur.fetchall()
+
+        self.compaction_stats["runs"] += 1
+        self.compaction_stats["checkpoints_deleted"] += checkpoints_deleted
+        self.compaction_stats["writes_deleted"] += writes_deleted
+        self.compaction_stats["last_run"] = time.time()
+        print(f"\033[34mCheckpoint compaction: {checkpoints_deleted} checkpoints and {writes_deleted} writes deleted\033[0m")
+
+    def enable_incremental_vacuum(self):
+        # auto_vacuum can only be changed on an existing database by rebuilding it once with VACUUM
+        self.setup()
+        with self.write_lock:
+            if self.base_conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                self.base_conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                self.base_conn.execute("VACUUM")
+
+    def start_compaction(self, interval=CHECKPOINT_COMPACT_INTERVAL):
+        if self.compaction_started or interval <= 0:
+            return
+        self.compaction_started = True
+
+        def run():
+            self.enable_incremental_vacuum()
+            while True:
+                try:
+                    self.compact()
+                except sqlite3.Error as e:
+                    print(f"\033[31mCheckpoint compaction failed: {e}\033[0m")
+                time.sleep(interval)
+
+        threading.Thread(target=run, name="checkpoint-compaction", daemon=True).start()
+
+    def get_stats(self):
+        latencies = sorted(self.write_latencies)
+        size = sum(os.path.getsize(self.path + suffix) for suffix in ('', '-wal') if os.path.exists(self.path + suffix))
+        return {
+            "db_size_bytes": size,
+            "pool_size": self.pool.size,
+            "pool_connections": self.pool.created,
+            "writes": len(latencies),
+            "write_latency_avg_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0,
+            "write_latency_p95_ms": latencies[int(len(latencies) * 0.95)] * 1000 if latencies else 0,
+            "write_latency_max_ms": latencies[-1] * 1000 if latencies else 0,
+            "keep_per_thread": CHECKPOINT_KEEP,
+            **self.compaction_stats,
+        }
@@ -1,5 +1,7 @@
+import os
+
 # Set this to False if going to production
-DEBUG = True
+DEBUG = os.getenv('DEBUG', 'True').lower() == 'true'
 
 # Set this to random value when going to production
 SECRET_KEY = 'development'
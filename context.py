@@ -0,0 +1,138 @@
+import os
+import json
+import threading
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage, RemoveMessage
+
+# Context management of long threads.
+# Before a turn, threads with too many turns get their older turns folded into a rolling summary
+# stored in the state. Before every LLM call, tool outputs of previous turns are truncated and the
+# oldest turns are dropped until the whole prompt (system prompt, summary, history and current turn)
+# fits the token budget of the model. If the current turn alone does not fit, its tool outputs are cut.
+CONTEXT_KEEP_TURNS = int(os.getenv('CONTEXT_KEEP_TURNS', 4))
+# Older turns are summarized once there are this many of them, so the summary is not redone every turn
+CONTEXT_SUMMARY_BATCH = int(os.getenv('CONTEXT_SUMMARY_BATCH', 4))
+TOOL_OUTPUT_MAX_CHARS = int(os.getenv('TOOL_OUTPUT_MAX_CHARS', 1500))
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 6000))
+# Per model overrides, e.g. '{"llama3.1:8b": 6000, "llama3-70b-8192": 7000}'
+CONTEXT_TOKEN_BUDGETS = json.loads(os.getenv('CONTEXT_TOKEN_BUDGETS', '{}'))
+
+SUMMARY_PROMPT = """Summarize the following conversation between a student and FIBerBot, the FIB virtual assistant.
+Keep the facts the student may ask about later: subjects, dates, schedules, rules and decisions.
+If there is a previous summary, merge it with the new messages. Write the summary in the language of the conversation.
+
+Previous summary:
+{summary}
+
+Conversation:
+{conversation}"""
+
+context_stats = {"llm_calls": 0, "tokens_in": 0, "tokens_saved": 0, "summaries": 0, "summary_errors": 0}
+context_stats_lock = threading.Lock()
+
+
+def token_budget(model):
+    return CONTEXT_TOKEN_BUDGETS.get(model, CONTEXT_TOKEN_BUDGET)
+
+
+def count_tokens(messages):
+    # Approximation (~4 characters per token), good enough for budgeting and does not need a tokenizer
+    return sum(len(str(message.content)) // 4 + 4 for message in messages)
+
+
+def split_turns(messages):
+    turns = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def truncate_tool_output(message, max_chars=TOOL_OUTPUT_MAX_CHARS):
+    content = str(message.content)
+    if len(content) <= max_chars:
+        return message
+    return message.model_copy(update={"content": content[:max_chars] + f"... [truncated {len(content) - max_chars} characters]"})
+
+
+def trim_current_turn(current, budget):
+    # Tool outputs of the current turn are cut, the largest first, until the turn fits the budget
+    current = list(current)
+    tools = sorted((i for i, m in enumerate(current) if isinstance(m, ToolMessage)), key=lambda i: -len(str(current[i].content)))
+    for i in tools:
+        excess = count_tokens(current) - budget
+        if excess <= 0:
+            break
+        # 4 characters per token, and room for the truncation marker
+        current[i] = truncate_tool_output(current[i], max(0, len(str(current[i].content)) - excess * 4 - 60))
+    return current
+
+
+def fit_messages(messages, budget):
+    # Previous turns: stale tool outputs are truncated and the oldest turns dropped. The current turn is
+    # kept verbatim unless it does not fit by itself.
+    turns = split_turns(messages)
+    previous = [[truncate_tool_output(m) if isinstance(m, ToolMessage) else m for m in turn] for turn in turns[:-1]]
+    current = turns[-1] if turns else []
+    while previous and count_tokens([m for turn in previous for m in turn] + current) > budget:
+        previous.pop(0)
+    if not previous:
+        current = trim_current_turn(current, budget)
+    return [m for turn in previous for m in turn] + current
+
+
+def make_state_modifier(prompt, model):
+    budget = token_budget(model)
+
+    def state_modifier(state):
+        messages = state["messages"]
+        summary = [SystemMessage(content=f"Summary of the earlier conversation: {state['summary']}")] if state.get("summary") else []
+        # System prompt and summary count against the budget too
+        overhead = count_tokens(prompt.invoke({**state, "messages": []}).to_messages() + summary)
+        fitted = fit_messages(messages, budget - overhead)
+        prompt_messages = prompt.invoke({**state, "messages": fitted}).to_messages()
+        prompt_messages[1:1] = summary
+        before = count_tokens(messages) + overhead
+        after = count_tokens(fitted) + overhead
+        with context_stats_lock:
+            context_stats["llm_calls"] += 1
+            context_stats["tokens_in"] += after
+            context_stats["tokens_saved"] += before - after
+        if after > budget:
+            print(f"\033[31mContext: ~{after} tokens, over the budget of {budget} without tool outputs to cut\033[0m")
+        print(f"\033[34mContext: ~{after} tokens of prompt (budget {budget}), ~{before - after} tokens saved\033[0m")
+        return prompt_messages
+
+    return state_modifier
+
+
+def compact_thread(agent_executor, llm, config):
+    # Folds the turns older than CONTEXT_KEEP_TURNS into the rolling summary of the thread
+    state = agent_executor.get_state(config).values
+    turns = split_turns(state.get("messages", []))
+    if len(turns) < CONTEXT_KEEP_TURNS + CONTEXT_SUMMARY_BATCH:
+        return False
+
+    old = [m for turn in turns[:-CONTEXT_KEEP_TURNS] for m in turn]
+    conversation = "\n".join(
+        f"{'student' if isinstance(m, HumanMessage) else 'FIBerBot'}: {m.content}"
+        for m in old if isinstance(m, (HumanMessage, AIMessage)) and m.content
+    )
+    try:
+        summary = llm.invoke(SUMMARY_PROMPT.format(summary=state.get("summary") or "-", conversation=conversation)).content
+    except Exception as e:
+        print(f"\033[31mCould not summarize the thread: {e}\033[0m")
+        with context_stats_lock:
+            context_stats["summary_errors"] += 1
+        return False
+
+    agent_executor.update_state(config, {"summary": summary, "messages": [RemoveMessage(id=m.id) for m in old]}, as_node="agent")
+    with context_stats_lock:
+        context_stats["summaries"] += 1
+    print(f"\033[34mSummarized {len(old)} messages (~{count_tokens(old)} tokens) into ~{len(summary) // 4} tokens\033[0m")
+    return True
+
+
+def get_context_stats():
+    with context_stats_lock:
+        return dict(context_stats)
@@ -1,10 +1,34 @@
 import os
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_community.document_loaders import WebBaseLoader
+import time
+import hashlib
+import threading
+import multiprocessing
+from collections import deque
+import psutil
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from get_vector_db import get_vector_db
+from get_vector_db import get_vector_db, get_active_collection, bump_collection_version
+from lexical_index import get_lexical_index
+from source_catalog import get_source_catalog
+from metrics import Histogram
 
 SOURCE_FOLDER = os.getenv('SOURCE_FOLDER', './document_source')
+# Chunks sent to the embedding model per add_documents call
+EMBED_BATCH_SIZE = int(os.getenv('EMBED_BATCH_SIZE', 32))
+# Embedding batches that ingestion may have in flight at once, keeps Ollama free for interactive queries
+INGEST_EMBED_CONCURRENCY = int(os.getenv('INGEST_EMBED_CONCURRENCY', 2))
+embedding_slots = threading.BoundedSemaphore(INGEST_EMBED_CONCURRENCY)
+# PDFs with at least this many pages are parsed by a process pool, INGEST_PARSE_RANGE pages per task
+INGEST_PARSE_MIN_PAGES = int(os.getenv('INGEST_PARSE_MIN_PAGES', 64))
+INGEST_PARSE_RANGE = int(os.getenv('INGEST_PARSE_RANGE', 16))
+INGEST_PARSE_WORKERS = int(os.getenv('INGEST_PARSE_WORKERS', min(4, os.cpu_count() or 1)))
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+ingest_duration = Histogram("fiberbot_ingest_duration_seconds", "Time to ingest a document", buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+ingest_first_chunk = Histogram("fiberbot_ingest_first_chunk_seconds", "Time from the start of an ingestion to its first embedded chunk")
 
 # Function to check if the uploaded file is allowed (only PDF files)
 def allowed_file(filename):
@@ -16,32 +40,259 @@ def save_file(file):
     file.save(file_path)
     return file_path
 
-def load_and_split_data(file_path):
-    loader = PyPDFLoader(file_path=file_path)
-    data = loader.load()
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    chunks = text_splitter.split_documents(data)
-    return chunks
+def pdf_page(file_path, page_number, page):
+    # Same text and metadata as PyPDFLoader, so the chunk ids of documents ingested with it don't change
+    return Document(page_content=page.extract_text(extraction_mode="plain"), metadata={"source": file_path, "page": page_number})
 
 
-def embed_url(url):
+def parse_pages(file_path, start, stop):
+    # Runs in the parse pool, a fresh reader per range so the parsed objects are freed with it
+    from pypdf import PdfReader
+    with open(file_path, 'rb') as f:
+        reader = PdfReader(f)
+        return [pdf_page(file_path, i, reader.pages[i]) for i in range(start, stop)]
+
+
+def get_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            # forkserver: forking the worker itself would copy the locks held by its other threads (sqlite,
+            # logging, HTTP sessions) into the children. The server preloads this module so the children
+            # start without importing it again.
+            context = multiprocessing.get_context('forkserver')
+            context.set_forkserver_preload(['embed'])
+            _parse_pool = ProcessPoolExecutor(max_workers=INGEST_PARSE_WORKERS, mp_context=context)
+        return _parse_pool
+
+
+def iter_pdf_pages(file_path):
+    # Pages are parsed lazily, from the file on disk instead of a copy of it in memory.
+    # Big files are parsed in page ranges by the process pool, with a bounded number of ranges in flight.
+    from pypdf import PdfReader
+    with open(file_path, 'rb') as f:
+        reader = PdfReader(f)
+        total = len(reader.pages)
+        if total < INGEST_PARSE_MIN_PAGES or INGEST_PARSE_WORKERS < 2:
+            for i in range(total):
+                yield pdf_page(file_path, i, reader.pages[i])
+            return
+
+    global _parse_pool
+    pool = get_parse_pool()
+    ranges = [(start, min(start + INGEST_PARSE_RANGE, total)) for start in range(0, total, INGEST_PARSE_RANGE)]
+    pending = deque()
+    try:
+        for start, stop in ranges:
+            pending.append(pool.submit(parse_pages, file_path, start, stop))
+            if len(pending) >= INGEST_PARSE_WORKERS * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    except BrokenProcessPool:
+        # A worker died (e.g. out of memory), the next file gets a new pool
+        with _parse_pool_lock:
+            if _parse_pool is pool:
+                _parse_pool = None
+        raise
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class PdfChunks:
+    # Chunks of a PDF, produced page by page. pages counts the pages parsed so far.
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.pages = 0
+
+    def __iter__(self):
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+        for page in iter_pdf_pages(self.file_path):
+            self.pages += 1
+            yield from text_splitter.split_documents([page])
+
+
+def chunk_id(chunk):
+    # Content-addressed id: re-ingesting an unchanged chunk of the same source gives the same id
+    key = chunk.metadata.get('source', '') + '\0' + chunk.page_content
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def rss_mb():
+    # Current RSS, ru_maxrss is the peak of the whole process and doesn't go down after a bigger file
+    return psutil.Process().memory_info().rss / 2**20
+
+
+def add_chunks(chunks, progress=None, pages_parsed=0, collection=None):
+    # Incremental, streaming ingestion: chunks are consumed as they are produced, the ones already
+    # in the collection are kept without calling the embedding model and new ones are embedded in
+    # batches with several requests in flight. Only ids are kept for the whole document, so memory
+    # doesn't grow with its size. Chunks of the source that are not there anymore are deleted at the end.
+    # progress may raise to stop the ingestion, in that case only the chunks added here are removed.
+    # collection defaults to the active one, reindex.py passes the collection it is building.
+    collection = collection or get_active_collection()
+    db = get_vector_db(collection)
+    lexical_index = get_lexical_index(collection)
+    catalog = get_source_catalog(collection)
+    start_time = time.monotonic()
+    start_rss = peak_rss = rss_mb()
+    ids_by_source = {}
+    existing = set()
+    seen = set()
+    kept = 0
+    first_chunk_seconds = None
+    added = []
+    added_lock = threading.Lock()
+    # Parsing stops while this many batches wait for the embedding model
+    in_flight = threading.BoundedSemaphore(INGEST_EMBED_CONCURRENCY * 2)
+
+    def add_batch(batch):
+        try:
+            with embedding_slots:
+                ids = db.add_documents([chunk for _, chunk in batch], ids=[id for id, _ in batch])
+            lexical_index.add(ids, [chunk for _, chunk in batch])
+            with added_lock:
+                added.extend(ids)
+        finally:
+            in_flight.release()
+
+    def report(**counters):
+        if progress:
+            progress(pages_parsed=getattr(chunks, 'pages', pages_parsed), chunks_total=len(seen),
+                     chunks_embedded=kept + len(added), **counters)
+
+    def collect(futures, wait=False):
+        nonlocal first_chunk_seconds, peak_rss
+        peak_rss = max(peak_rss, rss_mb())
+        for future in [future for future in futures if wait or future.done()]:
+            futures.remove(future)
+            future.result()
+            if first_chunk_seconds is None:
+                first_chunk_seconds = time.monotonic() - start_time
+                report(first_chunk_seconds=first_chunk_seconds)
+            else:
+                report()
+
+    executor = ThreadPoolExecutor(max_workers=INGEST_EMBED_CONCURRENCY)
+    futures = []
+    batch = []
+    # Sources without catalog entry (older collections, or interrupted before the end) may have
+    # chunks in the collection that are missing from the lexical index, their kept chunks are indexed again
+    unverified = set()
+    reindexed = []
+    try:
+        for chunk in chunks:
+            id = chunk_id(chunk)
+            if id in seen:
+                continue
+            seen.add(id)
+            source = chunk.metadata.get('source')
+            if source not in ids_by_source:
+                ids_by_source[source] = []
+                catalog.begin(source)
+                entry = catalog.get(source)
+                if entry is None:
+                    existing.update(db.get(where={'source': source}, include=[])['ids'])
+                    unverified.add(source)
+                else:
+                    existing.update(entry['chunk_ids'])
+            ids_by_source[source].append(id)
+            if id in existing:
+                kept += 1
+                if source in unverified:
+                    reindexed.append((id, chunk))
+                    if len(reindexed) >= EMBED_BATCH_SIZE:
+                        lexical_index.add([id for id, _ in reindexed], [chunk for _, chunk in reindexed])
+                        reindexed = []
+                continue
+            batch.append((id, chunk))
+            if len(batch) >= EMBED_BATCH_SIZE:
+                in_flight.acquire()
+                futures.append(executor.submit(add_batch, batch))
+                batch = []
+                collect(futures)
+        if batch:
+            in_flight.acquire()
+            futures.append(executor.submit(add_batch, batch))
+        if reindexed:
+            lexical_index.add([id for id, _ in reindexed], [chunk for _, chunk in reindexed])
+        collect(futures, wait=True)
+        rss_growth_mb = max(peak_rss, rss_mb()) - start_rss
+        report(rss_growth_mb=rss_growth_mb)
+    except BaseException:
+        executor.shutdown(wait=True, cancel_futures=True)
+        if added:
+            db.delete(added)
+            lexical_index.delete(added)
+        catalog.abort(list(ids_by_source))
+        raise
+    executor.shutdown()
+
+    vanished = list(existing - seen)
+    if vanished:
+        db.delete(vanished)
+        lexical_index.delete(vanished)
+    for source, source_ids in ids_by_source.items():
+        catalog.put(source, source_ids)
+    if (added or vanished) and collection == get_active_collection():
+        bump_collection_version()
+
+    elapsed = time.monotonic() - start_time
+    ingest_duration.observe(elapsed)
+    if first_chunk_seconds is not None:
+        ingest_first_chunk.observe(first_chunk_seconds)
+    sources = ', '.join(map(str, ids_by_source))
+    if not added and not vanished:
+        print(f"\033[32mUnchanged, nothing to embed ({sources})\033[0m")
+    else:
+        print(f"\033[32mEmbedded {len(added)} new chunks, reused {kept}, removed {len(vanished)} ({sources}) in {elapsed:.1f} s, "
+              f"first chunk after {first_chunk_seconds or 0:.1f} s, peak RSS {start_rss + rss_growth_mb:.0f} MB (+{rss_growth_mb:.0f} MB)\033[0m")
+    return list(seen)
+
+
+def embed_url_source(url, progress=None, collection=None):
+    from langchain_community.document_loaders import WebBaseLoader
     loader = WebBaseLoader(url)
     docs = loader.load()
-    for doc in docs:
-        print(doc)
     text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
     chunks = text_splitter.split_documents(docs)
-    db = get_vector_db()
-    db.add_documents(chunks)
+    add_chunks(chunks, progress, pages_parsed=len(docs), collection=collection)
     return True
 
 
+def embed_file(file_path, progress=None, collection=None):
+    add_chunks(PdfChunks(file_path), progress, collection=collection)
+    return True
+
+
+def remove_source(source, collection=None):
+    # Deletes the chunks of a source from the collection (the active one by default), its lexical index and catalog
+    collection = collection or get_active_collection()
+    db = get_vector_db(collection)
+    catalog = get_source_catalog(collection)
+    catalog.begin(source)
+    entry = catalog.get(source)
+    if entry is not None:
+        doc_ids = entry['chunk_ids']
+    else:
+        doc_ids = db.get(where={'source': source}, include=[])['ids']
+    if doc_ids:
+        db.delete(doc_ids)
+    get_lexical_index(collection).delete_source(source)
+    catalog.remove(source)
+    if collection == get_active_collection():
+        bump_collection_version()
+    return doc_ids
+
+
+def embed_url(url):
+    return embed_url_source(url)
+
+
 def embed(file):
     if file.filename != '' and file and allowed_file(file.filename):
         file_path = save_file(file)
-        chunks = load_and_split_data(file_path)
-        db = get_vector_db()
-        db.add_documents(chunks)
-        return True
+        return embed_file(file_path)
 
-    return False
\ No newline at end of file
+    return False
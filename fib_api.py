@@ -0,0 +1,216 @@
+import os
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urljoin
+import requests
+from requests.adapters import HTTPAdapter
+from cachetools import TTLCache
+
+# Cache of FIB API responses shared by the agent tools.
+# Public data (url map, subject catalog, subject guides) is the same for everyone and changes rarely,
+# private data (horari, assignatures of the user) is cached per token with a short TTL.
+FIB_URLS_TTL = int(os.getenv('FIB_URLS_TTL', 24 * 3600))
+FIB_PUBLIC_TTL = int(os.getenv('FIB_PUBLIC_TTL', 6 * 3600))
+FIB_PRIVATE_TTL = int(os.getenv('FIB_PRIVATE_TTL', 300))
+FIB_PUBLIC_CACHE_SIZE = int(os.getenv('FIB_PUBLIC_CACHE_SIZE', 2048))
+FIB_PRIVATE_CACHE_SIZE = int(os.getenv('FIB_PRIVATE_CACHE_SIZE', 4096))
+# Pooled keep-alive connections and workers for independent requests made by one tool call
+FIB_API_POOL_SIZE = int(os.getenv('FIB_API_POOL_SIZE', 16))
+FIB_API_WORKERS = int(os.getenv('FIB_API_WORKERS', 8))
+FIB_API_TIMEOUT = float(os.getenv('FIB_API_TIMEOUT', 10))
+# The private data of a logged in user (and the guides of their subjects) is fetched at login and
+# refreshed in the background until logout or the end of the session, so the tools find it cached.
+# The refresh interval must be below FIB_PRIVATE_TTL to keep the entries from expiring in between.
+FIB_PREFETCH_ENABLED = os.getenv('FIB_PREFETCH_ENABLED', 'true').lower() == 'true'
+FIB_PREFETCH_REFRESH = int(os.getenv('FIB_PREFETCH_REFRESH', 240))
+FIB_PREFETCH_WORKERS = int(os.getenv('FIB_PREFETCH_WORKERS', 2))
+PREFETCHED_PRIVATE = ('horari', 'assignatures')
+
+
+class CachedFibApi:
+    def __init__(self, fib_api):
+        # The OAuth client is only used for its base url, requests go through a pooled session
+        self.base_url = fib_api.base_url
+        self.http = requests.Session()
+        adapter = HTTPAdapter(pool_connections=FIB_API_POOL_SIZE, pool_maxsize=FIB_API_POOL_SIZE)
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=FIB_API_WORKERS, thread_name_prefix='fib-api')
+        self.lock = threading.Lock()
+        self.caches = {
+            "urls": TTLCache(maxsize=8, ttl=FIB_URLS_TTL),
+            "public": TTLCache(maxsize=FIB_PUBLIC_CACHE_SIZE, ttl=FIB_PUBLIC_TTL),
+            "private": TTLCache(maxsize=FIB_PRIVATE_CACHE_SIZE, ttl=FIB_PRIVATE_TTL),
+        }
+        self.stats = {name: {"hits": 0, "misses": 0} for name in self.caches}
+        # acronym -> subject of the public catalog, rebuilt whenever the catalog is fetched again
+        self.subjects_by_acronym = {}
+        self.catalog_version = None
+        # (cache, key) -> Future of the request in flight, concurrent misses of the same entry wait for it
+        self.loading = {}
+        # user key -> token, end of the session (epoch seconds) and last prefetch of the logged in users
+        self.sessions = {}
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=FIB_PREFETCH_WORKERS, thread_name_prefix='fib-prefetch')
+        self.prefetch_stats = {"prefetches": 0, "refreshes": 0, "errors": 0, "expired": 0}
+        self.refresher = None
+
+    def fetch(self, url, token, lang=True):
+        headers = {'Accept': 'application/json'}
+        if lang:
+            headers['Accept-Language'] = 'es'
+        if token:
+            headers['Authorization'] = f"Bearer {user_key(token)}"
+        response = self.http.get(urljoin(self.base_url, url), headers=headers, timeout=FIB_API_TIMEOUT)
+        response.raise_for_status()
+        return response.json()
+
+    def fetch_many(self, loaders):
+        # Runs independent loaders (zero-argument callables) concurrently and returns their results in order.
+        # Loaders must not call fetch_many themselves.
+        return list(self.executor.map(lambda loader: loader(), loaders))
+
+    def cached(self, cache_name, key, loader):
+        cache = self.caches[cache_name]
+        with self.lock:
+            value = cache.get(key)
+            if value is not None:
+                self.stats[cache_name]["hits"] += 1
+                return value
+            self.stats[cache_name]["misses"] += 1
+        return self.load(cache_name, key, loader)
+
+    def load(self, cache_name, key, loader):
+        # Fetches the entry again and stores it, or waits for the request of the same entry already in flight
+        with self.lock:
+            future = self.loading.get((cache_name, key))
+            if future is not None:
+                owner = False
+            else:
+                owner = True
+                future = self.loading[(cache_name, key)] = Future()
+        if not owner:
+            return future.result()
+        try:
+            value = loader()
+        except Exception as e:
+            with self.lock:
+                del self.loading[(cache_name, key)]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.caches[cache_name][key] = value
+            del self.loading[(cache_name, key)]
+        future.set_result(value)
+        return value
+
+    def get_urls(self, token):
+        return self.cached("urls", "urls", lambda: self.fetch('', token, lang=False))
+
+    def get_public(self, name, token):
+        url = self.get_urls(token)['public'][name]
+        return self.cached("public", url, lambda: self.fetch(url, token))
+
+    def get_private(self, name, token):
+        url = self.get_urls(token)['privat'][name]
+        return self.cached("private", (user_key(token), url), lambda: self.fetch(url, token))
+
+    def get_guide(self, url, token):
+        return self.cached("public", url, lambda: self.fetch(url, token))
+
+    def find_subject(self, acronym, token):
+        catalog = self.get_public('assignatures', token)
+        with self.lock:
+            if self.catalog_version is not catalog:
+                self.subjects_by_acronym = {subject['sigles'].upper(): subject for subject in catalog['results']}
+                self.catalog_version = catalog
+            return self.subjects_by_acronym.get(acronym.strip().upper())
+
+    def load_user(self, token):
+        # Same entries the tools read: private schedule and subjects (fetched again), url map, catalog and guides
+        key = user_key(token)
+        urls = self.get_urls(token)['privat']
+        _, subjects = self.fetch_many([
+            (lambda url=urls[name]: self.load("private", (key, url), lambda: self.fetch(url, token)))
+            for name in PREFETCHED_PRIVATE
+        ])
+        guides = []
+        for subject in subjects['results']:
+            guide = subject.get('guia') or (self.find_subject(subject['id'], token) or {}).get('guia')
+            if guide:
+                guides.append(guide)
+        self.fetch_many([(lambda url=url: self.get_guide(url, token)) for url in guides])
+
+    def prefetch(self, token, stat):
+        start_time = time.monotonic()
+        try:
+            self.load_user(token)
+        except Exception as e:
+            # The tools fetch what is missing when they are called
+            print(f"\033[31mFIB API prefetch failed: {e}\033[0m")
+            with self.lock:
+                self.prefetch_stats["errors"] += 1
+            return
+        with self.lock:
+            self.prefetch_stats[stat] += 1
+        print(f"\033[34mFIB API data of a user loaded in {time.monotonic() - start_time:.2f} s ({stat})\033[0m")
+
+    def prefetch_user(self, token, expires_at):
+        # Called at login and on the requests of the user, the first call of the session in this worker prefetches
+        if not FIB_PREFETCH_ENABLED or not token:
+            return
+        key = user_key(token)
+        with self.lock:
+            if key in self.sessions:
+                return
+            self.sessions[key] = {"token": token, "expires_at": expires_at, "refreshed_at": time.time()}
+            if self.refresher is None:
+                self.refresher = threading.Thread(target=self.refresh_sessions, name='fib-prefetch-refresh', daemon=True)
+                self.refresher.start()
+        self.prefetch_executor.submit(self.prefetch, token, "prefetches")
+
+    def refresh_sessions(self):
+        while True:
+            time.sleep(min(FIB_PREFETCH_REFRESH, 30))
+            now = time.time()
+            with self.lock:
+                expired = [key for key, entry in self.sessions.items() if entry["expires_at"] <= now]
+                due = [entry for entry in self.sessions.values() if entry["expires_at"] > now and now - entry["refreshed_at"] >= FIB_PREFETCH_REFRESH]
+                for entry in due:
+                    entry["refreshed_at"] = now
+            for key in expired:
+                self.evict_user(key)
+                with self.lock:
+                    self.prefetch_stats["expired"] += 1
+            for entry in due:
+                self.prefetch_executor.submit(self.prefetch, entry["token"], "refreshes")
+
+    def evict_user(self, token):
+        key = user_key(token)
+        with self.lock:
+            self.sessions.pop(key, None)
+            cache = self.caches["private"]
+            for cache_key in [k for k in list(cache.keys()) if k[0] == key]:
+                cache.pop(cache_key, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                **{
+                    name: {
+                        **self.stats[name],
+                        "size": len(cache),
+                        "maxsize": cache.maxsize,
+                        "ttl": cache.ttl,
+                    }
+                    for name, cache in self.caches.items()
+                },
+                "prefetch": {**self.prefetch_stats, "sessions": len(self.sessions)},
+            }
+
+
+def user_key(token):
+    # The session stores the token as (access_token, secret)
+    if isinstance(token, (tuple, list)):
+        return token[0]
+    return token
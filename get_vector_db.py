@@ -1,19 +1,109 @@
 import os
-from langchain_ollama import OllamaEmbeddings
-from langchain_chroma import Chroma
+import fcntl
+import threading
 
 CHROMA_PATH = os.getenv('CHROMA_PATH', 'chroma')
 COLLECTION_NAME = os.getenv('COLLECTION_NAME', 'local-rag')
 TEXT_EMBEDDING_MODEL = os.getenv('TEXT_EMBEDDING_MODEL', 'nomic-embed-text')
 OLLAMA_SERVER_URL = os.getenv('OLLAMA_SERVER_URL', "http://localhost:11434")
+# chroma, or mmap for the memory mapped exact search of mmap_store.py (migrate with migrate_vector_store.py)
+VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'chroma')
 
-def get_vector_db():
-    embedding = OllamaEmbeddings(model=TEXT_EMBEDDING_MODEL,base_url=OLLAMA_SERVER_URL)
+# Version of the collection, bumped on every change of its content (embed, embed_url, delete_source).
+# It lives in a file next to the collection so every worker process sees the same value, bumps hold
+# an flock on VERSION_FILE.lock so the workers, ingest and reindex processes never write the same number.
+VERSION_FILE = os.path.join(CHROMA_PATH, 'collection_version')
 
-    db = Chroma(
-        collection_name=COLLECTION_NAME,
-        persist_directory=CHROMA_PATH,
-        embedding_function=embedding
-    )
+def get_collection_version():
+    try:
+        with open(VERSION_FILE) as f:
+            return int(f.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
 
-    return db
\ No newline at end of file
+def bump_collection_version():
+    os.makedirs(CHROMA_PATH, exist_ok=True)
+    # flock is per open file, it also serializes the threads of this process
+    with open(f"{VERSION_FILE}.lock", 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            version = get_collection_version() + 1
+            tmp_file = f"{VERSION_FILE}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_file, 'w') as f:
+                f.write(str(version))
+            os.replace(tmp_file, VERSION_FILE)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    return version
+
+# Collection that is served. reindex.py builds a new collection next to it and swaps this pointer,
+# every process follows it on its next call (with the lexical index and the source catalog).
+ACTIVE_COLLECTION_FILE = os.path.join(CHROMA_PATH, 'active_collection')
+
+def get_active_collection():
+    try:
+        with open(ACTIVE_COLLECTION_FILE) as f:
+            return f.read().strip() or COLLECTION_NAME
+    except FileNotFoundError:
+        return COLLECTION_NAME
+
+def set_active_collection(collection):
+    os.makedirs(CHROMA_PATH, exist_ok=True)
+    tmp_file = f"{ACTIVE_COLLECTION_FILE}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w') as f:
+        f.write(collection)
+    os.replace(tmp_file, ACTIVE_COLLECTION_FILE)
+    # Caches built from the previous collection are dropped
+    return bump_collection_version()
+
+# The embedding model client and the vector stores are created once per process, on first use,
+# and shared by the agent tools, the answer cache, the ingestion functions and the source endpoints.
+# chromadb and langchain_ollama are imported there too, they are slow to import.
+_embeddings = None
+_dbs = {}
+_db_lock = threading.Lock()
+
+def build_embeddings():
+    from langchain_ollama import OllamaEmbeddings
+    return OllamaEmbeddings(model=TEXT_EMBEDDING_MODEL, base_url=OLLAMA_SERVER_URL)
+
+def get_embeddings():
+    # Query embeddings go through the cache of query_cache.py, shared by the retriever, the router and the answer cache
+    global _embeddings
+    with _db_lock:
+        if _embeddings is None:
+            from query_cache import CachedQueryEmbeddings
+            _embeddings = CachedQueryEmbeddings(build_embeddings(), TEXT_EMBEDDING_MODEL)
+    return _embeddings
+
+def build_vector_db(collection, embedding, backend=VECTOR_BACKEND):
+    if backend == 'mmap':
+        from mmap_store import MmapVectorStore
+        return MmapVectorStore(collection, CHROMA_PATH, embedding)
+    if backend == 'chroma':
+        from langchain_chroma import Chroma
+        return Chroma(
+            collection_name=collection,
+            persist_directory=CHROMA_PATH,
+            embedding_function=embedding
+        )
+    raise ValueError(f"Unknown VECTOR_BACKEND {backend}")
+
+def get_vector_db(collection=None):
+    # None is the active collection
+    collection = collection or get_active_collection()
+    db = _dbs.get(collection)
+    if db is not None:
+        return db
+
+    embedding = get_embeddings()
+    with _db_lock:
+        if collection not in _dbs:
+            _dbs[collection] = build_vector_db(collection, embedding)
+
+    return _dbs[collection]
+
+def forget_vector_db(collection):
+    # Called when a collection is deleted
+    with _db_lock:
+        _dbs.pop(collection, None)
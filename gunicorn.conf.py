@@ -0,0 +1,27 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Production server: gunicorn --config gunicorn.conf.py app:app
+# python3 app.py starts the Flask development server and is only meant for development.
+bind = f"0.0.0.0:{os.getenv('PORT', 8080)}"
+# One worker by default: the admission limits, the auto mode estimates and the metrics live in the memory
+# of each worker, and a Chroma collection opened by a process doesn't see what other processes write to it
+workers = int(os.getenv('GUNICORN_WORKERS', 1))
+if workers > 1 and os.getenv('VECTOR_BACKEND', 'chroma') != 'mmap':
+    raise RuntimeError("GUNICORN_WORKERS > 1 needs VECTOR_BACKEND=mmap, with Chroma the documents ingested or deleted "
+                       "by one worker are not seen by the others")
+# Requests spend most of their time waiting on the LLM, the FIB API or sqlite, threads are enough
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 24))
+# Generations and streamed answers can take minutes
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 300))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = 5
+# Every worker opens its own vector store, sqlite pools and background threads after the fork,
+# nothing of that survives a fork so the app is not preloaded
+preload_app = False
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOGLEVEL', 'info')
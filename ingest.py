@@ -0,0 +1,192 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from embed import embed_file, embed_url_source
+from source_catalog import get_source_catalog
+
+# Background ingestion of PDFs and URLs.
+# Jobs live in a sqlite table so they survive restarts and can be claimed by any worker process,
+# the embedding work itself is limited by INGEST_WORKERS and the embedding slots in embed.py.
+INGEST_DB = os.getenv('INGEST_DB', 'jobs.sqlite')
+INGEST_WORKERS = int(os.getenv('INGEST_WORKERS', 1))
+# A running job that has not reported progress for this long is considered dead and is queued again
+INGEST_STALE_SECONDS = int(os.getenv('INGEST_STALE_SECONDS', 600))
+
+JOB_FIELDS = ('id', 'kind', 'source', 'status', 'pages_parsed', 'chunks_total', 'chunks_embedded', 'first_chunk_seconds', 'rss_growth_mb',
+              'error', 'created_at', 'updated_at')
+# Columns added after the table was created, with their definition
+ADDED_COLUMNS = {'first_chunk_seconds': 'REAL', 'rss_growth_mb': 'REAL'}
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class IngestionQueue:
+    def __init__(self, path=INGEST_DB, workers=INGEST_WORKERS):
+        self.path = path
+        self.workers = workers
+        self.wakeup = threading.Event()
+        self.started = False
+        self.start_lock = threading.Lock()
+        with self.connect() as conn:
+            conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    pages_parsed INTEGER NOT NULL DEFAULT 0,
+                    chunks_total INTEGER NOT NULL DEFAULT 0,
+                    chunks_embedded INTEGER NOT NULL DEFAULT 0,
+                    first_chunk_seconds REAL,
+                    rss_growth_mb REAL,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created_at);
+            """)
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+            for name, definition in ADDED_COLUMNS.items():
+                if name not in columns:
+                    conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def start(self):
+        # Worker threads are started lazily so importing the module has no side effects
+        with self.start_lock:
+            if self.started:
+                return
+            for i in range(self.workers):
+                threading.Thread(target=self.worker, name=f"ingest-{i}", daemon=True).start()
+            self.started = True
+
+    def submit(self, kind, source):
+        self.start()
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute("INSERT INTO jobs (id, kind, source, status, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+                         (job_id, kind, source, now, now))
+        self.wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        with self.connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def list(self, limit=50):
+        with self.connect() as conn:
+            rows = conn.execute(f"SELECT {', '.join(JOB_FIELDS)} FROM jobs ORDER BY created_at DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def cancel(self, job_id):
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cancelled = conn.execute("UPDATE jobs SET status = 'cancelled', updated_at = ? WHERE id = ? AND status = 'queued'",
+                                     (time.time(), job_id)).rowcount
+            # Running jobs notice it on their next progress report
+            conn.execute("UPDATE jobs SET status = 'cancelling', updated_at = ? WHERE id = ? AND status = 'running'", (time.time(), job_id))
+            job = conn.execute("SELECT kind, source FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            orphan = cancelled and self.is_orphan_upload(conn, job_id, job)
+            conn.execute("COMMIT")
+        if orphan:
+            self.delete_upload(job['source'])
+        return self.get(job_id)
+
+    def is_orphan_upload(self, conn, job_id, job):
+        # The uploaded file of a cancelled PDF job is deleted, unless another job still needs it or it is
+        # the file of a source that is indexed and served (a cancelled re-upload)
+        if job['kind'] != 'pdf':
+            return False
+        other = conn.execute("SELECT 1 FROM jobs WHERE source = ? AND id != ? AND status IN ('queued', 'running', 'cancelling')",
+                             (job['source'], job_id)).fetchone()
+        return other is None and get_source_catalog().get(job['source']) is None
+
+    def delete_upload(self, source):
+        if os.path.exists(source):
+            os.remove(source)
+            print(f"\033[33mDeleted {source}, its ingestion job was cancelled\033[0m")
+
+    def claim(self):
+        now = time.time()
+        with self.connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute("UPDATE jobs SET status = 'cancelled' WHERE status = 'cancelling' AND updated_at < ?", (now - INGEST_STALE_SECONDS,))
+            row = conn.execute("""
+                SELECT id FROM jobs
+                WHERE status = 'queued' OR (status = 'running' AND updated_at < ?)
+                ORDER BY created_at LIMIT 1
+            """, (now - INGEST_STALE_SECONDS,)).fetchone()
+            if row is None:
+                conn.execute("COMMIT")
+                return None
+            conn.execute("UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?", (now, row['id']))
+            conn.execute("COMMIT")
+        return self.get(row['id'])
+
+    def update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        assignments = ', '.join(f"{name} = ?" for name in fields)
+        with self.connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def progress_callback(self, job_id):
+        def progress(**counters):
+            with self.connect() as conn:
+                status = conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()['status']
+            if status == 'cancelling':
+                raise JobCancelled()
+            self.update(job_id, **counters)
+        return progress
+
+    def worker(self):
+        while True:
+            self.wakeup.clear()
+            try:
+                job = self.claim()
+            except sqlite3.Error as e:
+                print(f"\033[31mCould not claim an ingestion job: {e}\033[0m")
+                job = None
+            if job is None:
+                self.wakeup.wait(timeout=5)
+                continue
+            self.run(job)
+
+    def run(self, job):
+        progress = self.progress_callback(job['id'])
+        start_time = time.monotonic()
+        try:
+            if job['kind'] == 'pdf':
+                embed_file(job['source'], progress=progress)
+            else:
+                embed_url_source(job['source'], progress=progress)
+            self.update(job['id'], status='done')
+            print(f"\033[32mIngestion job {job['id']} ({job['source']}) done in {time.monotonic() - start_time} s\033[0m")
+        except JobCancelled:
+            self.update(job['id'], status='cancelled')
+            with self.connect() as conn:
+                orphan = self.is_orphan_upload(conn, job['id'], job)
+            if orphan:
+                self.delete_upload(job['source'])
+            print(f"\033[33mIngestion job {job['id']} ({job['source']}) cancelled\033[0m")
+        except Exception as e:
+            self.update(job['id'], status='failed', error=str(e))
+            print(f"\033[31mIngestion job {job['id']} ({job['source']}) failed: {e}\033[0m")
+
+
+ingestion_queue = IngestionQueue()
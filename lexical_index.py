@@ -0,0 +1,118 @@
+import os
+import re
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+from langchain_core.documents import Document
+from get_vector_db import CHROMA_PATH, COLLECTION_NAME, get_active_collection
+
+# BM25 inverted index of the chunks stored in the vector collection (sqlite FTS5), kept next to CHROMA_PATH.
+# It is updated by embed.py and /delete_source together with the collection.
+LEXICAL_INDEX_PATH = os.getenv('LEXICAL_INDEX_PATH', os.path.join(CHROMA_PATH, f"{COLLECTION_NAME}-lexical.sqlite"))
+
+
+def lexical_index_path(collection):
+    # Collections built by reindex.py get their own index next to them
+    if collection == COLLECTION_NAME:
+        return LEXICAL_INDEX_PATH
+    return os.path.join(CHROMA_PATH, f"{collection}-lexical.sqlite")
+
+
+class LexicalIndex:
+    def __init__(self, path=LEXICAL_INDEX_PATH):
+        self.path = path
+        self.write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.connect() as conn:
+            conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS chunk_docs (
+                    rowid INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    source TEXT,
+                    content TEXT NOT NULL,
+                    metadata TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS chunk_docs_source ON chunk_docs(source);
+                -- accents are removed so 'matricula' also matches 'matrícula'
+                CREATE VIRTUAL TABLE IF NOT EXISTS chunk_fts USING fts5(
+                    content, content='chunk_docs', content_rowid='rowid',
+                    tokenize='unicode61 remove_diacritics 2'
+                );
+                CREATE TRIGGER IF NOT EXISTS chunk_docs_insert AFTER INSERT ON chunk_docs BEGIN
+                    INSERT INTO chunk_fts(rowid, content) VALUES (new.rowid, new.content);
+                END;
+                CREATE TRIGGER IF NOT EXISTS chunk_docs_delete AFTER DELETE ON chunk_docs BEGIN
+                    INSERT INTO chunk_fts(chunk_fts, rowid, content) VALUES ('delete', old.rowid, old.content);
+                END;
+            """)
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def add(self, ids, documents):
+        rows = [(id, doc.metadata.get('source'), doc.page_content, json.dumps(doc.metadata)) for id, doc in zip(ids, documents)]
+        with self.write_lock, self.connect() as conn:
+            conn.executemany("DELETE FROM chunk_docs WHERE id = ?", [(row[0],) for row in rows])
+            conn.executemany("INSERT INTO chunk_docs (id, source, content, metadata) VALUES (?, ?, ?, ?)", rows)
+
+    def delete(self, ids):
+        with self.write_lock, self.connect() as conn:
+            conn.executemany("DELETE FROM chunk_docs WHERE id = ?", [(id,) for id in ids])
+
+    def delete_source(self, source):
+        with self.write_lock, self.connect() as conn:
+            conn.execute("DELETE FROM chunk_docs WHERE source = ?", (source,))
+
+    def count(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM chunk_docs").fetchone()[0]
+
+    def search(self, query, k):
+        terms = [term for term in re.findall(r'\w+', query.lower()) if len(term) > 1]
+        if not terms:
+            return []
+        match = ' OR '.join('"' + term.replace('"', '') + '"' for term in set(terms))
+        with self.connect() as conn:
+            rows = conn.execute("""
+                SELECT chunk_docs.content, chunk_docs.metadata
+                FROM chunk_fts JOIN chunk_docs ON chunk_docs.rowid = chunk_fts.rowid
+                WHERE chunk_fts MATCH ?
+                ORDER BY bm25(chunk_fts)
+                LIMIT ?
+            """, (match, k)).fetchall()
+        return [Document(page_content=content, metadata=json.loads(metadata)) for content, metadata in rows]
+
+    def rebuild_from(self, vector_store):
+        # Backfill for collections created before the index existed
+        docs = vector_store.get(include=["documents", "metadatas"])
+        with self.write_lock, self.connect() as conn:
+            conn.execute("DELETE FROM chunk_docs")
+            conn.executemany("INSERT INTO chunk_docs (id, source, content, metadata) VALUES (?, ?, ?, ?)", [
+                (id, (metadata or {}).get('source'), content, json.dumps(metadata or {}))
+                for id, content, metadata in zip(docs['ids'], docs['documents'], docs['metadatas'])
+            ])
+        return len(docs['ids'])
+
+
+_indexes = {}
+_index_lock = threading.Lock()
+
+def get_lexical_index(collection=None):
+    # None is the index of the active collection
+    collection = collection or get_active_collection()
+    with _index_lock:
+        if collection not in _indexes:
+            _indexes[collection] = LexicalIndex(lexical_index_path(collection))
+    return _indexes[collection]
+
+def forget_lexical_index(collection):
+    with _index_lock:
+        _indexes.pop(collection, None)
@@ -0,0 +1,293 @@
+import os
+import time
+import threading
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage
+
+# Performance telemetry in Prometheus text format, served by /metrics.
+# Metrics live in the memory of each worker process, every sample has a worker label (its pid) so the
+# series of different workers are not mixed, add them up with sum without (worker).
+try:
+    from opentelemetry import trace
+    tracer = trace.get_tracer("fiberbot") if os.getenv('TRACING_ENABLED', 'false').lower() == 'true' else None
+except ImportError:
+    tracer = None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 35, 50, 75, 100, 200, 500, 1000)
+
+# $ per million tokens of the cloud models
+cost_per_million_tokens = {
+    "llama3-70b-8192" : {
+        "input" : 0.59,
+        "output" : 0.79
+    },
+    "llama3-8b-8192" : {
+        "input" : 0.05,
+        "output" : 0.08
+    },
+    "llama-3.1-8b-instant" : {
+        "input" : 0.05,
+        "output" : 0.08
+    },
+    "llama-3.3-70b-versatile" : {
+        "input" : 0.59,
+        "output" : 0.79
+    },
+}
+
+BACKENDS = {"local": "ollama", "cloud": "groq"}
+
+
+def format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra) + [("worker", os.getpid())]
+    escape = lambda value: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        with self.lock:
+            return self.header() + [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def render(self):
+        with self.lock:
+            return self.header() + [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in self.values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            counts = [c + (value <= bound) for c, bound in zip(counts, self.buckets)]
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = self.header()
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', bound)])} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+registry = []
+# Functions called on every scrape to refresh gauges from the stats of other modules
+collectors = []
+
+
+def register_collector(collector):
+    collectors.append(collector)
+
+
+# Functions called with (mode, sample) after every LLM generation, the sample is None for an error.
+# backend_router.py keeps its estimates of each backend with them.
+generation_observers = []
+
+
+def register_generation_observer(observer):
+    generation_observers.append(observer)
+
+
+def notify_generation(mode, sample):
+    for observer in generation_observers:
+        observer(mode, sample)
+
+
+component_stats = Gauge("fiberbot_component_stat", "Numeric stats of the caches, retriever, context and checkpoint store", ("component", "stat"))
+
+
+def export_stats(component, stats, prefix=""):
+    # Flattens the get_stats() dicts of the other modules into component_stats
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            export_stats(component, value, f"{prefix}{name}_")
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            component_stats.set(value, component=component, stat=prefix + name)
+
+
+def render_metrics():
+    for collector in collectors:
+        try:
+            collector()
+        except Exception as e:
+            print(f"\033[31mMetrics collector failed: {e}\033[0m")
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+query_duration = Histogram("fiberbot_query_duration_seconds", "End to end duration of a query", ("mode", "path"))
+first_token_latency = Histogram("fiberbot_first_token_seconds", "Time to the first streamed token of an answer", ("mode",))
+query_errors = Counter("fiberbot_query_errors_total", "Queries that raised an error", ("mode",))
+tool_duration = Histogram("fiberbot_tool_duration_seconds", "Duration of a tool call", ("tool",))
+tool_errors = Counter("fiberbot_tool_errors_total", "Tool calls that raised an error", ("tool",))
+llm_errors = Counter("fiberbot_llm_errors_total", "Errors returned by the LLM backends", ("backend",))
+llm_load_duration = Histogram("fiberbot_llm_load_duration_seconds", "Time Ollama spent loading the model", ("model",))
+llm_prompt_eval_duration = Histogram("fiberbot_llm_prompt_eval_duration_seconds", "Prompt evaluation time of a generation", ("model",))
+llm_eval_duration = Histogram("fiberbot_llm_eval_duration_seconds", "Completion time of a generation", ("model",))
+llm_queue_time = Histogram("fiberbot_llm_queue_time_seconds", "Time a generation waited in the Groq queue", ("model",))
+llm_tokens_per_second = Histogram("fiberbot_llm_tokens_per_second", "Output tokens per second of a generation", ("model",), RATE_BUCKETS)
+llm_tokens = Counter("fiberbot_llm_tokens_total", "Tokens processed by the LLM backends", ("model", "type"))
+llm_cost = Counter("fiberbot_llm_cost_dollars_total", "Cost of the cloud generations in dollars", ("model",))
+
+
+def record_local_metrics(message: AIMessage):
+    metadata = message.response_metadata
+    usage = message.usage_metadata or {}
+    model = metadata.get('model', 'unknown')
+    load = metadata.get('load_duration', 0) / 1e9
+    prompt_eval = metadata.get('prompt_eval_duration', 0) / 1e9
+    eval = metadata.get('eval_duration', 0) / 1e9
+    output_tokens = usage.get('output_tokens', metadata.get('eval_count', 0))
+    tokens_per_second = output_tokens / eval if eval else 0
+    # Partial streamed chunks don't carry the timings, they are only observed when reported
+    if 'eval_duration' in metadata:
+        llm_load_duration.observe(load, model=model)
+        llm_prompt_eval_duration.observe(prompt_eval, model=model)
+        llm_eval_duration.observe(eval, model=model)
+        # A model (re)load is the wait of the local backend
+        notify_generation("local", {"queue_seconds": load, "prompt_seconds": prompt_eval, "tokens_per_second": tokens_per_second,
+                                    "input_tokens": usage.get('input_tokens', 0), "output_tokens": output_tokens, "cost": 0})
+    if tokens_per_second:
+        llm_tokens_per_second.observe(tokens_per_second, model=model)
+    llm_tokens.inc(usage.get('input_tokens', 0), model=model, type="input")
+    llm_tokens.inc(output_tokens, model=model, type="output")
+    print(f"\033[34mMetrics {model}: {usage.get('input_tokens', 0)} in / {output_tokens} out tokens, "
+          f"load {load*1000:.0f} ms, prompt eval {prompt_eval*1000:.0f} ms, eval {eval*1000:.0f} ms, "
+          f"total {metadata.get('total_duration', 0)/1e6:.0f} ms, {tokens_per_second:.1f} T/s\033[0m")
+    return 0
+
+
+def record_cloud_metrics(message: AIMessage):
+    metadata = message.response_metadata
+    usage = message.usage_metadata or {}
+    token_usage = metadata.get('token_usage') or {}
+    model = metadata.get('model_name', 'unknown')
+    input_tokens = usage.get('input_tokens', 0)
+    output_tokens = usage.get('output_tokens', 0)
+    queue_time = token_usage.get('queue_time') or 0
+    prompt_time = token_usage.get('prompt_time') or 0
+    completion_time = token_usage.get('completion_time') or 0
+    tokens_per_second = output_tokens / completion_time if completion_time else 0
+    prices = cost_per_million_tokens.get(model)
+    cost = (input_tokens / 1e6) * prices['input'] + (output_tokens / 1e6) * prices['output'] if prices else 0
+    if token_usage:
+        llm_queue_time.observe(queue_time, model=model)
+        llm_prompt_eval_duration.observe(prompt_time, model=model)
+        llm_eval_duration.observe(completion_time, model=model)
+        notify_generation("cloud", {"queue_seconds": queue_time, "prompt_seconds": prompt_time, "tokens_per_second": tokens_per_second,
+                                    "input_tokens": input_tokens, "output_tokens": output_tokens, "cost": cost})
+    if tokens_per_second:
+        llm_tokens_per_second.observe(tokens_per_second, model=model)
+    llm_tokens.inc(input_tokens, model=model, type="input")
+    llm_tokens.inc(output_tokens, model=model, type="output")
+    llm_cost.inc(cost, model=model)
+    print(f"\033[34mMetrics {model}: {input_tokens} in / {output_tokens} out tokens, queue {queue_time*1000:.0f} ms, "
+          f"prompt {prompt_time*1000:.0f} ms, completion {completion_time*1000:.0f} ms, {tokens_per_second:.1f} T/s, "
+          f"cost {'{0:.8f}'.format(cost)}$" + ("" if prices else " (no price for this model)") + "\033[0m")
+    return cost
+
+
+def record_llm_metrics(mode, message: AIMessage):
+    if mode == "cloud":
+        return record_cloud_metrics(message)
+    return record_local_metrics(message)
+
+
+class MetricsCallbackHandler(BaseCallbackHandler):
+    # Times tool calls and counts LLM errors of one query, optionally as trace spans of the thread
+    def __init__(self, mode, thread_id):
+        self.mode = mode
+        self.thread_id = thread_id
+        self.runs = {}
+        self.root_span = tracer.start_span("query", attributes={"thread_id": str(thread_id), "mode": mode}) if tracer else None
+
+    def start(self, run_id, name):
+        span = None
+        if self.root_span is not None:
+            span = tracer.start_span(name, context=trace.set_span_in_context(self.root_span), attributes={"thread_id": str(self.thread_id)})
+        self.runs[run_id] = (name, time.monotonic(), span)
+
+    def end(self, run_id, error=None):
+        name, start_time, span = self.runs.pop(run_id, (None, None, None))
+        if span is not None:
+            if error is not None:
+                span.record_exception(error)
+            span.end()
+        return name, (time.monotonic() - start_time) if start_time else None
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self.start(run_id, (serialized or {}).get("name", "tool"))
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        name, duration = self.end(run_id)
+        if name is not None:
+            tool_duration.observe(duration, tool=name)
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        name, duration = self.end(run_id, error)
+        if name is not None:
+            tool_duration.observe(duration, tool=name)
+            tool_errors.inc(tool=name)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self.start(run_id, "llm")
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self.end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self.end(run_id, error)
+        llm_errors.inc(backend=BACKENDS.get(self.mode, self.mode))
+        notify_generation(self.mode, None)
+
+    def finish(self, error=None):
+        if self.root_span is not None:
+            if error is not None:
+                self.root_span.record_exception(error)
+            self.root_span.end()
@@ -0,0 +1,50 @@
+import sys
+import time
+import argparse
+from dotenv import load_dotenv
+
+# Copies a Chroma collection (ids, embeddings, texts and metadata) into the memory mapped store of
+# mmap_store.py without calling the embedding model. Then start the app with VECTOR_BACKEND=mmap,
+# the lexical index and the source catalog are shared by both backends.
+#   python migrate_vector_store.py --dtype int8
+load_dotenv()
+
+from get_vector_db import CHROMA_PATH, get_active_collection, build_vector_db
+from mmap_store import MmapVectorStore
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy a Chroma collection into the memory mapped vector store")
+    parser.add_argument('--collection', default=None, help="collection to migrate (default the active one)")
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'int8'])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--force', action='store_true', help="replace an existing memory mapped store of the collection")
+    args = parser.parse_args()
+
+    collection = args.collection or get_active_collection()
+    chroma = build_vector_db(collection, None, backend='chroma')
+    target = MmapVectorStore(collection, CHROMA_PATH, dtype=args.dtype)
+    if target.count():
+        if not args.force:
+            print(f"\033[31m{target.path} already has {target.count()} chunks, use --force to replace it\033[0m")
+            return 1
+        target.delete_collection()
+        target = MmapVectorStore(collection, CHROMA_PATH, dtype=args.dtype)
+
+    start_time = time.monotonic()
+    copied = 0
+    while True:
+        batch = chroma.get(limit=args.batch_size, offset=copied, include=["embeddings", "documents", "metadatas"])
+        if not batch['ids']:
+            break
+        target.add_embeddings(batch['ids'], batch['embeddings'], batch['documents'], batch['metadatas'])
+        copied += len(batch['ids'])
+        print(f"Copied {copied} chunks ({copied / (time.monotonic() - start_time):.0f} chunks/s)")
+
+    print(f"\033[32mMigrated {copied} chunks of {collection} to {target.path} ({args.dtype}) in {time.monotonic() - start_time:.1f} s, "
+          f"set VECTOR_BACKEND=mmap to use it\033[0m")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
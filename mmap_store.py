@@ -0,0 +1,329 @@
+import os
+import json
+import uuid
+import fcntl
+import shutil
+import sqlite3
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+# Vector store backend for VECTOR_BACKEND=mmap, an alternative to Chroma for a corpus of tens of
+# thousands of chunks. The normalized embeddings (float32, or int8 with a scale per row), a live flag
+# per row and a small header are a single file under {CHROMA_PATH}/{collection}.mmap, memory mapped
+# by every worker process so the matrix is in the page cache once. Ids, texts and metadata are in a
+# sqlite side table. A search is one exact matrix-vector product over the used rows.
+# Writers hold a file lock. When the file is grown it is replaced, readers remap it on their next call.
+MMAP_VECTOR_DTYPE = os.getenv('MMAP_VECTOR_DTYPE', 'float32')
+DTYPES = {'float32': np.float32, 'int8': np.int8}
+INITIAL_CAPACITY = 1024
+HEADER_SIZE = 64
+# int8 rows are converted to float32 this many at a time, bounds the temporary copy of a search
+INT8_BLOCK_ROWS = 16384
+
+
+def align(offset):
+    return (offset + 63) // 64 * 64
+
+
+def layout(capacity, dim, itemsize):
+    # header (capacity, dim) | live flags | scales | vectors
+    live = HEADER_SIZE
+    scales = align(live + capacity)
+    vectors = align(scales + 4 * capacity)
+    return live, scales, vectors, vectors + capacity * dim * itemsize
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+@dataclass
+class Mapping:
+    inode: int
+    capacity: int
+    dim: int
+    data: np.memmap
+    live: np.ndarray
+    scales: np.ndarray
+    vectors: np.ndarray
+
+
+class MmapVectorStore(VectorStore):
+    def __init__(self, collection_name, persist_directory, embedding_function=None, dtype=MMAP_VECTOR_DTYPE):
+        self.collection_name = collection_name
+        self.path = os.path.join(persist_directory, f"{collection_name}.mmap")
+        self.data_path = os.path.join(self.path, 'vectors')
+        self.db_path = os.path.join(self.path, 'metadata.sqlite')
+        self.lock_path = os.path.join(self.path, 'lock')
+        self._embedding_function = embedding_function
+        self.lock = threading.Lock()
+        self.mapping = None
+        os.makedirs(self.path, exist_ok=True)
+        with self.connect() as conn:
+            conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS rows (
+                    row INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    source TEXT,
+                    content TEXT NOT NULL,
+                    metadata TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS rows_source ON rows(source);
+            """)
+            conn.execute("INSERT OR IGNORE INTO info (key, value) VALUES ('dtype', ?)", (dtype,))
+            # The dtype of an existing store wins over MMAP_VECTOR_DTYPE
+            self.dtype = DTYPES[conn.execute("SELECT value FROM info WHERE key = 'dtype'").fetchone()[0]]
+        self.repair()
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    @contextmanager
+    def write_lock(self):
+        with self.lock, open(self.lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def map(self, f):
+        header = np.fromfile(f, dtype=np.int64, count=2)
+        capacity, dim = int(header[0]), int(header[1])
+        live, scales, vectors, size = layout(capacity, dim, np.dtype(self.dtype).itemsize)
+        data = np.memmap(f, dtype=np.uint8, mode='r+', shape=(size,))
+        return Mapping(
+            inode=os.fstat(f.fileno()).st_ino,
+            capacity=capacity,
+            dim=dim,
+            data=data,
+            live=data[live:live + capacity],
+            scales=data[scales:scales + 4 * capacity].view(np.float32),
+            vectors=data[vectors:size].view(self.dtype).reshape(capacity, dim),
+        )
+
+    def current(self):
+        # Mapping of the data file, remapped when another process replaced it. None when empty.
+        try:
+            inode = os.stat(self.data_path).st_ino
+        except FileNotFoundError:
+            return None
+        mapping = self.mapping
+        if mapping is not None and mapping.inode == inode:
+            return mapping
+        with open(self.data_path, 'r+b') as f:
+            mapping = self.map(f)
+        self.mapping = mapping
+        return mapping
+
+    def grow(self, mapping, needed, dim):
+        # Writes a bigger copy of the data file and swaps it in, callers hold the write lock
+        capacity = INITIAL_CAPACITY if mapping is None else mapping.capacity
+        while capacity < needed:
+            capacity *= 2
+        itemsize = np.dtype(self.dtype).itemsize
+        live, scales, vectors, size = layout(capacity, dim, itemsize)
+        tmp_path = f"{self.data_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w+b') as f:
+            f.truncate(size)
+            f.write(np.array([capacity, dim], dtype=np.int64).tobytes())
+            f.flush()
+            f.seek(0)
+            grown = self.map(f)
+            if mapping is not None:
+                grown.live[:mapping.capacity] = mapping.live
+                grown.scales[:mapping.capacity] = mapping.scales
+                grown.vectors[:mapping.capacity] = mapping.vectors
+            grown.data.flush()
+        os.replace(tmp_path, self.data_path)
+        grown.inode = os.stat(self.data_path).st_ino
+        self.mapping = grown
+        return grown
+
+    def repair(self):
+        # A writer that died between the metadata commit and the live flag leaves rows out of sync
+        with self.write_lock():
+            mapping = self.current()
+            if mapping is None:
+                return
+            with self.connect() as conn:
+                rows = np.fromiter((row for (row,) in conn.execute("SELECT row FROM rows")), dtype=np.int64)
+            stored = np.zeros(mapping.capacity, dtype=np.uint8)
+            stored[rows[rows < mapping.capacity]] = 1
+            if not np.array_equal(stored, mapping.live):
+                mapping.live[:] = stored
+                mapping.data.flush()
+
+    def add_embeddings(self, ids, embeddings, texts, metadatas=None):
+        metadatas = metadatas or [{} for _ in texts]
+        # Same id twice in one call: the last one wins, like an upsert
+        entries = {id: (vector, text, metadata) for id, vector, text, metadata in zip(ids, embeddings, texts, metadatas)}
+        if not entries:
+            return []
+        vectors = normalize([vector for vector, _, _ in entries.values()])
+        with self.write_lock():
+            mapping = self.current()
+            if mapping is not None and mapping.dim != vectors.shape[1]:
+                raise ValueError(f"Embeddings of dimension {vectors.shape[1]}, the collection has {mapping.dim}")
+            self.delete_rows(mapping, list(entries))
+            free = np.flatnonzero(mapping.live == 0) if mapping is not None else np.empty(0, dtype=np.int64)
+            if len(free) < len(entries):
+                used = mapping.capacity - len(free) if mapping is not None else 0
+                mapping = self.grow(mapping, used + len(entries), vectors.shape[1])
+                free = np.flatnonzero(mapping.live == 0)
+            rows = free[:len(entries)]
+            if self.dtype == np.int8:
+                scales = np.abs(vectors).max(axis=1) / 127
+                scales[scales == 0] = 1
+                mapping.vectors[rows] = np.round(vectors / scales[:, None]).astype(np.int8)
+                mapping.scales[rows] = scales
+            else:
+                mapping.vectors[rows] = vectors
+                mapping.scales[rows] = 1
+            mapping.data.flush()
+            with self.connect() as conn:
+                conn.executemany("INSERT OR REPLACE INTO rows (row, id, source, content, metadata) VALUES (?, ?, ?, ?, ?)", [
+                    (int(row), id, (metadata or {}).get('source'), text, json.dumps(metadata or {}))
+                    for row, (id, (_, text, metadata)) in zip(rows, entries.items())
+                ])
+            # Searches only see the rows once their metadata is there
+            mapping.live[rows] = 1
+            mapping.data.flush()
+        return list(entries)
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        return self.add_embeddings(ids, self._embedding_function.embed_documents(texts), texts, metadatas)
+
+    def delete_rows(self, mapping, ids):
+        with self.connect() as conn:
+            rows = []
+            for i in range(0, len(ids), 500):
+                batch = ids[i:i + 500]
+                rows += [row for (row,) in conn.execute(f"SELECT row FROM rows WHERE id IN ({', '.join('?' * len(batch))})", batch)]
+                conn.execute(f"DELETE FROM rows WHERE id IN ({', '.join('?' * len(batch))})", batch)
+        if rows and mapping is not None:
+            mapping.live[rows] = 0
+            mapping.data.flush()
+        return len(rows)
+
+    def delete(self, ids=None, **kwargs):
+        if not ids:
+            return False
+        with self.write_lock():
+            self.delete_rows(self.current(), list(ids))
+        return True
+
+    def where_clause(self, where):
+        # Equality filters, {'source': ...} uses the indexed column
+        clauses, params = [], []
+        for key, value in (where or {}).items():
+            clauses.append("source = ?" if key == 'source' else f"json_extract(metadata, '$.{key}') = ?")
+            params.append(value)
+        return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("documents", "metadatas"), **kwargs):
+        clause, params = self.where_clause(where)
+        if ids is not None:
+            ids = [ids] if isinstance(ids, str) else list(ids)
+            clause += (" AND " if clause else " WHERE ") + f"id IN ({', '.join('?' * len(ids))})"
+            params += ids
+        query = f"SELECT id, content, metadata FROM rows{clause} ORDER BY row"
+        if limit is not None or offset:
+            query += " LIMIT ? OFFSET ?"
+            params += [limit if limit is not None else -1, offset or 0]
+        with self.connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+        return {
+            "ids": [id for id, _, _ in rows],
+            "documents": [content for _, content, _ in rows] if "documents" in include else None,
+            "metadatas": [json.loads(metadata) for _, _, metadata in rows] if "metadatas" in include else None,
+        }
+
+    def count(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM rows").fetchone()[0]
+
+    def scores(self, mapping, query, end):
+        # Only rows below the last live one, new rows take the lowest free slots
+        if self.dtype == np.float32:
+            return mapping.vectors[:end] @ query
+        scores = np.empty(end, dtype=np.float32)
+        block = np.empty((min(end, INT8_BLOCK_ROWS), mapping.dim), dtype=np.float32)
+        for start in range(0, end, INT8_BLOCK_ROWS):
+            rows = min(INT8_BLOCK_ROWS, end - start)
+            np.copyto(block[:rows], mapping.vectors[start:start + rows])
+            np.matmul(block[:rows], query, out=scores[start:start + rows])
+        return scores * mapping.scales[:end]
+
+    def similarity_search_by_vector_with_score(self, embedding, k=4, filter=None):
+        mapping = self.current()
+        if mapping is None:
+            return []
+        live = np.flatnonzero(mapping.live)
+        if not len(live):
+            return []
+        end = int(live[-1]) + 1
+        candidates = mapping.live[:end] != 0
+        scores = self.scores(mapping, normalize(embedding), end)
+        if filter:
+            clause, params = self.where_clause(filter)
+            with self.connect() as conn:
+                allowed = np.zeros(end, dtype=bool)
+                allowed[[row for (row,) in conn.execute(f"SELECT row FROM rows{clause}", params) if row < end]] = True
+            candidates &= allowed
+        scores = np.where(candidates, scores, -np.inf)
+        k = min(k, int(candidates.sum()))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        with self.connect() as conn:
+            rows = {row: (content, metadata) for row, content, metadata in conn.execute(
+                f"SELECT row, content, metadata FROM rows WHERE row IN ({', '.join('?' * k)})", [int(row) for row in top])}
+        # A row deleted after the product is skipped
+        return [(Document(page_content=rows[row][0], metadata=json.loads(rows[row][1])), float(scores[row]))
+                for row in top if row in rows]
+
+    def similarity_search_by_vector(self, embedding, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query, k=4, filter=None, **kwargs):
+        return self.similarity_search_by_vector_with_score(self._embedding_function.embed_query(query), k, filter)
+
+    def similarity_search(self, query, k=4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    def _select_relevance_score_fn(self):
+        # Scores are cosine similarities
+        return lambda score: (score + 1) / 2
+
+    def delete_collection(self):
+        with self.write_lock():
+            self.mapping = None
+            shutil.rmtree(self.path, ignore_errors=True)
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, collection_name='local-rag', persist_directory='chroma', **kwargs):
+        store = cls(collection_name, persist_directory, embedding)
+        store.add_texts(texts, metadatas, ids)
+        return store
@@ -0,0 +1,178 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from get_vector_db import CHROMA_PATH
+
+# Caches in front of the embedding server and the retriever. The LLM rephrases the same question
+# across turns and users, and the answer cache, the router and the normativa retriever each embed it.
+# - CachedQueryEmbeddings: LRU of normalized query text -> embedding, optionally persisted to a sqlite
+#   file shared by the worker processes. Entries are keyed by the embedding model.
+# - RetrievalCache: query -> top-k documents of the retriever, dropped when the collection version changes.
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', 2048))
+QUERY_EMBEDDING_CACHE_PERSIST = os.getenv('QUERY_EMBEDDING_CACHE_PERSIST', 'false').lower() == 'true'
+QUERY_EMBEDDING_CACHE_PATH = os.getenv('QUERY_EMBEDDING_CACHE_PATH', os.path.join(CHROMA_PATH, 'query-embeddings.sqlite'))
+# Rows kept in the sqlite file, the least recently stored are deleted beyond it
+QUERY_EMBEDDING_CACHE_DISK_SIZE = int(os.getenv('QUERY_EMBEDDING_CACHE_DISK_SIZE', 100000))
+RETRIEVAL_CACHE_SIZE = int(os.getenv('RETRIEVAL_CACHE_SIZE', 1024))
+
+
+def normalize_query(text):
+    return " ".join(text.split()).lower()
+
+
+class CachedQueryEmbeddings(Embeddings):
+    # Documents are embedded once at ingestion, only embed_query goes through the cache
+    def __init__(self, embeddings, model, maxsize=QUERY_EMBEDDING_CACHE_SIZE, path=QUERY_EMBEDDING_CACHE_PATH if QUERY_EMBEDDING_CACHE_PERSIST else None):
+        self.embeddings = embeddings
+        self.model = model
+        self.maxsize = maxsize
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "errors": 0, "miss_ms": 0.0}
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            with self.connect() as conn:
+                conn.executescript("""
+                    PRAGMA journal_mode=WAL;
+                    CREATE TABLE IF NOT EXISTS query_embeddings (
+                        model TEXT NOT NULL,
+                        query TEXT NOT NULL,
+                        vector BLOB NOT NULL,
+                        stored_at REAL NOT NULL,
+                        PRIMARY KEY (model, query)
+                    );
+                    CREATE INDEX IF NOT EXISTS query_embeddings_stored_at ON query_embeddings(stored_at);
+                """)
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def remember(self, key, vector):
+        # callers hold self.lock
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def load(self, key):
+        try:
+            with self.connect() as conn:
+                row = conn.execute("SELECT vector FROM query_embeddings WHERE model = ? AND query = ?", (self.model, key)).fetchone()
+        except sqlite3.Error as e:
+            print(f"\033[31mQuery embedding cache file unavailable: {e}\033[0m")
+            return None
+        return None if row is None else np.frombuffer(row[0], dtype=np.float32).tolist()
+
+    def save(self, key, vector):
+        try:
+            with self.connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO query_embeddings (model, query, vector, stored_at) VALUES (?, ?, ?, ?)",
+                             (self.model, key, np.asarray(vector, dtype=np.float32).tobytes(), time.time()))
+                conn.execute("DELETE FROM query_embeddings WHERE stored_at < (SELECT stored_at FROM query_embeddings "
+                             "ORDER BY stored_at DESC LIMIT 1 OFFSET ?)", (QUERY_EMBEDDING_CACHE_DISK_SIZE,))
+        except sqlite3.Error as e:
+            print(f"\033[31mQuery embedding cache file unavailable: {e}\033[0m")
+
+    def embed_query(self, text):
+        key = normalize_query(text)
+        with self.lock:
+            vector = self.entries.get(key)
+            if vector is not None:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return vector
+        if self.path:
+            vector = self.load(key)
+            if vector is not None:
+                with self.lock:
+                    self.remember(key, vector)
+                    self.stats["disk_hits"] += 1
+                return vector
+
+        start_time = time.monotonic()
+        try:
+            vector = self.embeddings.embed_query(text)
+        except Exception:
+            with self.lock:
+                self.stats["errors"] += 1
+            raise
+        elapsed_ms = (time.monotonic() - start_time) * 1000
+        with self.lock:
+            self.remember(key, vector)
+            self.stats["misses"] += 1
+            self.stats["miss_ms"] += elapsed_ms
+        if self.path:
+            self.save(key, vector)
+        return vector
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            size = len(self.entries)
+        lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+        avg_miss_ms = stats.pop("miss_ms") / stats["misses"] if stats["misses"] else 0.0
+        return {**stats, "size": size, "maxsize": self.maxsize, "persisted": bool(self.path),
+                "hit_rate": (stats["hits"] + stats["disk_hits"]) / lookups if lookups else 0.0,
+                "avg_miss_ms": avg_miss_ms,
+                # Estimate: every hit saved one request of the average miss latency
+                "saved_ms": (stats["hits"] + stats["disk_hits"]) * avg_miss_ms}
+
+
+class RetrievalCache:
+    # (query, k, fetch_k) -> documents returned by the retriever, valid for one collection version
+    def __init__(self, maxsize=RETRIEVAL_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = None
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "invalidated": 0}
+
+    def check_version(self, version):
+        # callers hold self.lock
+        if version != self.version:
+            self.stats["invalidated"] += len(self.entries)
+            self.entries.clear()
+            self.version = version
+
+    def lookup(self, key, version):
+        with self.lock:
+            self.check_version(version)
+            docs = self.entries.get(key)
+            if docs is None:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return list(docs)
+
+    def store(self, key, version, docs):
+        with self.lock:
+            # Results of a search that started before the last version change are dropped
+            if self.version is not None and version < self.version:
+                return
+            self.check_version(version)
+            self.entries[key] = list(docs)
+            self.stats["stores"] += 1
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def get_stats(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return {**self.stats, "size": len(self.entries), "maxsize": self.maxsize,
+                    "hit_rate": self.stats["hits"] / lookups if lookups else 0.0}
@@ -0,0 +1,250 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+
+# Bulk (re)indexing of every PDF in SOURCE_FOLDER and a list of URLs into a fresh collection,
+# e.g. after changing TEXT_EMBEDDING_MODEL or the splitter. The app keeps serving the active
+# collection while it is built, then the active collection pointer is swapped and every worker
+# follows it on its next request. Documents uploaded, URLs embedded and sources deleted through the app
+# while the collection is built are replayed into it before and after the swap. An interrupted run
+# is resumed by running the command again.
+#   python reindex.py --urls urls.txt --workers 4
+# --reconcile only checks the source catalog of the active collection against the collection and exits.
+load_dotenv()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Rebuild the vector collection from SOURCE_FOLDER and a list of URLs")
+    parser.add_argument('--urls', default=None, help="file with one URL per line (# starts a comment)")
+    parser.add_argument('--drop-urls', action='store_true', help="don't index the URLs of the active collection again")
+    # The URLs of the active collection are kept by default, the flag is accepted for older scripts
+    parser.add_argument('--keep-urls', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--workers', type=int, default=4, help="sources indexed at the same time")
+    parser.add_argument('--parse-workers', type=int, default=os.cpu_count() or 1, help="processes parsing PDF pages")
+    parser.add_argument('--embed-concurrency', type=int, default=4, help="embedding requests in flight")
+    parser.add_argument('--fresh', action='store_true', help="discard an interrupted run instead of resuming it")
+    parser.add_argument('--keep-previous', action='store_true', help="keep the replaced collection (it is deleted by default)")
+    parser.add_argument('--no-swap', action='store_true', help="build the collection without making it active")
+    parser.add_argument('--reconcile', action='store_true', help="check the source catalog of the active collection against it and exit")
+    return parser.parse_args()
+
+
+from get_vector_db import (CHROMA_PATH, COLLECTION_NAME, TEXT_EMBEDDING_MODEL, get_vector_db, forget_vector_db,
+                           get_active_collection, set_active_collection)
+from lexical_index import forget_lexical_index, lexical_index_path
+from source_catalog import get_source_catalog, forget_source_catalog, source_catalog_path
+import embed
+from embed import SOURCE_FOLDER, allowed_file, embed_file, embed_url_source, remove_source
+
+STATE_FILE = os.path.join(CHROMA_PATH, 'reindex.json')
+# Seconds the replaced collection is kept after the swap, for the queries that are still using it
+DROP_GRACE_SECONDS = float(os.getenv('REINDEX_DROP_GRACE', 30))
+
+
+def load_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_state(state):
+    os.makedirs(CHROMA_PATH, exist_ok=True)
+    tmp_file = f"{STATE_FILE}.tmp"
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_file, STATE_FILE)
+
+
+def drop_collection(collection):
+    get_vector_db(collection).delete_collection()
+    forget_vector_db(collection)
+    forget_lexical_index(collection)
+    forget_source_catalog(collection)
+    for path in (lexical_index_path(collection), source_catalog_path(collection)):
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    print(f"\033[33mDeleted collection {collection}\033[0m")
+
+
+def configure_ingestion(args):
+    # Every PDF goes through the parse pool so pages are parsed on all cores
+    embed.INGEST_EMBED_CONCURRENCY = args.embed_concurrency
+    embed.embedding_slots = threading.BoundedSemaphore(args.embed_concurrency)
+    embed.INGEST_PARSE_WORKERS = args.parse_workers
+    embed.INGEST_PARSE_MIN_PAGES = 1
+
+
+def is_url(source):
+    return source.startswith(('http://', 'https://'))
+
+
+def list_sources(urls_file, drop_urls):
+    sources = [('pdf', os.path.join(SOURCE_FOLDER, name)) for name in sorted(os.listdir(SOURCE_FOLDER)) if allowed_file(name)]
+    urls = []
+    if urls_file:
+        with open(urls_file) as f:
+            urls = [line.split('#', 1)[0].strip() for line in f]
+    active_urls = [entry['source'] for entry in get_source_catalog().list() if is_url(entry['source'])]
+    if drop_urls:
+        dropped = set(active_urls) - set(urls)
+        if dropped:
+            print(f"\033[31m--drop-urls: {len(dropped)} URLs of the active collection will not be in the new one: "
+                  f"{', '.join(sorted(dropped))}\033[0m")
+    else:
+        urls += active_urls
+    sources += [('url', url) for url in dict.fromkeys(url for url in urls if url)]
+    return sources
+
+
+def is_done(catalog, kind, source):
+    # Sources finished before a crash are in the catalog of the collection being built
+    entry = catalog.get(source)
+    if entry is None:
+        return False
+    return kind == 'url' or os.path.getmtime(source) <= entry['ingested_at']
+
+
+def replay_changes(source_collection, collection, since, sources_at_start):
+    # Applies to collection what the app did to source_collection after since: sources embedded or
+    # updated are indexed again, sources deleted are removed. Returns the number of sources replayed.
+    source_catalog = get_source_catalog(source_collection)
+    catalog = get_source_catalog(collection)
+    current = {entry['source']: entry for entry in source_catalog.list()}
+    replayed = 0
+    for source, entry in current.items():
+        if entry['ingested_at'] <= since:
+            continue
+        if is_url(source):
+            embed_url_source(source, collection=collection)
+        elif os.path.exists(source):
+            embed_file(source, collection=collection)
+        else:
+            continue
+        replayed += 1
+        print(f"\033[33mReplayed {source} into {collection}\033[0m")
+    for source in sources_at_start:
+        if source not in current and catalog.get(source) is not None:
+            remove_source(source, collection)
+            replayed += 1
+            print(f"\033[33mReplayed the deletion of {source} in {collection}\033[0m")
+    return replayed
+
+
+class Throughput:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.start_time = time.monotonic()
+
+    def progress(self, source):
+        def progress(**counters):
+            with self.lock:
+                self.counters.setdefault(source, {}).update(counters)
+        return progress
+
+    def totals(self):
+        with self.lock:
+            pages = sum(counters.get('pages_parsed', 0) for counters in self.counters.values())
+            chunks = sum(counters.get('chunks_total', 0) for counters in self.counters.values())
+        elapsed = time.monotonic() - self.start_time
+        return pages, chunks, elapsed
+
+    def report(self, prefix):
+        pages, chunks, elapsed = self.totals()
+        print(f"{prefix}: {pages} pages, {chunks} chunks in {elapsed:.1f} s "
+              f"({pages / elapsed if elapsed else 0:.1f} pages/s, {chunks / elapsed if elapsed else 0:.1f} chunks/s)")
+
+
+def reconcile():
+    collection = get_active_collection()
+    updated, removed = get_source_catalog(collection).reconcile(get_vector_db(collection))
+    print(f"\033[32mSource catalog of {collection} reconciled: {updated} sources added or updated, {removed} removed\033[0m")
+    return 0
+
+
+def main(args):
+    if args.reconcile:
+        return reconcile()
+    configure_ingestion(args)
+    os.makedirs(SOURCE_FOLDER, exist_ok=True)
+    state = load_state()
+    if state and (args.fresh or state['embedding_model'] != TEXT_EMBEDDING_MODEL):
+        print(f"\033[33mDiscarding the interrupted build of {state['collection']}\033[0m")
+        drop_collection(state['collection'])
+        state = None
+    if state:
+        print(f"\033[33mResuming the build of {state['collection']}\033[0m")
+    else:
+        state = {"collection": f"{COLLECTION_NAME}-{time.strftime('%Y%m%d%H%M%S')}", "embedding_model": TEXT_EMBEDDING_MODEL, "started_at": time.time()}
+    if 'sources_at_start' not in state:
+        # Sources deleted through the app during the build are the ones of this list missing at the end
+        state['sources_at_start'] = [entry['source'] for entry in get_source_catalog().list()]
+        save_state(state)
+    collection = state['collection']
+    catalog = get_source_catalog(collection)
+
+    sources = list_sources(args.urls, args.drop_urls)
+    pending = [(kind, source) for kind, source in sources if not is_done(catalog, kind, source)]
+    print(f"Indexing {len(pending)} of {len(sources)} sources into {collection} with {args.workers} workers")
+
+    throughput = Throughput()
+    stop = threading.Event()
+
+    def reporter():
+        while not stop.wait(10):
+            throughput.report("Progress")
+    threading.Thread(target=reporter, daemon=True).start()
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {}
+        for kind, source in pending:
+            index = embed_file if kind == 'pdf' else embed_url_source
+            futures[executor.submit(index, source, progress=throughput.progress(source), collection=collection)] = source
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                failed.append(futures[future])
+                print(f"\033[31mCould not index {futures[future]}: {e}\033[0m")
+    stop.set()
+    throughput.report("Indexed")
+
+    if failed:
+        print(f"\033[31m{len(failed)} sources failed, run the command again to retry them and finish the build\033[0m")
+        return 1
+    if args.no_swap:
+        print(f"Built {collection}, not made active (--no-swap)")
+        return 0
+
+    # Ingestion jobs of the app write to the active collection until the swap, their changes are
+    # replayed until a pass finds none
+    previous = get_active_collection()
+    since = state['started_at']
+    while True:
+        pass_start = time.time()
+        if not replay_changes(previous, collection, since, state['sources_at_start']):
+            break
+        since = pass_start
+    version = set_active_collection(collection)
+    print(f"\033[32m{collection} is now the active collection (version {version}), it replaced {previous}\033[0m")
+    if previous != collection:
+        # Jobs that resolved the previous collection before the swap finish during the grace period
+        time.sleep(DROP_GRACE_SECONDS)
+        replay_changes(previous, collection, since, state['sources_at_start'])
+        if not args.keep_previous:
+            drop_collection(previous)
+    os.remove(STATE_FILE)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,114 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+from get_vector_db import get_vector_db, get_collection_version
+from lexical_index import get_lexical_index
+from query_cache import RetrievalCache, normalize_query
+
+# Hybrid retrieval for the normativa tool: BM25 over the lexical index fused with the dense search
+# of the vector store using reciprocal rank fusion. When the embedding server is slow or down the
+# lexical results are returned alone. Results of the active collection are cached until its version changes.
+RETRIEVER_K = int(os.getenv('RETRIEVER_K', 2))
+RETRIEVER_FETCH_K = int(os.getenv('RETRIEVER_FETCH_K', 10))
+RRF_K = int(os.getenv('RRF_K', 60))
+VECTOR_SEARCH_TIMEOUT = float(os.getenv('VECTOR_SEARCH_TIMEOUT', 5))
+# After a vector search failure the dense side is skipped for this many seconds
+VECTOR_RETRY_AFTER = float(os.getenv('VECTOR_RETRY_AFTER', 30))
+
+vector_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='vector-search')
+retrieval_stats = {"queries": 0, "lexical_only": 0, "vector_errors": 0, "lexical_ms": 0.0, "vector_ms": 0.0, "overlap": 0, "returned": 0}
+retrieval_stats_lock = threading.Lock()
+vector_down_until = 0.0
+retrieval_cache = RetrievalCache()
+
+
+def document_key(doc):
+    return (doc.metadata.get('source'), doc.page_content)
+
+
+def reciprocal_rank_fusion(result_lists, k=RRF_K):
+    scores = {}
+    docs = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = document_key(doc)
+            docs.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+
+def get_retrieval_stats():
+    with retrieval_stats_lock:
+        stats = dict(retrieval_stats)
+    queries = stats["queries"] or 1
+    stats["avg_lexical_ms"] = stats.pop("lexical_ms") / queries
+    stats["avg_vector_ms"] = stats.pop("vector_ms") / queries
+    stats["cache"] = retrieval_cache.get_stats()
+    return stats
+
+
+class HybridRetriever(BaseRetriever):
+    # None uses the active collection and its index, opened on the first search
+    vector_store: Any = None
+    lexical_index: Any = None
+    k: int = RETRIEVER_K
+    fetch_k: int = RETRIEVER_FETCH_K
+
+    def vector_search(self, query):
+        global vector_down_until
+        if time.monotonic() < vector_down_until:
+            return None
+        vector_store = self.vector_store if self.vector_store is not None else get_vector_db()
+        future = vector_executor.submit(vector_store.similarity_search, query, self.fetch_k)
+        try:
+            return future.result(timeout=VECTOR_SEARCH_TIMEOUT)
+        except Exception as e:
+            vector_down_until = time.monotonic() + VECTOR_RETRY_AFTER
+            print(f"\033[31mVector search unavailable, using lexical results only: {e!r}\033[0m")
+            with retrieval_stats_lock:
+                retrieval_stats["vector_errors"] += 1
+            return None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        start_time = time.monotonic()
+        # Only the default stores are cached, the collection version covers them (and a reindex swap)
+        cache_key = None
+        if self.vector_store is None and self.lexical_index is None:
+            cache_key = (normalize_query(query), self.k, self.fetch_k)
+            version = get_collection_version()
+            cached = retrieval_cache.lookup(cache_key, version)
+            if cached is not None:
+                print(f"\033[34mRetrieval cache hit, returned {len(cached)} docs in {(time.monotonic() - start_time)*1000:.1f} ms\033[0m")
+                return cached
+        lexical_index = self.lexical_index if self.lexical_index is not None else get_lexical_index()
+        lexical = lexical_index.search(query, self.fetch_k)
+        lexical_time = time.monotonic()
+        vector = self.vector_search(query)
+        vector_time = time.monotonic()
+
+        if vector is None:
+            results = lexical[:self.k]
+            overlap = 0
+        else:
+            results = reciprocal_rank_fusion([vector, lexical])[:self.k]
+            overlap = len({document_key(doc) for doc in vector} & {document_key(doc) for doc in lexical})
+
+        print(f"\033[34mRetrieval: lexical {len(lexical)} docs in {(lexical_time - start_time)*1000:.1f} ms, "
+              f"vector {'-' if vector is None else len(vector)} docs in {(vector_time - lexical_time)*1000:.1f} ms, "
+              f"overlap {overlap}, returned {len(results)}\033[0m")
+        with retrieval_stats_lock:
+            retrieval_stats["queries"] += 1
+            retrieval_stats["lexical_only"] += vector is None
+            retrieval_stats["lexical_ms"] += (lexical_time - start_time) * 1000
+            retrieval_stats["vector_ms"] += (vector_time - lexical_time) * 1000
+            retrieval_stats["overlap"] += overlap
+            retrieval_stats["returned"] += len(results)
+        # Lexical only results are not cached, the next query retries the vector search
+        if cache_key is not None and vector is not None:
+            retrieval_cache.store(cache_key, version, results)
+        return results
@@ -0,0 +1,155 @@
+import os
+import re
+import time
+import threading
+import unicodedata
+from dataclasses import dataclass, field
+import numpy as np
+from answer_cache import RETRIEVAL_TOOL
+from metrics import Counter
+
+# Fast path in front of the ReAct agent. Obvious intents are recognised with keywords, or with the
+# similarity of the question to example questions of each route, and answered without the
+# tool-selection generation: greetings with a single generation, single tool questions by calling
+# the tool directly and summarising its output in one generation. Anything else goes to the agent.
+ROUTER_ENABLED = os.getenv('ROUTER_ENABLED', 'true').lower() == 'true'
+ROUTER_THRESHOLD = float(os.getenv('ROUTER_THRESHOLD', 0.8))
+# The best route has to beat the second one by this margin, otherwise the question is ambiguous
+ROUTER_MARGIN = float(os.getenv('ROUTER_MARGIN', 0.05))
+# Greetings are short, longer messages that start with 'hola' usually ask something
+GREETING_MAX_WORDS = int(os.getenv('ROUTER_GREETING_MAX_WORDS', 5))
+
+CHAT = "chat"
+
+KEYWORDS = {
+    CHAT: re.compile(r"^(hola|holi|buenas|buenos dias|buenas tardes|buenas noches|bon dia|bona tarda|bona nit|hey|hello|hi|"
+                     r"gracias|muchas gracias|moltes gracies|merci|thanks|thank you|adios|adeu|hasta luego|fins aviat|bye)\b"),
+    # Only first person or possessive phrasing, "horario de secretaria" is not the schedule of the user
+    "get_user_class_schedule": re.compile(r"\b(mis? horarios?|el meu horari|my (class )?schedule|my timetable|horarios? tengo|horaris? tinc|"
+                                          r"tengo clases?|tinc classes?|clases? tengo|classes? tinc|clases? de hoy|clases? de manana)\b"),
+    # Same for the subjects: "asignaturas de primer curso" are not the ones the user is enrolled in
+    "get_subjects_list": re.compile(r"\b(mis asignaturas|les meves assignatures|my subjects)\b|"
+                                    r"\b(asignaturas|assignatures|subjects)\b.*\b(tengo(?! que)|tinc(?! que)|estoy matriculad\w*|estic matriculat|"
+                                    r"me he matriculado|m'he matriculat|am i enrolled|i am enrolled|i'm enrolled)\b|"
+                                    r"\b(estoy matriculad\w*|estic matriculat|me he matriculado|m'he matriculat|am i enrolled|i am enrolled)\b.*"
+                                    r"\b(asignaturas|assignatures|subjects)\b"),
+    RETRIEVAL_TOOL: re.compile(r"\b(normativa|reglamento|regulations?)\b"),
+}
+
+EXAMPLES = {
+    CHAT: ["hola", "buenos dias", "gracias", "muchas gracias por la ayuda", "adios", "hasta luego",
+           "bon dia", "moltes gracies", "hello", "thank you"],
+    "get_user_class_schedule": ["que clases tengo hoy", "cual es mi horario", "a que hora tengo clase manana",
+                                "que horario tengo esta semana", "quines classes tinc avui", "what classes do I have today"],
+    "get_subjects_list": ["que asignaturas tengo este cuatrimestre", "en que asignaturas estoy matriculado",
+                          "quines assignatures tinc", "which subjects am I enrolled in"],
+    RETRIEVAL_TOOL: ["que dice la normativa sobre las practicas externas", "como funciona la evaluacion segun la normativa de la FIB",
+                     "cuantos creditos necesito para presentar el TFG segun la normativa"],
+}
+
+router_decisions = Counter("fiberbot_router_decisions_total", "Questions routed by the fast path or sent to the agent", ("route", "method"))
+router_latency_saved = Counter("fiberbot_router_latency_saved_seconds_total", "Estimated latency saved by the fast path", ("route",))
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(ch for ch in text if not unicodedata.combining(ch)).strip()
+
+
+@dataclass
+class Route:
+    name: str
+    method: str
+    score: float
+    tool: str = None
+    args: dict = field(default_factory=dict)
+
+
+class IntentRouter:
+    def __init__(self, embeddings, tool_descriptions, threshold=ROUTER_THRESHOLD, margin=ROUTER_MARGIN):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.margin = margin
+        # The descriptions of the tools are matched too, so they stay the single source of what a tool does
+        self.examples = {name: examples + ([tool_descriptions[name]] if name in tool_descriptions else [])
+                         for name, examples in EXAMPLES.items()}
+        self.lock = threading.Lock()
+        self.example_vectors = None
+        self.example_routes = None
+        self.stats = {"routed": 0, "fallback": 0, "ambiguous": 0, "latency_saved_seconds": 0.0}
+
+    def load_examples(self):
+        with self.lock:
+            if self.example_vectors is None:
+                routes = [name for name, examples in self.examples.items() for _ in examples]
+                vectors = np.asarray(self.embeddings.embed_documents([text for examples in self.examples.values() for text in examples]), dtype=np.float32)
+                norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+                self.example_vectors = vectors / np.where(norms == 0, 1, norms)
+                self.example_routes = routes
+        return self.example_vectors, self.example_routes
+
+    def make_route(self, name, method, score, question):
+        if name == CHAT:
+            return Route(name, method, score)
+        return Route(name, method, score, tool=name, args={"query": question} if name == RETRIEVAL_TOOL else {})
+
+    def classify(self, question, vector=None):
+        text = normalize(question)
+        words = len(text.split())
+        matches = [name for name, pattern in KEYWORDS.items() if pattern.search(text)]
+        if CHAT in matches and (len(matches) > 1 or words > GREETING_MAX_WORDS):
+            matches.remove(CHAT)
+        if len(matches) == 1:
+            return self.make_route(matches[0], "keyword", 1.0, question), None
+        if len(matches) > 1:
+            return None, "ambiguous"
+
+        try:
+            example_vectors, example_routes = self.load_examples()
+            if vector is None:
+                vector = np.asarray(self.embeddings.embed_query(question), dtype=np.float32)
+                vector = vector / (np.linalg.norm(vector) or 1)
+        except Exception as e:
+            print(f"\033[31mRouter similarity not available: {e}\033[0m")
+            return None, "fallback"
+        similarities = example_vectors @ vector
+        scores = {}
+        for name, similarity in zip(example_routes, similarities):
+            scores[name] = max(scores.get(name, -1.0), float(similarity))
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        best, score = ranked[0]
+        second = ranked[1][1] if len(ranked) > 1 else -1.0
+        if score < self.threshold or (best == CHAT and words > GREETING_MAX_WORDS):
+            return None, "fallback"
+        if score - second < self.margin:
+            return None, "ambiguous"
+        return self.make_route(best, "similarity", score, question), None
+
+    def route(self, question, vector=None):
+        # vector is the normalized embedding of the question when the caller already has it
+        if not ROUTER_ENABLED or not question:
+            return None
+        start_time = time.monotonic()
+        route, reason = self.classify(question, vector)
+        elapsed = (time.monotonic() - start_time) * 1000
+        with self.lock:
+            self.stats["routed" if route else reason] += 1
+        if route:
+            router_decisions.inc(route=route.name, method=route.method)
+            print(f"\033[32mRouter: '{question}' -> {route.name} ({route.method} {route.score:.2f}, {elapsed:.0f} ms)\033[0m")
+        else:
+            router_decisions.inc(route="agent", method=reason)
+            print(f"\033[33mRouter: '{question}' -> agent ({reason}, {elapsed:.0f} ms)\033[0m")
+        return route
+
+    def observe_route(self, route, duration, generation_time):
+        # The agent would have run one more generation over the same prompt to pick the tool
+        # (natural_language_chat for greetings), that generation is the latency saved
+        with self.lock:
+            self.stats["latency_saved_seconds"] += generation_time
+        router_latency_saved.inc(generation_time, route=route.name)
+        print(f"\033[32mRouter: {route.name} answered in {duration:.2f} s, ~{generation_time:.2f} s saved over the agent\033[0m")
+
+    def get_stats(self):
+        with self.lock:
+            return {**self.stats, "enabled": ROUTER_ENABLED, "threshold": self.threshold, "margin": self.margin}
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+from get_vector_db import CHROMA_PATH, COLLECTION_NAME, get_active_collection
+
+# Catalog of the sources stored in the vector collection: chunk ids, chunk count, content hash and
+# ingest time per source. Listing and deleting sources use it instead of scanning the collection.
+SOURCE_CATALOG_PATH = os.getenv('SOURCE_CATALOG_PATH', os.path.join(CHROMA_PATH, f"{COLLECTION_NAME}-sources.sqlite"))
+
+
+def source_catalog_path(collection):
+    # Collections built by reindex.py get their own catalog next to them
+    if collection == COLLECTION_NAME:
+        return SOURCE_CATALOG_PATH
+    return os.path.join(CHROMA_PATH, f"{collection}-sources.sqlite")
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def content_hash(chunk_ids):
+    # chunk ids are already content addressed, see embed.chunk_id
+    return hashlib.sha256('\n'.join(chunk_ids).encode('utf-8')).hexdigest()
+
+
+class SourceCatalog:
+    def __init__(self, path=SOURCE_CATALOG_PATH):
+        self.path = path
+        self.write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with self.connect() as conn:
+            conn.executescript("""
+                PRAGMA journal_mode=WAL;
+                CREATE TABLE IF NOT EXISTS sources (
+                    source TEXT PRIMARY KEY,
+                    chunk_count INTEGER NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    ingested_at REAL NOT NULL,
+                    chunk_ids TEXT NOT NULL
+                );
+                -- Sources whose chunks a process is changing, cleared when their entry is written. Rows left
+                -- by a process that died are the entries that may not match the collection.
+                CREATE TABLE IF NOT EXISTS pending (
+                    source TEXT NOT NULL,
+                    pid INTEGER NOT NULL,
+                    started_at REAL NOT NULL,
+                    PRIMARY KEY (source, pid)
+                );
+            """)
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def begin(self, source):
+        # Called before the chunks of the source change in the vector store
+        with self.write_lock, self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO pending (source, pid, started_at) VALUES (?, ?, ?)", (source, os.getpid(), time.time()))
+
+    def abort(self, sources):
+        # The changes were rolled back, the entries are still right
+        with self.write_lock, self.connect() as conn:
+            conn.executemany("DELETE FROM pending WHERE source = ? AND pid = ?", [(source, os.getpid()) for source in sources])
+
+    def put(self, source, chunk_ids):
+        with self.write_lock, self.connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO sources (source, chunk_count, content_hash, ingested_at, chunk_ids) VALUES (?, ?, ?, ?, ?)",
+                         (source, len(chunk_ids), content_hash(chunk_ids), time.time(), json.dumps(chunk_ids)))
+            conn.execute("DELETE FROM pending WHERE source = ? AND pid = ?", (source, os.getpid()))
+
+    def get(self, source):
+        with self.connect() as conn:
+            row = conn.execute("SELECT * FROM sources WHERE source = ?", (source,)).fetchone()
+        if row is None:
+            return None
+        return {**dict(row), "chunk_ids": json.loads(row["chunk_ids"])}
+
+    def remove(self, source):
+        with self.write_lock, self.connect() as conn:
+            conn.execute("DELETE FROM sources WHERE source = ?", (source,))
+            conn.execute("DELETE FROM pending WHERE source = ? AND pid = ?", (source, os.getpid()))
+
+    def pending_sources(self):
+        # (sources being changed by running processes, sources left pending by processes that died)
+        with self.connect() as conn:
+            rows = conn.execute("SELECT source, pid FROM pending").fetchall()
+        running, interrupted = set(), set()
+        for row in rows:
+            (running if pid_alive(row["pid"]) else interrupted).add(row["source"])
+        return running, interrupted - running
+
+    def list(self, after=None, limit=None):
+        # Keyset pagination by source name
+        query = "SELECT source, chunk_count, content_hash, ingested_at FROM sources"
+        params = []
+        if after is not None:
+            query += " WHERE source > ?"
+            params.append(after)
+        query += " ORDER BY source"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self.connect() as conn:
+            return [dict(row) for row in conn.execute(query, params).fetchall()]
+
+    def count(self):
+        with self.connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+
+    def reconcile(self, vector_store, sources=None):
+        # The catalog is written after the vector store, a crash in between leaves it listing sources
+        # that are gone or missing ones that are there. Checks the given sources against the collection,
+        # or all of them with sources=None (a scan of the whole collection, reindex.py --reconcile).
+        # Sources a running process is changing are skipped, and entries written by an ingestion after
+        # the snapshot are left alone. Returns the sources (updated, removed).
+        running, interrupted = self.pending_sources()
+        with self.connect() as conn:
+            snapshot = {row["source"]: (row["ingested_at"], set(json.loads(row["chunk_ids"])))
+                        for row in conn.execute("SELECT source, ingested_at, chunk_ids FROM sources")}
+        by_source = {}
+        if sources is None:
+            docs = vector_store.get(include=["metadatas"])
+            for id, metadata in zip(docs['ids'], docs['metadatas']):
+                source = (metadata or {}).get('source')
+                if source is not None:
+                    by_source.setdefault(source, []).append(id)
+            checked = set(by_source) | set(snapshot)
+        else:
+            for source in sources:
+                ids = vector_store.get(where={'source': source}, include=[])['ids']
+                if ids:
+                    by_source[source] = ids
+            checked = set(sources)
+
+        updated = removed = 0
+        now = time.time()
+        with self.write_lock, self.connect() as conn:
+            for source in checked - running:
+                chunk_ids = by_source.get(source)
+                if chunk_ids is None:
+                    if source in snapshot:
+                        removed += conn.execute("DELETE FROM sources WHERE source = ? AND ingested_at = ?", (source, snapshot[source][0])).rowcount
+                elif source not in snapshot:
+                    updated += conn.execute("INSERT OR IGNORE INTO sources (source, chunk_count, content_hash, ingested_at, chunk_ids) VALUES (?, ?, ?, ?, ?)",
+                                            (source, len(chunk_ids), content_hash(chunk_ids), now, json.dumps(chunk_ids))).rowcount
+                elif snapshot[source][1] != set(chunk_ids):
+                    updated += conn.execute("UPDATE sources SET chunk_count = ?, content_hash = ?, chunk_ids = ? WHERE source = ? AND ingested_at = ?",
+                                            (len(chunk_ids), content_hash(chunk_ids), json.dumps(chunk_ids), source, snapshot[source][0])).rowcount
+            # Rows of dead processes are done with, those of running ones stay
+            for source in interrupted & checked:
+                for (pid,) in conn.execute("SELECT pid FROM pending WHERE source = ?", (source,)).fetchall():
+                    if not pid_alive(pid):
+                        conn.execute("DELETE FROM pending WHERE source = ? AND pid = ?", (source, pid))
+        return updated, removed
+
+
+_catalogs = {}
+_catalog_lock = threading.Lock()
+
+def get_source_catalog(collection=None):
+    # None is the catalog of the active collection
+    collection = collection or get_active_collection()
+    with _catalog_lock:
+        if collection not in _catalogs:
+            _catalogs[collection] = SourceCatalog(source_catalog_path(collection))
+    return _catalogs[collection]
+
+def forget_source_catalog(collection):
+    with _catalog_lock:
+        _catalogs.pop(collection, None)
@@ -0,0 +1,55 @@
+import os
+import json
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from langchain_core.messages import ToolMessage
+from langchain_core.tools import BaseTool
+from metrics import Counter
+
+# Timeouts of the agent tools. The ToolNode of langgraph already runs the tool calls of one AIMessage
+# at the same time, each tool is wrapped so a call that doesn't answer in time gets an error
+# ToolMessage and the model answers with the results of the others. As the calls of a turn start
+# together, capping every timeout to TOOL_TURN_DEADLINE is also the deadline of the turn.
+TOOL_TIMEOUT = float(os.getenv('TOOL_TIMEOUT', 20))
+# Per tool overrides, e.g. '{"duckduckgo_search": 8}'
+TOOL_TIMEOUTS = json.loads(os.getenv('TOOL_TIMEOUTS', '{}'))
+TOOL_TURN_DEADLINE = float(os.getenv('TOOL_TURN_DEADLINE', 30))
+# A thread can't be killed, tools that time out keep running in the background. The shared pool
+# bounds how many of them there can be.
+TOOL_WORKERS = int(os.getenv('TOOL_WORKERS', 16))
+
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+tool_timeouts = Counter("fiberbot_tool_timeouts_total", "Tool calls that did not answer before their timeout", ("tool",))
+
+
+class TimeoutTool(BaseTool):
+    # Same name, description and arguments as the wrapped tool, so the model and the ToolNode see no difference
+    tool: BaseTool
+    timeout: float
+
+    def __init__(self, tool, timeout):
+        super().__init__(tool=tool, timeout=timeout, name=tool.name, description=tool.description, args_schema=tool.args_schema)
+
+    def _run(self, *args, **kwargs):
+        return self.tool._run(*args, **kwargs)
+
+    def invoke(self, input, config=None, **kwargs):
+        start_time = time.monotonic()
+        # The call runs in a copy of the caller's context, so the context variables set by the request
+        # (Flask request context, langchain callbacks and tracing parent run) are visible in the tool
+        future = tool_executor.submit(contextvars.copy_context().run, self.tool.invoke, input, config, **kwargs)
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            tool_timeouts.inc(tool=self.name)
+            print(f"\033[31mTool {self.name} timed out after {time.monotonic() - start_time:.1f} s\033[0m")
+            content = f"Error: the tool {self.name} did not answer in time. Answer with the other results or tell the user to try again later."
+            if isinstance(input, dict) and input.get("type") == "tool_call":
+                return ToolMessage(content=content, name=self.name, tool_call_id=input["id"], status="error")
+            return content
+
+
+def with_timeout(tool):
+    return TimeoutTool(tool, min(TOOL_TIMEOUTS.get(tool.name, TOOL_TIMEOUT), TOOL_TURN_DEADLINE))
@@ -0,0 +1,107 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+import requests
+from get_vector_db import get_vector_db, OLLAMA_SERVER_URL, TEXT_EMBEDDING_MODEL
+from lexical_index import get_lexical_index
+from source_catalog import get_source_catalog
+from agent import LLM_MODEL
+
+# Startup of a worker. The app serves as soon as it is imported, the slow parts (opening the
+# collection, loading the models in Ollama, compiling the agent) run in a background thread and
+# /readyz reports ready when they are done, so a new replica only gets traffic once it is useful.
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', 'true').lower() == 'true'
+# Loads the chat and embedding models in the Ollama server before the first query
+WARMUP_MODELS = os.getenv('WARMUP_MODELS', 'true').lower() == 'true'
+OLLAMA_KEEP_ALIVE = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+WARMUP_TIMEOUT = float(os.getenv('WARMUP_TIMEOUT', 300))
+
+ready = threading.Event()
+startup_report = {"phases": {}, "errors": {}, "ready": False}
+startup_lock = threading.Lock()
+
+
+@contextmanager
+def phase(name):
+    start_time = time.monotonic()
+    try:
+        yield
+    except Exception as e:
+        # A failed phase is reported, the worker still becomes ready (cloud mode doesn't need Ollama)
+        print(f"\033[31mStartup phase {name} failed: {e}\033[0m")
+        with startup_lock:
+            startup_report["errors"][name] = str(e)
+    finally:
+        record_phase(name, time.monotonic() - start_time)
+
+
+def record_phase(name, seconds):
+    with startup_lock:
+        startup_report["phases"][name] = round(seconds, 3)
+
+
+def preload_chat_model(model):
+    # A generate request without prompt only loads the model
+    response = requests.post(f"{OLLAMA_SERVER_URL}/api/generate", json={"model": model, "keep_alive": OLLAMA_KEEP_ALIVE}, timeout=WARMUP_TIMEOUT)
+    response.raise_for_status()
+
+
+def preload_embedding_model(model=TEXT_EMBEDDING_MODEL):
+    response = requests.post(f"{OLLAMA_SERVER_URL}/api/embed", json={"model": model, "input": "", "keep_alive": OLLAMA_KEEP_ALIVE}, timeout=WARMUP_TIMEOUT)
+    response.raise_for_status()
+
+
+def backfill_indexes():
+    # Lexical index and source catalog of collections created before they existed. Otherwise only the
+    # catalog entries left pending by an ingestion or delete that died are checked, the full check is
+    # reindex.py --reconcile.
+    lexical_index = get_lexical_index()
+    if lexical_index.count() == 0:
+        print(f"\033[33mBuilt lexical index with {lexical_index.rebuild_from(get_vector_db())} chunks\033[0m")
+    catalog = get_source_catalog()
+    if catalog.count() == 0:
+        updated, removed = catalog.reconcile(get_vector_db())
+    else:
+        _, interrupted = catalog.pending_sources()
+        if not interrupted:
+            return
+        updated, removed = catalog.reconcile(get_vector_db(), sources=interrupted)
+    if updated or removed:
+        print(f"\033[33mSource catalog reconciled with the collection: {updated} sources added or updated, {removed} removed\033[0m")
+
+
+def warm_up(agent, process_start):
+    with phase("vector_store"):
+        get_vector_db()
+    with phase("backfill_indexes"):
+        backfill_indexes()
+    if WARMUP_ENABLED:
+        with phase("agent_local"):
+            agent.get_executor("local")
+        if os.getenv("GROQ_API_KEY"):
+            with phase("agent_cloud"):
+                agent.get_executor("cloud")
+        if WARMUP_MODELS:
+            with phase("ollama_chat_model"):
+                preload_chat_model(LLM_MODEL)
+            with phase("ollama_embedding_model"):
+                preload_embedding_model()
+        with phase("router_examples"):
+            agent.router.load_examples()
+
+    with startup_lock:
+        startup_report["ready"] = True
+        startup_report["total_seconds"] = round(time.monotonic() - process_start, 3)
+        report = dict(startup_report["phases"])
+    ready.set()
+    print(f"\033[32mReady in {startup_report['total_seconds']} s: " + ", ".join(f"{name} {seconds} s" for name, seconds in report.items()) + "\033[0m")
+
+
+def start_warm_up(agent, process_start):
+    threading.Thread(target=warm_up, args=(agent, process_start), name="warm-up", daemon=True).start()
+
+
+def get_startup_report():
+    with startup_lock:
+        return {**startup_report, "phases": dict(startup_report["phases"]), "errors": dict(startup_report["errors"])}